@@ -2,22 +2,42 @@ import argparse
 import json
 import logging
 import re
+import socket
 import sys
 
 from dedupe_trees import (
+    DEFAULT_BLOCK_SIZE,
+    AutoTuningBlockReader,
+    BlockComparator,
+    BlockReader,
     ConfiguredSourceFilter,
+    ContentSampler,
     CopyPatternDuplicateResolver,
     DeduplicateOperation,
     DeleteDuplicateFileSink,
+    DigestCache,
+    DuplicatePlan,
+    FileOperationSink,
     FilenameSortDuplicateResolver,
     InteractiveDuplicateResolver,
+    LinkDuplicateFileSink,
+    ManifestSource,
+    MergedDeduplicateOperation,
     ModificationDateDuplicateResolver,
     OutputOnlyDuplicateFileSink,
     PathLengthDuplicateResolver,
+    PhaseProfiler,
+    PlanDuplicateFileSink,
+    ProgressReporter,
+    SamplingProfiler,
+    ScanManifest,
     SequesterDuplicateFileSink,
     SortBasedDuplicateResolver,
     Source,
     SourceOrderDuplicateResolver,
+    WatchedDeduplicateOperation,
+    get_hash_algorithm,
+    hash_algorithms,
 )
 
 # Establish dictionaries mapping command-line arguments to resolvers and sinks
@@ -36,6 +56,18 @@ sinks = {
         "class": SequesterDuplicateFileSink,
         "args": [{"name": "path", "type": str, "nargs": 1}],
     },
+    "link": {
+        "class": LinkDuplicateFileSink,
+        "args": [
+            {
+                "name": "mode",
+                "type": str,
+                "nargs": 1,
+                "default": "auto",
+                "choices": LinkDuplicateFileSink.modes,
+            }
+        ],
+    },
     "output-only": {
         "class": OutputOnlyDuplicateFileSink,
         "args": [
@@ -50,6 +82,34 @@ sinks = {
 }
 
 
+def block_size(value):
+    if value == "auto":
+        return value
+
+    size = int(value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("block size must be positive")
+
+    return size
+
+
+def memory_size(value):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    multiplier = units.get(value[-1:].upper(), 1)
+    if multiplier > 1:
+        value = value[:-1]
+
+    try:
+        size = int(value) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(value))
+
+    if size <= 0:
+        raise argparse.ArgumentTypeError("memory limit must be positive")
+
+    return size
+
+
 class ResolverAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         if (not hasattr(namespace, self.dest)) or getattr(namespace, self.dest) is None:
@@ -101,6 +161,241 @@ def main():
         help="Configuration file in JSON format, if not ~/.deduperc",
     )
 
+    parser.add_argument(
+        "--prefilter-size",
+        dest="prefilter_size",
+        type=int,
+        default=4096,
+        help="Bytes sampled from each region of candidate files before computing "
+        "full digests (default 4096); 0 disables sampling",
+    )
+
+    parser.add_argument(
+        "--prefilter-tail",
+        dest="prefilter_tail",
+        action="store_true",
+        help="Also sample the end of each candidate file",
+    )
+
+    parser.add_argument(
+        "--prefilter-blocks",
+        dest="prefilter_blocks",
+        type=int,
+        default=0,
+        help="Number of evenly-spaced blocks to sample from the middle of each "
+        "candidate file",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of files to hash concurrently (default 1)",
+    )
+
+    parser.add_argument(
+        "--hash",
+        dest="hash",
+        choices=list(hash_algorithms.keys()) + ["auto"],
+        default="sha512",
+        help="Digest algorithm used to identify duplicates (default sha512). "
+        "Matches found with crc32 or adler32 are confirmed by comparing contents; "
+        "'auto' selects the fastest cryptographic algorithm on this machine",
+    )
+
+    parser.add_argument(
+        "--block-size",
+        dest="block_size",
+        type=block_size,
+        default=DEFAULT_BLOCK_SIZE,
+        help="Size in bytes of the reads used to hash files (default {}), or 'auto' "
+        "to choose one for each device by measurement".format(DEFAULT_BLOCK_SIZE),
+    )
+
+    parser.add_argument(
+        "--compare-bytes",
+        dest="compare_bytes",
+        action="store_true",
+        help="Confirm duplicates by comparing file contents directly, rather than "
+        "by their digests",
+    )
+
+    parser.add_argument(
+        "--collapse-hardlinks",
+        dest="collapse_hardlinks",
+        action="store_true",
+        help="Treat hard links to the same file as a single file, considering only "
+        "the first link found",
+    )
+
+    parser.add_argument(
+        "--ignore-file",
+        dest="ignore_file",
+        default=".dedupeignore",
+        help="Name of the files, in the style of .gitignore, whose rules exclude "
+        "files and subdirectories of their own directory, if not .dedupeignore "
+        "(an empty name disables ignore files)",
+    )
+
+    parser.add_argument(
+        "--compact",
+        dest="compact",
+        action="store_true",
+        help="Use a compact in-memory representation for catalogued files, "
+        "reducing memory use for very large trees at a small cost in speed",
+    )
+
+    parser.add_argument(
+        "--fwalk",
+        dest="fwalk",
+        action="store_true",
+        help="Walk the sources with os.fwalk(), finding files relative to open "
+        "directory descriptors rather than by full path (not available on Windows)",
+    )
+
+    parser.add_argument(
+        "--columnar",
+        dest="columnar",
+        action="store_true",
+        help="Group files and evaluate sort-based resolvers with NumPy arrays, "
+        "which is faster for very large trees (requires NumPy, installed with the "
+        "columnar extra)",
+    )
+
+    parser.add_argument(
+        "--memory-limit",
+        dest="memory_limit",
+        type=memory_size,
+        help="Approximate memory to use for the file catalog, such as 512M or 2G; "
+        "beyond this, the catalog is sorted on disk in the temporary directory",
+    )
+
+    parser.add_argument(
+        "--manifest",
+        dest="manifest",
+        help="File in which to save the state of this scan. If it already exists, "
+        "only files that are new or changed since the saved scan are read, and "
+        "duplicate groups added or dissolved since then are reported",
+    )
+
+    parser.add_argument(
+        "--node",
+        dest="node",
+        default=socket.gethostname(),
+        help="Name of this node in a multi-node run, if not its host name",
+    )
+
+    parser.add_argument(
+        "--node-scan",
+        dest="node_scan",
+        action="store_true",
+        help="Only scan the sources, hashing every file, and save them to the "
+        "--manifest, to be merged with the manifests of other nodes by "
+        "--merge-plans. No resolvers or sink are needed",
+    )
+
+    parser.add_argument(
+        "--merge-plans",
+        dest="merge_plans",
+        help="Merge the node manifests given in place of source directories, "
+        "resolve duplicates across all of them, and write a plan of each node's "
+        "duplicates to this directory. No files are read, and no sink is needed",
+    )
+
+    parser.add_argument(
+        "--apply-plan",
+        dest="apply_plan",
+        help="Pass the duplicates in this plan, written by --merge-plans for this "
+        "node, to the sink, skipping files that have changed since they were "
+        "scanned. No sources or resolvers are needed",
+    )
+
+    parser.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="After scanning, keep watching the sources for changes (Linux only), "
+        "resolving and sinking new duplicates as they appear",
+    )
+
+    parser.add_argument(
+        "--metrics-json",
+        dest="metrics_json",
+        help="File in which to save timings and counts of the work done in each "
+        "phase of the run, as JSON",
+    )
+
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        help="Directory in which to write a profile of each phase of the run",
+    )
+
+    parser.add_argument(
+        "--profile-mode",
+        dest="profile_mode",
+        choices=["full", "sampling"],
+        default="full",
+        help="full: a cProfile dump and tracemalloc snapshot for each phase; "
+        "sampling: periodic samples of every thread's stack, cheap enough for "
+        "production use (default full)",
+    )
+
+    parser.add_argument(
+        "--progress",
+        dest="progress",
+        action="store_true",
+        help="Report the progress of confirming duplicates to standard error",
+    )
+
+    parser.add_argument(
+        "--progress-file",
+        dest="progress_file",
+        help="File in which to keep a JSON report of the progress of confirming "
+        "duplicates",
+    )
+
+    parser.add_argument(
+        "--progress-interval",
+        dest="progress_interval",
+        type=float,
+        default=1.0,
+        help="Seconds between progress reports (default 1)",
+    )
+
+    parser.add_argument(
+        "--sink-batch-size",
+        dest="sink_batch_size",
+        type=int,
+        default=1000,
+        help="Number of duplicate files to pass to the sink at a time (default "
+        "1000); 0 passes all duplicates at the end of the run",
+    )
+
+    parser.add_argument(
+        "--sink-jobs",
+        dest="sink_jobs",
+        type=int,
+        default=1,
+        help="Number of files the delete, sequester and link sinks work on at once "
+        "(default 1)",
+    )
+
+    parser.add_argument(
+        "--digest-cache",
+        dest="digest_cache",
+        help="SQLite database in which to cache file digests between runs",
+    )
+
+    parser.add_argument(
+        "--digest-cache-prune",
+        dest="digest_cache_prune",
+        action="store_true",
+        help="Remove cached digests for files that no longer exist or have changed",
+    )
+
     # Resolvers take an optional argument 'desc' to indicate descending/reverse sorting
     for item in resolvers:
         if issubclass(resolvers[item], SortBasedDuplicateResolver):
@@ -132,9 +427,14 @@ def main():
                 action="store",
                 type=sink_arg["type"],
                 nargs=sink_arg["nargs"],
+                choices=sink_arg.get("choices"),
             )
 
-    parser.add_argument("source_dir", nargs="+", help="A directory tree to be scanned.")
+    parser.add_argument(
+        "source_dir",
+        nargs="*",
+        help="A directory tree to scan (or, with --merge-plans, a node manifest).",
+    )
 
     a = parser.parse_args()
 
@@ -142,22 +442,37 @@ def main():
     logging.getLogger(__name__).handlers[:] = [logging.StreamHandler()]
 
     # Check for required parameters that aren't enforced by argparse.
-    if a.sink_class is None or a.resolvers is None:
+    if (
+        (a.sink_class is None and not (a.node_scan or a.merge_plans is not None))
+        or (a.resolvers is None and not (a.node_scan or a.apply_plan is not None))
+        or (not a.source_dir and a.apply_plan is None)
+    ):
         parser.print_help()
         return 1
 
+    if a.node_scan and (a.manifest is None or a.watch):
+        logging.getLogger(__name__).error(
+            "--node-scan requires --manifest, and cannot be combined with --watch."
+        )
+        return 1
+
     # Load config to get base ignores.
     ignore_pattern_list = None
     ignore_file_list = None
+    ignore_glob_list = None
     try:
         with open(a.config, "r") as config_file:
             config = json.load(config_file)
 
         ignore_pattern_list = [re.compile(x) for x in config.get("ignore_patterns", [])]
         ignore_file_list = config.get("ignore_names", [])
+        ignore_glob_list = config.get("ignore_globs", [])
         logging.getLogger(__name__).info(
-            "Loaded configuration file {} with {} ignore names and {} ignore patterns.".format(
-                a.config, len(ignore_file_list), len(ignore_pattern_list)
+            "Loaded configuration file {} with {} ignore names, {} ignore patterns and {} ignore globs.".format(
+                a.config,
+                len(ignore_file_list),
+                len(ignore_pattern_list),
+                len(ignore_glob_list),
             )
         )
     except IOError:
@@ -170,14 +485,33 @@ def main():
 
     # Create and number sources.
     sources = []
-    source_filter = ConfiguredSourceFilter(ignore_pattern_list, ignore_file_list)
+    source_filter = ConfiguredSourceFilter(
+        ignore_pattern_list, ignore_file_list, ignore_glob_list
+    )
 
-    for i in range(len(a.source_dir)):
-        sources.append(Source(a.source_dir[i], i + 1, source_filter))
+    try:
+        if a.merge_plans is not None:
+            # The sources are those recorded in each node's manifest.
+            sources = ManifestSource.load_all(a.source_dir)
+        else:
+            for i in range(len(a.source_dir)):
+                sources.append(
+                    Source(
+                        a.source_dir[i],
+                        i + 1,
+                        source_filter,
+                        a.compact,
+                        a.fwalk,
+                        a.ignore_file or None,
+                    )
+                )
+    except (OSError, ValueError) as e:
+        logging.getLogger(__name__).error(str(e))
+        return 1
 
     # Create sink, pulling out applicable parameters.
     params = {}
-    for arg in sinks[a.sink_class]["args"]:
+    for arg in sinks[a.sink_class]["args"] if a.sink_class is not None else []:
         this_arg_name = "sink-arguments-" + a.sink_class + "-" + arg["name"]
         if hasattr(a, this_arg_name):
             this_arg = getattr(a, this_arg_name)
@@ -194,12 +528,145 @@ def main():
                     parser.print_help()
                     return 1
 
-    sink = sinks[a.sink_class]["class"](**params)
+    sink = None
+    if a.merge_plans is not None:
+        sink = PlanDuplicateFileSink(
+            a.merge_plans, sorted(set(s.node for s in sources))
+        )
+    elif a.sink_class is not None:
+        if issubclass(sinks[a.sink_class]["class"], FileOperationSink):
+            params["jobs"] = a.sink_jobs
+
+        sink = sinks[a.sink_class]["class"](**params)
+
+    if a.apply_plan is not None:
+        try:
+            plan = DuplicatePlan.load(a.apply_plan)
+            if plan.node != a.node:
+                raise ValueError(
+                    "The plan {} is for node {}, not {}.".format(
+                        a.apply_plan, plan.node, a.node
+                    )
+                )
+
+            (sunk, skipped) = plan.apply(sink, a.sink_batch_size)
+        except (OSError, ValueError) as e:
+            logging.getLogger(__name__).error(str(e))
+            return 1
+
+        logging.getLogger(__name__).info(
+            "Applied plan {}: {} duplicate files sunk and {} skipped.".format(
+                a.apply_plan, sunk, skipped
+            )
+        )
+        return 0
+
+    # Configure hashing and content sampling.
+    algorithm = get_hash_algorithm(a.hash)
+    logging.getLogger(__name__).info(
+        "Using the {} digest algorithm.".format(algorithm.name)
+    )
+
+    if a.block_size == "auto":
+        reader = AutoTuningBlockReader()
+    else:
+        reader = BlockReader(a.block_size)
+
+    sampler = None
+    if a.prefilter_size > 0:
+        sampler = ContentSampler(
+            a.prefilter_size, a.prefilter_tail, a.prefilter_blocks, algorithm
+        )
+
+    # Open the digest cache, if requested.
+    digest_cache = None
+    if a.digest_cache is not None:
+        digest_cache = DigestCache(a.digest_cache)
+        if a.digest_cache_prune:
+            logging.getLogger(__name__).info(
+                "Pruned {} stale entries from the digest cache.".format(
+                    digest_cache.prune()
+                )
+            )
+
+    progress = None
+    if a.progress or a.progress_file is not None:
+        progress = ProgressReporter(
+            sys.stderr if a.progress else None, a.progress_file, a.progress_interval
+        )
+
+    profiler = None
+    if a.profile is not None:
+        if a.profile_mode == "sampling":
+            profiler = SamplingProfiler(a.profile)
+        else:
+            profiler = PhaseProfiler(a.profile)
+
+    manifest = None
+    if a.manifest is not None:
+        manifest = ScanManifest.load(
+            a.manifest, algorithm, a.node if a.node_scan else None
+        )
 
     # Run the operation
-    op = DeduplicateOperation(sources, a.resolvers, sink)
+    try:
+        if a.merge_plans is not None:
+            # Digests come from the manifests; no files are sampled or read.
+            op = MergedDeduplicateOperation(
+                sources,
+                a.resolvers,
+                sink,
+                digest_cache=digest_cache,
+                comparator=BlockComparator() if a.compare_bytes else None,
+                collapse_links=a.collapse_hardlinks,
+                sink_batch_size=a.sink_batch_size,
+                columnar=a.columnar,
+                memory_limit=a.memory_limit,
+                manifest=manifest,
+                progress=progress,
+                profiler=profiler,
+            )
+        else:
+            op = (WatchedDeduplicateOperation if a.watch else DeduplicateOperation)(
+                sources,
+                a.resolvers,
+                sink,
+                sampler=sampler,
+                digest_cache=digest_cache,
+                jobs=a.jobs,
+                comparator=BlockComparator() if a.compare_bytes else None,
+                algorithm=algorithm,
+                reader=reader,
+                collapse_links=a.collapse_hardlinks,
+                sink_batch_size=a.sink_batch_size,
+                columnar=a.columnar,
+                memory_limit=a.memory_limit,
+                manifest=manifest,
+                progress=progress,
+                profiler=profiler,
+            )
 
-    op.run()
+        if a.node_scan:
+            op.scan()
+        elif a.watch:
+            try:
+                op.watch()
+            except KeyboardInterrupt:
+                # Watching continues until interrupted.
+                pass
+        else:
+            op.run()
+
+        if manifest is not None:
+            manifest.save(a.manifest)
+        if a.metrics_json is not None:
+            op.stats.save(a.metrics_json)
+    except ValueError as e:
+        logging.getLogger(__name__).error(str(e))
+        return 1
+    finally:
+        if digest_cache is not None:
+            digest_cache.close()
 
     return 0
 
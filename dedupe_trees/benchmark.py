@@ -0,0 +1,454 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dedupe_trees import (
+    BlockComparator,
+    ContentSampler,
+    DeduplicateOperation,
+    FilenameSortDuplicateResolver,
+    OutputOnlyDuplicateFileSink,
+    PathLengthDuplicateResolver,
+    Source,
+    get_hash_algorithm,
+    hash_algorithms,
+)
+
+PHASES = ["walk", "group", "hash", "resolve", "sink"]
+
+
+def generate_tree(
+    root,
+    files=1000,
+    depth=3,
+    fanout=4,
+    min_size=1,
+    max_size=1 << 16,
+    duplicate_ratio=0.3,
+    mean_group_size=2.5,
+    decoy_ratio=0.05,
+    seed=0,
+):
+    """Create a reproducible tree of files under root, returning a summary.
+
+    Directories form a tree depth levels deep, with fanout subdirectories at
+    each level, and files are spread evenly among them. File sizes are
+    distributed log-uniformly between min_size and max_size. duplicate_ratio is
+    the proportion of files that are redundant copies of another file; each
+    duplicate group has two files, plus an exponentially distributed number of
+    extra copies, so that groups average mean_group_size files. decoy_ratio is
+    the proportion of files that have the same size as another file but differ
+    from it in a single byte. Very small files may also be duplicates by chance."""
+    rng = random.Random(seed)
+
+    directories = [root]
+    level = [root]
+    for i in range(depth):
+        level = [
+            os.path.join(parent, "dir{}".format(j))
+            for parent in level
+            for j in range(fanout)
+        ]
+        directories.extend(level)
+
+    # Plan each file as (content seed, size, offset of a flipped byte or None).
+    duplicates = int(files * duplicate_ratio)
+    decoys = int(files * decoy_ratio)
+    (low, high) = (math.log(min_size), math.log(max_size + 1))
+    contents = []
+    for i in range(files - duplicates - decoys):
+        size = min(int(math.exp(rng.uniform(low, high))), max_size)
+        contents.append((rng.getrandbits(32), size, None))
+
+    # Each duplicate group copies a different file.
+    plan = list(contents)
+    originals = list(contents)
+    rng.shuffle(originals)
+    groups = 0
+    remaining = duplicates
+    while remaining > 0 and originals:
+        extra = 0
+        if mean_group_size > 2:
+            extra = int(round(rng.expovariate(1 / (mean_group_size - 2))))
+        copies = min(1 + extra, remaining)
+        plan.extend([originals.pop()] * copies)
+        remaining -= copies
+        groups += 1
+
+    for i in range(decoys if contents else 0):
+        (content_seed, size, flip) = rng.choice(contents)
+        plan.append((content_seed, size, rng.randrange(size)))
+
+    rng.shuffle(plan)
+
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    total = 0
+    for (i, (content_seed, size, flip)) in enumerate(plan):
+        data = bytearray(
+            random.Random(content_seed).getrandbits(size * 8).to_bytes(size, "little")
+        )
+        if flip is not None:
+            data[flip] ^= 0xFF
+
+        path = os.path.join(directories[i % len(directories)], "file{}.dat".format(i))
+        with open(path, "wb") as f:
+            f.write(data)
+        total += size
+
+    return {
+        "files": len(plan),
+        "bytes": total,
+        "directories": len(directories),
+        "duplicate_groups": groups,
+        "duplicates": duplicates - remaining,
+        "decoys": decoys if contents else 0,
+    }
+
+
+def time_phases(operation):
+    """Run operation one phase at a time, returning the time taken by each phase
+    and counts of the work done."""
+    timings = {}
+
+    start = time.perf_counter()
+    catalog = operation.build_catalog()
+    timings["walk"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    candidates = list(catalog.get_groups())
+    timings["group"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    groups = list(operation.find_duplicates(candidates))
+    timings["hash"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    duplicates = []
+    for (originals, group_duplicates) in operation.resolve_all(groups, catalog):
+        duplicates.extend(group_duplicates)
+    timings["resolve"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    operation.sink.sink(duplicates)
+    timings["sink"] = time.perf_counter() - start
+
+    counts = {
+        "files": sum(len(entries) for entries in catalog.store.values()),
+        "candidates": sum(len(g) for g in candidates),
+        "candidate_bytes": sum(entry.get_size() for g in candidates for entry in g),
+        "duplicate_groups": len(groups),
+        "duplicates": len(duplicates),
+    }
+
+    return (timings, counts)
+
+
+def run_benchmark(root, repeat=1, **kwargs):
+    """Time each phase of a deduplication of root, repeat times, keeping the
+    fastest time for each phase. kwargs are passed to DeduplicateOperation.
+    Nothing is changed on disk: duplicates are written to os.devnull."""
+    best = {}
+    with open(os.devnull, "w") as devnull:
+        for i in range(repeat):
+            operation = DeduplicateOperation(
+                [Source(root, 1)],
+                [PathLengthDuplicateResolver(), FilenameSortDuplicateResolver()],
+                OutputOnlyDuplicateFileSink(devnull),
+                **kwargs
+            )
+            (timings, counts) = time_phases(operation)
+            for (phase, seconds) in timings.items():
+                best[phase] = min(seconds, best.get(phase, seconds))
+
+    def rate(amount, seconds):
+        return amount / seconds if seconds else None
+
+    total = sum(best.values())
+    return {
+        "phases": best,
+        "total": total,
+        "counts": counts,
+        "throughput": {
+            "files_per_second": rate(counts["files"], total),
+            "walk_files_per_second": rate(counts["files"], best["walk"]),
+            "hash_megabytes_per_second": rate(
+                counts["candidate_bytes"] / (1 << 20), best["hash"]
+            ),
+        },
+    }
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def add_generator_arguments(parser):
+    parser.add_argument(
+        "--files", type=int, default=10000, help="Number of files (default 10000)"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=3, help="Depth of the directory tree (default 3)"
+    )
+    parser.add_argument(
+        "--fanout", type=int, default=4, help="Subdirectories per directory (default 4)"
+    )
+    parser.add_argument(
+        "--min-size", type=int, default=1, help="Smallest file size (default 1)"
+    )
+    parser.add_argument(
+        "--max-size", type=int, default=1 << 16, help="Largest file size (default 64K)"
+    )
+    parser.add_argument(
+        "--duplicate-ratio",
+        type=float,
+        default=0.3,
+        help="Proportion of files that are redundant copies (default 0.3)",
+    )
+    parser.add_argument(
+        "--mean-group-size",
+        type=float,
+        default=2.5,
+        help="Mean number of files in each duplicate group (default 2.5)",
+    )
+    parser.add_argument(
+        "--decoy-ratio",
+        type=float,
+        default=0.05,
+        help="Proportion of files with the same size as another file, but different "
+        "contents (default 0.05)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default 0)")
+
+
+def get_generator_parameters(a):
+    return {
+        "files": a.files,
+        "depth": a.depth,
+        "fanout": a.fanout,
+        "min_size": a.min_size,
+        "max_size": a.max_size,
+        "duplicate_ratio": a.duplicate_ratio,
+        "mean_group_size": a.mean_group_size,
+        "decoy_ratio": a.decoy_ratio,
+        "seed": a.seed,
+    }
+
+
+def generate(a):
+    print(json.dumps(generate_tree(a.root, **get_generator_parameters(a)), indent=2))
+    return 0
+
+
+def run(a):
+    algorithm = get_hash_algorithm(a.hash)
+    sampler = None
+    if a.prefilter_size > 0:
+        sampler = ContentSampler(a.prefilter_size, algorithm=algorithm)
+
+    results = {
+        "label": a.label,
+        "environment": get_environment(),
+        "options": {
+            "jobs": a.jobs,
+            "hash": algorithm.name,
+            "prefilter_size": a.prefilter_size,
+            "compare_bytes": a.compare_bytes,
+            "repeat": a.repeat,
+        },
+    }
+    options = {
+        "jobs": a.jobs,
+        "algorithm": algorithm,
+        "sampler": sampler,
+        "comparator": BlockComparator() if a.compare_bytes else None,
+    }
+
+    if a.tree is None:
+        with tempfile.TemporaryDirectory() as root:
+            results["tree"] = get_generator_parameters(a)
+            results["tree"].update(generate_tree(root, **get_generator_parameters(a)))
+            results.update(run_benchmark(root, a.repeat, **options))
+    else:
+        results["tree"] = {"path": os.path.abspath(a.tree)}
+        results.update(run_benchmark(a.tree, a.repeat, **options))
+
+    for phase in PHASES:
+        print("{:<26} {:>12.3f}s".format(phase, results["phases"][phase]))
+    print("{:<26} {:>12.3f}s".format("total", results["total"]))
+    for (name, value) in results["throughput"].items():
+        if value is not None:
+            print("{:<26} {:>12.1f}".format(name, value))
+
+    if a.output is not None:
+        with open(a.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+def compare(a):
+    with open(a.baseline) as f:
+        baseline = json.load(f)
+    with open(a.results) as f:
+        results = json.load(f)
+
+    print(
+        "{:<10} {:>12} {:>12} {:>8}".format(
+            "phase",
+            baseline.get("label") or "baseline",
+            results.get("label") or "results",
+            "ratio",
+        )
+    )
+    for phase in PHASES + ["total"]:
+        if phase == "total":
+            (before, after) = (baseline["total"], results["total"])
+        else:
+            (before, after) = (baseline["phases"][phase], results["phases"][phase])
+
+        print(
+            "{:<10} {:>11.3f}s {:>11.3f}s {:>8}".format(
+                phase, before, after, "{:.2f}".format(after / before) if before else "-"
+            )
+        )
+
+    return 0
+
+
+def measure_catalog_memory(path, compact):
+    """Walk path into a size catalog, as DeduplicateOperation does, and return
+    (entry count, bytes allocated) for the catalog and its entries."""
+    operation = DeduplicateOperation(
+        [Source(path, 1, compact=compact)], [], OutputOnlyDuplicateFileSink()
+    )
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        catalog = operation.build_catalog()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    return (sum(len(entries) for entries in catalog.store.values()), allocated)
+
+
+def memory(a):
+    if a.path is None:
+        with tempfile.TemporaryDirectory() as root:
+            generate_tree(root, a.files, max_size=4096, duplicate_ratio=0)
+            return memory_report(root)
+
+    return memory_report(a.path)
+
+
+def memory_report(path):
+    print("{:<10} {:>10} {:>14} {:>10}".format("entries", "files", "bytes", "per file"))
+    for (name, compact) in [("standard", False), ("compact", True)]:
+        (count, allocated) = measure_catalog_memory(path, compact)
+        print(
+            "{:<10} {:>10} {:>14} {:>10.1f}".format(
+                name, count, allocated, allocated / count if count else 0
+            )
+        )
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="dedupe_trees.benchmark", description="Benchmark dedupe_trees."
+    )
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    generate_parser = subparsers.add_parser(
+        "generate", help="Generate a synthetic tree of files"
+    )
+    add_generator_arguments(generate_parser)
+    generate_parser.add_argument("root", help="Directory in which to create the tree")
+    generate_parser.set_defaults(function=generate)
+
+    run_parser = subparsers.add_parser(
+        "run", help="Time each phase of a run against a generated or existing tree"
+    )
+    add_generator_arguments(run_parser)
+    run_parser.add_argument(
+        "--tree", help="An existing tree to benchmark, rather than a generated one"
+    )
+    run_parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Files to hash concurrently"
+    )
+    run_parser.add_argument(
+        "--hash",
+        choices=list(hash_algorithms.keys()) + ["auto"],
+        default="sha512",
+        help="Digest algorithm (default sha512)",
+    )
+    run_parser.add_argument(
+        "--prefilter-size",
+        type=int,
+        default=4096,
+        help="Bytes sampled from each candidate file (default 4096); 0 disables "
+        "sampling",
+    )
+    run_parser.add_argument(
+        "--compare-bytes",
+        action="store_true",
+        help="Confirm duplicates by comparing contents",
+    )
+    run_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        help="Number of runs, keeping the fastest time for each phase; runs after "
+        "the first read from a warm cache",
+    )
+    run_parser.add_argument("--label", help="Label for the results, such as a version")
+    run_parser.add_argument("--output", help="File in which to save results as JSON")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two sets of results saved by run"
+    )
+    compare_parser.add_argument("baseline", help="Results to compare against")
+    compare_parser.add_argument("results", help="Results to compare")
+    compare_parser.set_defaults(function=compare)
+
+    memory_parser = subparsers.add_parser(
+        "memory", help="Measure the memory used to catalog each file"
+    )
+    memory_parser.add_argument(
+        "--files",
+        type=int,
+        default=100000,
+        help="Number of files to generate when no path is given (default 100000)",
+    )
+    memory_parser.add_argument(
+        "path", nargs="?", help="An existing tree to catalog instead"
+    )
+    memory_parser.set_defaults(function=memory)
+
+    a = parser.parse_args()
+    if a.benchmark is None:
+        parser.print_help()
+        return 1
+
+    return a.function(a)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,45 @@
 import abc
+import array
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import cProfile
+import ctypes
+import ctypes.util
+import errno
+import functools
 import hashlib
+import heapq
 import itertools
+import json
 import logging
 import operator
 import os
+import pickle
 import re
+import select
+import shutil
+import sqlite3
+import stat
+import struct
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
 
 
 def join_paths_componentwise(path1, path2):
@@ -17,6 +51,11 @@ def join_paths_componentwise(path1, path2):
 
 
 class DuplicateResolver(metaclass=abc.ABCMeta):
+    # Whether many groups may be resolved at once by resolve_many(), holding back
+    # their duplicates until all of them are resolved. Resolvers that ask the
+    # user, or that may fail part way through, resolve one group at a time.
+    batched = False
+
     def __init__(self, reverse=False):
         self.reverse = reverse
 
@@ -24,31 +63,106 @@ class DuplicateResolver(metaclass=abc.ABCMeta):
     def resolve(self, flist):
         pass
 
+    def resolve_many(self, groups):
+        """Resolve each of the lists of entries in groups as resolve() would,
+        returning a list of (originals, duplicates) pairs."""
+        return [self.resolve(g) for g in groups]
+
 
 class SortBasedDuplicateResolver(DuplicateResolver):
     """Resolver based on sorting on some attribute pulled from each entry
-    by a rank_function."""
+    by a rank_function.
+
+    Subclasses whose rank is kept by ColumnarFileCatalog name the column in
+    column, allowing many groups to be resolved at once by resolve_columnar()."""
+
+    batched = True
+    column = None
 
     def __init__(self, rank_function, reverse=False):
         self.rank_function = rank_function
         super(SortBasedDuplicateResolver, self).__init__(reverse)
 
-    def resolve(self, flist):
-        if len(flist) > 1:
-            q = sorted(flist, key=self.rank_function, reverse=self.reverse)
-
-            pivot = None
-            rank = self.rank_function(q[0])
-            for i in range(1, len(q)):
-                if self.rank_function(q[i]) != rank:
-                    # Found the point where the sorting is meaningful
-                    pivot = i
-                    break
+    def resolve_columnar(self, groups, catalog):
+        """Resolve each of groups, whose entries are held in catalog, as resolve()
+        would, comparing ranks from the catalog's column with vectorized
+        operations. Return a list of (originals, duplicates) pairs."""
+        if type(self).resolve is not SortBasedDuplicateResolver.resolve:
+            return self.resolve_many(groups)
+        if not groups:
+            return []
+
+        entries = [entry for g in groups for entry in g]
+        rows = numpy.fromiter(
+            (catalog.rows[id(entry)] for entry in entries),
+            dtype=numpy.intp,
+            count=len(entries),
+        )
+        keys = catalog.get_column(self.column)[rows]
+        lengths = numpy.fromiter(map(len, groups), dtype=numpy.intp, count=len(groups))
+        starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+        labels = numpy.repeat(numpy.arange(len(groups)), lengths)
+
+        # The leaders of each group are the entries sharing its best rank; the
+        # rest follow in (stable) rank order, as with sorted().
+        best = (numpy.maximum if self.reverse else numpy.minimum).reduceat(keys, starts)
+        leaders = (keys == best[labels]).tolist()
+        order = numpy.lexsort((-keys if self.reverse else keys, labels)).tolist()
+
+        results = []
+        for (start, length) in zip(starts.tolist(), lengths.tolist()):
+            end = start + length
+            results.append(
+                (
+                    [entries[i] for i in range(start, end) if leaders[i]],
+                    [entries[i] for i in order[start:end] if not leaders[i]],
+                )
+            )
 
-            if pivot is not None:
-                return q[:pivot], q[pivot:]
+        return results
+
+    def get_keys(self, entries):
+        """Return the rank of each of entries."""
+        return list(map(self.rank_function, entries))
+
+    def resolve_many(self, groups):
+        """Resolve each of groups, ranking every entry once. The originals of
+        each group are the entries sharing its best rank, found without sorting;
+        the remaining entries follow in (stable) rank order, as with sorted()."""
+        if type(self).resolve is not SortBasedDuplicateResolver.resolve:
+            # A subclass that overrides resolve() alone must still be consulted.
+            return [self.resolve(g) for g in groups]
+
+        keys = self.get_keys([entry for g in groups for entry in g])
+        best_of = max if self.reverse else min
+        results = []
+        start = 0
+
+        for g in groups:
+            group_keys = keys[start : start + len(g)]
+            start += len(g)
+            if len(g) < 2:
+                results.append((g, []))
+                continue
+
+            best = best_of(group_keys)
+            rest = [i for (i, key) in enumerate(group_keys) if key != best]
+            if not rest:
+                results.append((g, []))
+                continue
+
+            rest.sort(key=group_keys.__getitem__, reverse=self.reverse)
+            results.append(
+                (
+                    [entry for (entry, key) in zip(g, group_keys) if key == best],
+                    [g[i] for i in rest],
+                )
+            )
 
-        return flist, []
+        return results
+
+    def resolve(self, flist):
+        return self.resolve_many([flist])[0]
 
 
 class AttrBasedDuplicateResolver(SortBasedDuplicateResolver):
@@ -62,17 +176,32 @@ class PathLengthDuplicateResolver(SortBasedDuplicateResolver):
     """Resolve based on the shortest path length (by component count)
     excluding the source path."""
 
+    column = "depth"
+
     def __init__(self, reverse=False):
         super().__init__(
-            lambda x: len(x.path.split(os.path.sep))
-            - len(x.source.path.split(os.path.sep)),
+            lambda x: x.path.count(os.path.sep) - x.source.path.count(os.path.sep),
             reverse,
         )
 
+    def get_keys(self, entries):
+        # Each source's own depth is counted only once.
+        source_depths = {}
+        keys = []
+        for entry in entries:
+            source = id(entry.source)
+            if source not in source_depths:
+                source_depths[source] = entry.source.path.count(os.path.sep)
+            keys.append(entry.path.count(os.path.sep) - source_depths[source])
+
+        return keys
+
 
 class SourceOrderDuplicateResolver(AttrBasedDuplicateResolver):
     """Resolve based on the order of the sources specified on the command line."""
 
+    column = "order"
+
     def __init__(self, reverse=False):
         super().__init__("source.order", reverse)
 
@@ -80,15 +209,18 @@ class SourceOrderDuplicateResolver(AttrBasedDuplicateResolver):
 class ModificationDateDuplicateResolver(AttrBasedDuplicateResolver):
     """Resolve based on file modification date."""
 
+    column = "mtime"
+
     def __init__(self, reverse=False):
         super(ModificationDateDuplicateResolver, self).__init__(
-            "stat.st_mtime", reverse
+            "stat.st_mtime_ns", reverse
         )
 
 
 class CopyPatternDuplicateResolver(DuplicateResolver):
     """Resolve by removing files whose names match common "copy" patterns."""
 
+    batched = True
     copy_patterns = [
         re.compile("^Copy of"),
         re.compile(".* copy [0-9]+\\.[a-zA-Z0-9]{3}$"),
@@ -96,15 +228,16 @@ class CopyPatternDuplicateResolver(DuplicateResolver):
         re.compile(".*\\([0-9]\\)\\.[a-zA-Z0-9]{3}$"),
     ]
 
+    def __init__(self, reverse=False):
+        super().__init__(reverse)
+        self.matcher = CompiledMatcher(patterns=self.copy_patterns)
+
     def resolve(self, flist):
         originals = []
         duplicates = []
 
         for f in flist:
-            if True in [
-                re.match(pattern, os.path.basename(f.path)) is not None
-                for pattern in self.copy_patterns
-            ]:
+            if self.matcher.match(os.path.basename(f.path)):
                 duplicates.append(f)
             else:
                 originals.append(f)
@@ -115,6 +248,8 @@ class CopyPatternDuplicateResolver(DuplicateResolver):
 class FilenameSortDuplicateResolver(DuplicateResolver):
     """Force resolution by choosing the single first sorted file"""
 
+    batched = True
+
     def resolve(self, flist):
         sorted_list = sorted(flist, key=lambda entry: os.path.basename(entry.path))
 
@@ -125,6 +260,10 @@ class UserCanceledException(Exception):
     pass
 
 
+class OperationStopped(Exception):
+    """Raised by an operation asked to stop part way through its work."""
+
+
 class InteractiveDuplicateResolver(DuplicateResolver):
     """Allow the user to interactively resolve duplicate files."""
 
@@ -149,48 +288,282 @@ class InteractiveDuplicateResolver(DuplicateResolver):
 
 
 class DuplicateFileSink(metaclass=abc.ABCMeta):
+    # The number of files that could not be sunk.
+    failures = 0
+
     @abc.abstractmethod
     def sink(self, files):
         pass
 
 
-class DeleteDuplicateFileSink(DuplicateFileSink):
-    """Immediately delete duplicate files."""
+# Whether files can be opened, stat()ed, unlinked and renamed relative to a
+# directory file descriptor.
+SUPPORTS_DIR_FD = hasattr(os, "fwalk") and (
+    {os.open, os.stat, os.unlink, os.rename} <= os.supports_dir_fd
+)
+
+
+class FileOperationSink(DuplicateFileSink):
+    """A sink that applies sink_file() to each duplicate file in turn, logging and
+    counting the files for which it fails.
+
+    Files are processed in order of their directories, keeping operations on
+    each directory together, by up to jobs worker threads. Each task covers at
+    most chunk_size files in a single directory. Where supported, sink_file() is
+    passed a descriptor for that directory, so that files can be found without
+    resolving their full paths, and the task keeps working on the same
+    directory even if it is moved."""
+
+    failure_message = "Unable to sink duplicate file %s: %s"
+    # Whether sink_file() makes use of directory descriptors.
+    uses_dir_fd = True
+
+    def __init__(self, jobs=1, chunk_size=64):
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+
+    @abc.abstractmethod
+    def sink_file(self, entry, dir_fd=None):
+        """Sink entry. If dir_fd is given, it is a descriptor for the directory
+        containing entry."""
+        pass
+
+    def open_directory(self, directory):
+        if not (self.uses_dir_fd and SUPPORTS_DIR_FD and directory):
+            return None
+
+        try:
+            return os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        except OSError:
+            # Fall back to full paths, so that errors are reported per file.
+            return None
+
+    def get_tasks(self, files):
+        # sorted() is stable, so files keep their order within each directory.
+        files = sorted(files, key=lambda entry: os.path.dirname(entry.path))
+        for (directory, group) in itertools.groupby(
+            files, key=lambda entry: os.path.dirname(entry.path)
+        ):
+            group = list(group)
+            for i in range(0, len(group), self.chunk_size):
+                yield group[i : i + self.chunk_size]
+
+    def run_task(self, task):
+        dir_fd = self.open_directory(os.path.dirname(task[0].path))
+        try:
+            for entry in task:
+                try:
+                    self.sink_file(entry, dir_fd)
+                except Exception as e:
+                    logging.getLogger(__name__).error(
+                        self.failure_message, entry.path, e
+                    )
+                    with self.lock:
+                        self.failures += 1
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
 
     def sink(self, files):
-        logger = logging.getLogger(__name__)
-        for entry in files:
-            try:
-                logger.debug("Deleting duplicate file %s", entry.path)
-                os.unlink(entry.path)
-            except Exception as e:
-                logger.error("Unable to delete duplicate file %s: %s", entry.path, e)
+        if self.jobs <= 1:
+            for task in self.get_tasks(files):
+                self.run_task(task)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            # Bound the number of tasks queued at once.
+            pending = collections.deque()
+            for task in self.get_tasks(files):
+                pending.append(executor.submit(self.run_task, task))
+                if len(pending) >= self.jobs * 4:
+                    pending.popleft().result()
+
+            while pending:
+                pending.popleft().result()
+
+
+class DeleteDuplicateFileSink(FileOperationSink):
+    """Immediately delete duplicate files."""
+
+    failure_message = "Unable to delete duplicate file %s: %s"
+
+    def sink_file(self, entry, dir_fd=None):
+        logging.getLogger(__name__).debug("Deleting duplicate file %s", entry.path)
+        if dir_fd is None:
+            os.unlink(entry.path)
+            return
 
+        try:
+            os.unlink(os.path.basename(entry.path), dir_fd=dir_fd)
+        except OSError as e:
+            # Report the full path, as os.unlink(entry.path) would.
+            e.filename = entry.path
+            raise
 
-class SequesterDuplicateFileSink(DuplicateFileSink):
+
+class SequesterDuplicateFileSink(FileOperationSink):
     """Move duplicate files into a separate directory tree."""
 
-    def __init__(self, path=None):
+    failure_message = "Unable to sequester duplicate file %s: %s"
+
+    def __init__(self, path=None, jobs=1):
+        super(SequesterDuplicateFileSink, self).__init__(jobs)
         self.sequester_path = path
+        # Directories known to exist in the sequester tree.
+        self.directories = set()
 
     def construct_sequestered_path(self, file_path):
         return join_paths_componentwise(self.sequester_path, file_path)
 
-    def sink(self, files):
-        logger = logging.getLogger(__name__)
-        for entry in files:
+    def make_directory(self, directory):
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+
+    def rename(self, entry, new_path, dir_fd):
+        if dir_fd is None:
+            os.rename(entry.path, new_path)
+            return
+
+        try:
+            os.rename(os.path.basename(entry.path), new_path, src_dir_fd=dir_fd)
+        except OSError as e:
+            # Report the full paths, as os.rename(entry.path, new_path) would.
+            (e.filename, e.filename2) = (entry.path, new_path)
+            raise
+
+    def sink_file(self, entry, dir_fd=None):
+        logging.getLogger(__name__).debug("Sequestering duplicate file %s", entry.path)
+        # We don't use os.renames because it has the bizarre side effect
+        # of pruning directories containing the original file, if empty.
+
+        new_path = self.construct_sequestered_path(entry.path)
+        directory = os.path.dirname(new_path)
+        self.make_directory(directory)
+        try:
+            self.rename(entry, new_path, dir_fd)
+        except FileNotFoundError:
+            if not os.path.exists(entry.path):
+                raise
+
+            # The directory was removed since we created it.
+            self.directories.discard(directory)
+            self.make_directory(directory)
+            self.rename(entry, new_path, dir_fd)
+
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class LinkDuplicateFileSink(FileOperationSink):
+    """Replace duplicate files with links to their originals, reclaiming their
+    space while leaving their paths in place.
+
+    In "reflink" mode, duplicates become copy-on-write clones of the original
+    (on filesystems that support them, such as btrfs and XFS); in "hardlink"
+    mode, they become hard links to it. "auto" mode tries a reflink and falls
+    back to a hard link. Each duplicate is replaced atomically, by creating
+    the link under a temporary name and renaming it over the duplicate."""
+
+    modes = ["auto", "reflink", "hardlink"]
+
+    # Errors indicating that the filesystem can't clone these files.
+    reflink_unsupported = {
+        errno.EBADF,
+        errno.EINVAL,
+        errno.ENOSYS,
+        errno.ENOTTY,
+        errno.EOPNOTSUPP,
+        errno.EXDEV,
+    }
+
+    failure_message = "Unable to link duplicate file %s: %s"
+    uses_dir_fd = False
+
+    def __init__(self, mode="auto", jobs=1):
+        if mode not in self.modes:
+            raise ValueError("Unknown link mode {}".format(mode))
+
+        super(LinkDuplicateFileSink, self).__init__(jobs)
+        self.mode = mode
+
+    def construct_temporary_path(self, file_path, attempt):
+        (head, tail) = os.path.split(file_path)
+        return os.path.join(head, ".{}.dedupe-{}-{}".format(tail, os.getpid(), attempt))
+
+    def create_temporary(self, file_path, create):
+        # Call create with a new temporary path alongside file_path, retrying
+        # if the path is in use.
+        for attempt in itertools.count():
+            temporary_path = self.construct_temporary_path(file_path, attempt)
             try:
-                logger.debug("Sequestering duplicate file %s", entry.path)
-                # We don't use os.renames because it has the bizarre side effect
-                # of pruning directories containing the original file, if empty.
+                create(temporary_path)
+                return temporary_path
+            except FileExistsError:
+                continue
 
-                new_path = self.construct_sequestered_path(entry.path)
+    def reflink(self, original_path, temporary_path):
+        if fcntl is None:
+            raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported")
 
-                if not os.path.exists(os.path.dirname(new_path)):
-                    os.makedirs(os.path.dirname(new_path))
-                os.rename(entry.path, new_path)
-            except Exception as e:
-                logger.error("Unable to sequester duplicate file %s: %s", entry.path, e)
+        with open(original_path, mode="rb") as original:
+            fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                fcntl.ioctl(fd, FICLONE, original.fileno())
+            except OSError:
+                os.unlink(temporary_path)
+                raise
+            finally:
+                os.close(fd)
+
+    def link(self, original_path, file_path):
+        temporary_path = None
+
+        if self.mode != "hardlink":
+            try:
+                temporary_path = self.create_temporary(
+                    file_path, lambda path: self.reflink(original_path, path)
+                )
+
+                # The clone is a new file; keep the duplicate's metadata.
+                st = os.stat(file_path)
+                shutil.copystat(file_path, temporary_path)
+                try:
+                    os.chown(temporary_path, st.st_uid, st.st_gid)
+                except OSError:
+                    pass
+            except OSError as e:
+                if temporary_path is not None:
+                    os.unlink(temporary_path)
+                    temporary_path = None
+
+                if self.mode == "reflink" or e.errno not in self.reflink_unsupported:
+                    raise
+
+        if temporary_path is None:
+            temporary_path = self.create_temporary(
+                file_path, lambda path: os.link(original_path, path)
+            )
+
+        try:
+            os.replace(temporary_path, file_path)
+        except OSError:
+            os.unlink(temporary_path)
+            raise
+
+    def sink_file(self, entry, dir_fd=None):
+        logger = logging.getLogger(__name__)
+        if entry.original is None:
+            raise ValueError("no original file was identified")
+
+        if os.path.samefile(entry.original.path, entry.path):
+            logger.debug("Duplicate file %s is already linked", entry.path)
+            return
+
+        logger.debug("Linking duplicate file %s to %s", entry.path, entry.original.path)
+        self.link(entry.original.path, entry.path)
 
 
 class OutputOnlyDuplicateFileSink(DuplicateFileSink):
@@ -204,32 +577,305 @@ class OutputOnlyDuplicateFileSink(DuplicateFileSink):
             self.output_file.write(entry.path + "\n")
 
 
-class FileEntry:
-    def __init__(self, fpath, fsource):
-        self.path = fpath
-        self.source = fsource
-        self.stat = os.stat(fpath)
-        self.digest = None
+class ZlibChecksum:
+    """hashlib-style wrapper around zlib's crc32 and adler32 checksums."""
+
+    def __init__(self, function, initial):
+        self.function = function
+        self.value = initial
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self):
+        return "{:08x}".format(self.value & 0xFFFFFFFF)
+
+
+HashAlgorithm = collections.namedtuple(
+    "HashAlgorithm", ["name", "factory", "cryptographic"]
+)
+
+# Digests from non-cryptographic algorithms must be confirmed by comparing
+# the files' contents.
+hash_algorithms = {
+    "sha512": HashAlgorithm("sha512", hashlib.sha512, True),
+    "sha256": HashAlgorithm("sha256", hashlib.sha256, True),
+    "sha1": HashAlgorithm("sha1", hashlib.sha1, True),
+    "md5": HashAlgorithm("md5", hashlib.md5, True),
+    "blake2b": HashAlgorithm("blake2b", hashlib.blake2b, True),
+    "crc32": HashAlgorithm("crc32", lambda: ZlibChecksum(zlib.crc32, 0), False),
+    "adler32": HashAlgorithm("adler32", lambda: ZlibChecksum(zlib.adler32, 1), False),
+}
+
+DEFAULT_HASH_ALGORITHM = hash_algorithms["sha512"]
+
+
+def select_fastest_hash_algorithm(candidates=None, sample_size=1 << 22):
+    """Time each candidate algorithm on sample_size bytes and return the fastest.
+    By default, only cryptographic algorithms are considered, since the others
+    require every duplicate to be read a second time for confirmation."""
+    if candidates is None:
+        candidates = [a for a in hash_algorithms.values() if a.cryptographic]
+
+    data = os.urandom(sample_size)
+    timings = []
+    for algorithm in candidates:
+        try:
+            d = algorithm.factory()
+        except ValueError:
+            # Some algorithms are disabled, e.g. md5 on FIPS systems.
+            continue
+
+        start = time.perf_counter()
+        for i in range(0, sample_size, 1 << 16):
+            d.update(data[i : i + (1 << 16)])
+        d.hexdigest()
+        timings.append((time.perf_counter() - start, algorithm.name))
+
+    logging.getLogger(__name__).debug(
+        "Hash algorithm timings:\n%s",
+        "\n".join("{}: {:.6f}s".format(name, t) for (t, name) in sorted(timings)),
+    )
+
+    return hash_algorithms[min(timings)[1]]
+
+
+def get_hash_algorithm(name):
+    if name == "auto":
+        return select_fastest_hash_algorithm()
+
+    return hash_algorithms[name]
+
+
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+
+class BlockReader:
+    """Read files in fixed-size blocks, using readinto() on a buffer that is
+    reused for every file read by the same thread. Blocks are memoryviews over
+    that buffer, and are only valid until the next block is read."""
+
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+        self.local = threading.local()
+
+    def get_block_size(self, entry):
+        return self.block_size
+
+    def get_buffer(self, size):
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+        if size not in buffers:
+            buffers[size] = bytearray(size)
+
+        return buffers[size]
+
+    def read_file(self, path, block_size):
+        buf = self.get_buffer(block_size)
+        view = memoryview(buf)
+        # Unbuffered, so that readinto() reads directly into our buffer.
+        with open(path, mode="rb", buffering=0) as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+
+                yield view[:n]
+
+    def read_blocks(self, entry):
+        return self.read_file(entry.path, self.get_block_size(entry))
+
+
+class AutoTuningBlockReader(BlockReader):
+    """Choose a block size for each device by measurement. Candidate sizes start
+    at the device's preferred I/O size (st_blksize), or 64 KiB if larger; each is
+    used for `trials` files of at least min_trial_bytes, after which the size
+    with the best throughput is used for the rest of the run."""
+
+    def __init__(self, candidates=None, trials=3, min_trial_bytes=1 << 22):
+        super().__init__()
+        self.candidates = candidates
+        self.trials = trials
+        self.min_trial_bytes = min_trial_bytes
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def get_candidates(self, entry):
+        if self.candidates is not None:
+            return self.candidates
+
+        base = max(getattr(entry.stat, "st_blksize", 0), 1 << 16)
+        return [base << (2 * i) for i in range(4)]
+
+    def get_device(self, entry):
+        device = self.devices.get(entry.stat.st_dev)
+        if device is None:
+            device = {
+                "chosen": None,
+                "measurements": {c: [0, 0.0, 0] for c in self.get_candidates(entry)},
+            }
+            self.devices[entry.stat.st_dev] = device
+
+        return device
+
+    def get_block_size(self, entry):
+        with self.lock:
+            device = self.get_device(entry)
+            if device["chosen"] is not None:
+                return device["chosen"]
+
+            # Try the least-measured candidate next.
+            return min(
+                device["measurements"].items(), key=lambda item: (item[1][2], item[0])
+            )[0]
+
+    def record(self, entry, block_size, nbytes, seconds):
+        with self.lock:
+            device = self.get_device(entry)
+            if device["chosen"] is not None or seconds <= 0:
+                return
+
+            measurement = device["measurements"][block_size]
+            measurement[0] += nbytes
+            measurement[1] += seconds
+            measurement[2] += 1
+
+            if all(m[2] >= self.trials for m in device["measurements"].values()):
+                device["chosen"] = max(
+                    device["measurements"].items(),
+                    key=lambda item: item[1][0] / item[1][1],
+                )[0]
+                logging.getLogger(__name__).info(
+                    "Selected block size %d for device %d.",
+                    device["chosen"],
+                    entry.stat.st_dev,
+                )
+
+    def read_blocks(self, entry):
+        block_size = self.get_block_size(entry)
+        nbytes = 0
+        start = time.perf_counter()
+
+        for block in self.read_file(entry.path, block_size):
+            nbytes += len(block)
+            yield block
+
+        if nbytes >= self.min_trial_bytes:
+            self.record(entry, block_size, nbytes, time.perf_counter() - start)
+
+
+DEFAULT_BLOCK_READER = BlockReader()
+
+
+class ContentSampler:
+    """Digest a fixed-size sample of a file's content: its head, and optionally
+    its tail and a number of evenly-spaced blocks from its middle.
+
+    Sample digests are only comparable between files of the same size."""
+
+    def __init__(self, sample_size=4096, tail=False, middle_blocks=0, algorithm=None):
+        self.sample_size = sample_size
+        self.tail = tail
+        self.middle_blocks = middle_blocks
+        self.algorithm = algorithm or DEFAULT_HASH_ALGORITHM
+
+    def __repr__(self):
+        return "ContentSampler({}, tail={}, middle_blocks={}, algorithm={})".format(
+            self.sample_size, self.tail, self.middle_blocks, self.algorithm.name
+        )
+
+    @property
+    def key(self):
+        # Identifies the sampling configuration, so that sample digests taken
+        # with different configurations are never confused.
+        return "sample:{}:{}:{}:{}".format(
+            self.sample_size, int(self.tail), self.middle_blocks, self.algorithm.name
+        )
+
+    def covers(self, size):
+        return size <= self.sample_size
+
+    def get_regions(self, size):
+        """Return a sorted list of non-overlapping (offset, length) regions
+        to be sampled from a file of the given size."""
+        n = self.sample_size
+        offsets = [0]
+        for i in range(1, self.middle_blocks + 1):
+            offsets.append(max(0, (size * i) // (self.middle_blocks + 1) - n // 2))
+        if self.tail:
+            offsets.append(max(0, size - n))
+
+        regions = []
+        end = 0
+        for offset in sorted(offsets):
+            start = max(offset, end)
+            stop = min(offset + n, size)
+            if stop > start:
+                if regions and start == end:
+                    regions[-1] = (regions[-1][0], stop - regions[-1][0])
+                else:
+                    regions.append((start, stop - start))
+                end = stop
+
+        return regions
+
+    def run_digest(self, path, size):
+        d = self.algorithm.factory()
+        with open(path, mode="rb") as f:
+            for (offset, length) in self.get_regions(size):
+                f.seek(offset)
+                d.update(f.read(length))
+
+        return d.hexdigest()
+
+
+class BaseFileEntry:
+    """Behavior shared by FileEntry and CompactFileEntry. Subclasses provide path,
+    source, stat, digest, partial_digests, and original attributes."""
+
+    __slots__ = ()
 
     def get_size(self):
         return self.stat.st_size
 
-    def get_digest(self):
+    def get_inode(self):
+        """Return a (device, inode) pair identifying the file's data, shared by
+        all hard links to it, or None where the filesystem provides no inodes."""
+        if self.stat.st_ino == 0:
+            return None
+
+        return (self.stat.st_dev, self.stat.st_ino)
+
+    def get_digest(self, algorithm=None, reader=None):
         if self.digest is None:
-            self.run_digest()
+            self.run_digest(algorithm, reader)
 
         return self.digest
 
-    def run_digest(self):
-        with open(self.path, mode="rb") as f:
-            d = hashlib.sha512()
+    def get_partial_digest(self, sampler):
+        if sampler.covers(self.get_size()):
+            # The sample would read the entire file anyway; the full digest
+            # costs no more and need not be computed again later.
+            return self.get_digest(sampler.algorithm)
 
-            while True:
-                buf = f.read(4096)
-                if not buf:
-                    break
+        if sampler.key not in self.partial_digests:
+            self.partial_digests[sampler.key] = sampler.run_digest(
+                self.path, self.get_size()
+            )
+            logging.getLogger(__name__).debug(
+                "Found sample digest %s for path %s.",
+                self.partial_digests[sampler.key],
+                self.path,
+            )
+
+        return self.partial_digests[sampler.key]
+
+    def run_digest(self, algorithm=None, reader=None):
+        d = (algorithm or DEFAULT_HASH_ALGORITHM).factory()
 
-                d.update(buf)
+        for block in (reader or DEFAULT_BLOCK_READER).read_blocks(self):
+            d.update(block)
 
         self.digest = d.hexdigest()
         logging.getLogger(__name__).debug(
@@ -237,16 +883,722 @@ class FileEntry:
         )
 
 
+class FileEntry(BaseFileEntry):
+    def __init__(self, fpath, fsource, fstat=None):
+        self.path = fpath
+        self.source = fsource
+        self.stat = fstat if fstat is not None else os.stat(fpath)
+        self.digest = None
+        self.partial_digests = {}
+        self.original = None
+
+
+class DirectoryTable:
+    """Intern directory paths, assigning each distinct path a small integer id."""
+
+    def __init__(self):
+        self.ids = {}
+        self.paths = []
+
+    def intern(self, path):
+        directory = self.ids.get(path)
+        if directory is None:
+            directory = len(self.paths)
+            self.ids[path] = directory
+            self.paths.append(path)
+
+        return directory
+
+    def __getitem__(self, directory):
+        return self.paths[directory]
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class CompactFileEntry(BaseFileEntry):
+    """A FileEntry using a fraction of the memory, for very large catalogs.
+
+    Only the stat fields that resolvers, readers, and caches use are kept, and
+    the entry serves as its own stat result. The path is stored as the id of
+    its parent directory in the source's DirectoryTable and a basename, and is
+    rebuilt on access."""
+
+    __slots__ = (
+        "source",
+        "directory",
+        "name",
+        "st_dev",
+        "st_ino",
+        "st_size",
+        "st_mtime_ns",
+        "st_blksize",
+        "digest",
+        "_partial_digests",
+        "original",
+    )
+
+    def __init__(self, fpath, fsource, fstat=None, directory=None, name=None):
+        if fstat is None:
+            fstat = os.stat(fpath)
+        if directory is None:
+            (head, name) = os.path.split(fpath)
+            directory = fsource.directories.intern(head)
+
+        self.source = fsource
+        self.directory = directory
+        self.name = name
+        self.st_dev = fstat.st_dev
+        self.st_ino = fstat.st_ino
+        self.st_size = fstat.st_size
+        self.st_mtime_ns = fstat.st_mtime_ns
+        self.st_blksize = getattr(fstat, "st_blksize", 0)
+        self.digest = None
+        self._partial_digests = None
+        self.original = None
+
+    @property
+    def path(self):
+        return os.path.join(self.source.directories[self.directory], self.name)
+
+    @property
+    def stat(self):
+        return self
+
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 1e9
+
+    @property
+    def partial_digests(self):
+        # Most entries are never sampled; allocate the dict only when needed.
+        if self._partial_digests is None:
+            self._partial_digests = {}
+
+        return self._partial_digests
+
+    @partial_digests.setter
+    def partial_digests(self, value):
+        self._partial_digests = value
+
+
+class BlockComparator:
+    """Confirm duplicates by reading the members of a group of same-size files
+    in lockstep, chunk by chunk, and splitting the group wherever their contents
+    diverge. A file is no longer read once it is known to be unique.
+
+    Chunks grow from initial_chunk_size to max_chunk_size. At most max_open_files
+    files are held open at once; others are reopened as needed."""
+
+    def __init__(
+        self, initial_chunk_size=4096, max_chunk_size=1 << 20, max_open_files=64
+    ):
+        self.initial_chunk_size = initial_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_open_files = max_open_files
+
+    def get_groups(self, flist, stats=None, progress=None):
+        """Return the groups of identical files among flist, which must all have
+        the same size. Groups are ordered by their first member's position. The
+        bytes read are counted in stats and progress, if given."""
+        size = flist[0].get_size()
+        position = {id(entry): i for (i, entry) in enumerate(flist)}
+        handles = collections.OrderedDict()
+
+        active = [list(flist)]
+        offset = 0
+        chunk_size = self.initial_chunk_size
+
+        try:
+            while offset < size and active:
+                next_active = []
+                for group in active:
+                    buckets = collections.OrderedDict()
+                    for entry in group:
+                        chunk = self.read_chunk(handles, entry, offset, chunk_size)
+                        if stats is not None:
+                            stats.increment("bytes_compared", len(chunk))
+                        if progress is not None:
+                            progress.advance(len(chunk), 0)
+                        buckets.setdefault(chunk, []).append(entry)
+
+                    for members in buckets.values():
+                        if len(members) > 1:
+                            next_active.append(members)
+                        else:
+                            self.close_file(handles, members[0])
+
+                active = next_active
+                offset += chunk_size
+                chunk_size = min(chunk_size * 2, self.max_chunk_size)
+        finally:
+            for f in handles.values():
+                f.close()
+
+        return sorted(active, key=lambda group: position[id(group[0])])
+
+    def read_chunk(self, handles, entry, offset, length):
+        f = handles.pop(id(entry), None)
+        if f is None:
+            if len(handles) >= self.max_open_files:
+                handles.popitem(last=False)[1].close()
+
+            f = open(entry.path, mode="rb")
+            f.seek(offset)
+
+        # Most recently used files are kept at the end.
+        handles[id(entry)] = f
+        return f.read(length)
+
+    def close_file(self, handles, entry):
+        f = handles.pop(id(entry), None)
+        if f is not None:
+            f.close()
+
+
+class DigestCache:
+    """Persistent store of full and sample digests in a SQLite database.
+
+    Digests are keyed by each file's device and inode, and are only returned
+    while the file's size and modification time are unchanged. Files without
+    inodes are never cached. The database may be shared by concurrent runs."""
+
+    def __init__(self, path, batch_size=512):
+        self.path = path
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self.pending = []
+        self.lock = threading.Lock()
+
+        # Writes are batched into explicit transactions; WAL mode allows other
+        # processes to read while we write, and the timeout makes concurrent
+        # writers wait for each other rather than fail.
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "dev INTEGER NOT NULL, ino INTEGER NOT NULL, kind TEXT NOT NULL, "
+            "size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "path TEXT NOT NULL, digest TEXT NOT NULL, "
+            "PRIMARY KEY (dev, ino, kind))"
+        )
+
+    def lookup(self, entry, kind):
+        if entry.get_inode() is None:
+            # Without an inode, the file cannot be told apart from others.
+            return None
+
+        st = entry.stat
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, digest FROM digests "
+                "WHERE dev = ? AND ino = ? AND kind = ?",
+                (st.st_dev, st.st_ino, kind),
+            ).fetchone()
+
+            if row is not None and row[:2] == (st.st_size, st.st_mtime_ns):
+                self.hits += 1
+                return row[2]
+
+            self.misses += 1
+            return None
+
+    def store(self, entry, kind, digest):
+        if entry.get_inode() is None:
+            return
+
+        st = entry.stat
+        with self.lock:
+            self.pending.append(
+                (
+                    st.st_dev,
+                    st.st_ino,
+                    kind,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    entry.path,
+                    digest,
+                )
+            )
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self.pending,
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.pending = []
+
+    def get_digest(self, entry, algorithm=None, reader=None):
+        algorithm = algorithm or DEFAULT_HASH_ALGORITHM
+        if entry.digest is None:
+            entry.digest = self.lookup(entry, algorithm.name)
+            if entry.digest is None:
+                entry.run_digest(algorithm, reader)
+                self.store(entry, algorithm.name, entry.digest)
+
+        return entry.digest
+
+    def get_partial_digest(self, entry, sampler):
+        if sampler.covers(entry.get_size()):
+            return self.get_digest(entry, sampler.algorithm)
+
+        if sampler.key not in entry.partial_digests:
+            digest = self.lookup(entry, sampler.key)
+            if digest is None:
+                self.store(entry, sampler.key, entry.get_partial_digest(sampler))
+            else:
+                entry.partial_digests[sampler.key] = digest
+
+        return entry.partial_digests[sampler.key]
+
+    def prune(self):
+        """Remove entries for files that no longer exist or have changed.
+        Returns the number of entries removed."""
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT dev, ino, kind, size, mtime_ns, path FROM digests"
+            ).fetchall()
+
+            stale = []
+            for (dev, ino, kind, size, mtime_ns, path) in rows:
+                try:
+                    st = os.stat(path)
+                    current = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+                    if current == (dev, ino, size, mtime_ns):
+                        continue
+                except OSError:
+                    pass
+
+                stale.append((dev, ino, kind))
+
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "DELETE FROM digests WHERE dev = ? AND ino = ? AND kind = ?", stale
+            )
+            self.connection.execute("COMMIT")
+
+        return len(stale)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class ScanManifest:
+    """The state of a scan: each file found, with its stat identity and any full
+    and sample digests computed, and the duplicate groups confirmed.
+
+    A manifest loaded from a previous scan is used to seed the digests of files
+    whose device, inode, size and modification time are unchanged, so that only
+    new and changed files are read, and to report the duplicate groups added
+    and dissolved since that scan. Manifests are stored as JSON lines.
+
+    A manifest naming the node (host) it was scanned on also records its sources,
+    so that the manifests of several nodes can be combined by a
+    MergedDeduplicateOperation."""
+
+    VERSION = 1
+
+    def __init__(self, algorithm=None, node=None):
+        self.algorithm = algorithm or DEFAULT_HASH_ALGORITHM
+        self.node = node
+        self.sources = {}
+        self.previous = {}
+        self.previous_groups = set()
+        self.files = {}
+        self.groups = []
+        self.catalog = None
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+
+    @classmethod
+    def load(cls, path, algorithm=None, node=None):
+        """Return a manifest whose previous scan is read from path, which need not
+        exist."""
+        manifest = cls(algorithm, node)
+
+        try:
+            f = open(path, "r")
+        except FileNotFoundError:
+            return manifest
+
+        with f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("version") != cls.VERSION:
+                logging.getLogger(__name__).warning(
+                    "Ignoring manifest %s with unknown version.", path
+                )
+                return manifest
+
+            # Full digests can only be reused if they used the same algorithm.
+            same_algorithm = header.get("algorithm") == manifest.algorithm.name
+            for line in f:
+                record = json.loads(line)
+                if "group" in record:
+                    manifest.previous_groups.add(frozenset(record["group"]))
+                else:
+                    if not same_algorithm:
+                        record["digest"] = None
+                    manifest.previous[record["path"]] = record
+
+        return manifest
+
+    def save(self, path):
+        # Write to a temporary file first, so that an interrupted save leaves the
+        # previous manifest intact.
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        header = {"version": self.VERSION, "algorithm": self.algorithm.name}
+        if self.node is not None:
+            header["node"] = self.node
+            header["sources"] = [
+                {"order": order, "path": source_path}
+                for (order, source_path) in sorted(self.sources.items())
+            ]
+
+        with open(temporary_path, "w") as f:
+            f.write(json.dumps(header) + "\n")
+            for record in self.files.values():
+                f.write(json.dumps(record) + "\n")
+            for group in self.groups:
+                f.write(json.dumps({"group": group}) + "\n")
+
+        os.replace(temporary_path, path)
+
+    def add_entry(self, entry):
+        """Record entry, seed its digests from the previous scan if it is
+        unchanged, and pass it on to self.catalog."""
+        st = entry.stat
+        identity = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+        record = {
+            "path": entry.path,
+            "source": entry.source.order,
+            "stat": identity,
+            "digest": None,
+            "samples": {},
+        }
+        self.sources[entry.source.order] = entry.source.path
+
+        previous = self.previous.get(entry.path)
+        if previous is None:
+            self.new += 1
+        elif previous["stat"] != identity:
+            self.changed += 1
+        else:
+            self.unchanged += 1
+            record["digest"] = previous["digest"]
+            record["samples"] = previous["samples"]
+            if entry.digest is None:
+                entry.digest = previous["digest"]
+            if previous["samples"]:
+                entry.partial_digests.update(previous["samples"])
+
+        self.files[entry.path] = record
+        if self.catalog is not None:
+            self.catalog.add_entry(entry)
+
+    def record_digests(self, entry):
+        record = self.files.get(entry.path)
+        if record is not None:
+            record["digest"] = entry.digest
+            record["samples"] = dict(entry.partial_digests)
+
+    def add_group(self, group):
+        self.groups.append(sorted(entry.path for entry in group))
+
+    def get_deleted(self):
+        return [path for path in self.previous if path not in self.files]
+
+    def get_changes(self):
+        """Return lists of the groups added and dissolved since the previous scan,
+        each as a sorted list of paths."""
+        current = set(map(frozenset, self.groups))
+
+        return (
+            [sorted(g) for g in current if g not in self.previous_groups],
+            [sorted(g) for g in self.previous_groups if g not in current],
+        )
+
+
+class ManifestStat(
+    collections.namedtuple(
+        "ManifestStat", ["st_dev", "st_ino", "st_size", "st_mtime_ns"]
+    )
+):
+    """The stat identity of a file, as recorded in a manifest."""
+
+    __slots__ = ()
+    st_blksize = 0
+
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 1e9
+
+
+class ManifestEntry(FileEntry):
+    """A file recorded, with its digest, in the manifest of some node. It is
+    never read: it need not exist on this host at all."""
+
+    def get_inode(self):
+        # Device and inode numbers only identify files on the same node.
+        inode = super(ManifestEntry, self).get_inode()
+        if inode is None:
+            return None
+
+        return (self.source.node,) + inode
+
+    def run_digest(self, algorithm=None, reader=None):
+        raise ValueError(
+            "The file {} was not hashed on node {}.".format(self.path, self.source.node)
+        )
+
+
+class ManifestSource:
+    """A source scanned on some node, whose files are read from the node's
+    manifest rather than walked."""
+
+    def __init__(self, node, path, order, manifest_path, local_order, algorithm):
+        self.node = node
+        self.path = path
+        self.order = order
+        self.manifest_path = manifest_path
+        self.local_order = local_order
+        self.algorithm = algorithm
+
+    @classmethod
+    def load_all(cls, paths):
+        """Return a source for each source recorded in the manifests at paths,
+        numbered in turn. The manifests must come from different nodes, and use
+        the same cryptographic digest algorithm."""
+        sources = []
+        nodes = set()
+        algorithms = set()
+
+        for path in paths:
+            with open(path, "r") as f:
+                header = json.loads(f.readline() or "{}")
+
+            if header.get("version") != ScanManifest.VERSION or "node" not in header:
+                raise ValueError("{} is not a node manifest.".format(path))
+
+            node = header["node"]
+            if node in nodes:
+                raise ValueError("More than one manifest is from node {}.".format(node))
+            nodes.add(node)
+
+            algorithm = hash_algorithms.get(header.get("algorithm"))
+            if algorithm is None or not algorithm.cryptographic:
+                raise ValueError(
+                    "The manifest {} does not use a cryptographic digest "
+                    "algorithm.".format(path)
+                )
+            algorithms.add(algorithm.name)
+            if len(algorithms) > 1:
+                raise ValueError("The manifests use different digest algorithms.")
+
+            for source in header["sources"]:
+                sources.append(
+                    cls(
+                        node,
+                        source["path"],
+                        len(sources) + 1,
+                        path,
+                        source["order"],
+                        algorithm,
+                    )
+                )
+
+        return sources
+
+    def contains(self, other):
+        # Each file is recorded only once in its node's manifest.
+        return False
+
+    def walk(self, ctx, path=None, stats=None):
+        """Add an entry to ctx for each file in this source that was hashed on its
+        node. The work done is counted in stats, if given."""
+        counts = collections.Counter()
+        with open(self.manifest_path, "r") as f:
+            f.readline()
+            for line in f:
+                record = json.loads(line)
+                if record.get("source") != self.local_order:
+                    continue
+
+                if record["digest"] is None:
+                    # Empty, or unreadable when its node was scanned.
+                    counts["files_filtered"] += 1
+                    continue
+
+                counts["files_walked"] += 1
+                entry = ManifestEntry(
+                    record["path"], self, ManifestStat(*record["stat"])
+                )
+                entry.digest = record["digest"]
+                ctx.add_entry(entry)
+
+        if stats is not None:
+            for (name, count) in counts.items():
+                stats.increment(name, count)
+
+
+class DuplicatePlan:
+    """The duplicates found on one node by merging the manifests of several
+    nodes, as written by a PlanDuplicateFileSink, to be sunk on that node.
+
+    Duplicates, and originals on the same node, are checked to be unchanged
+    since they were scanned before anything is done; duplicates that have
+    changed are skipped. Originals on other nodes cannot be checked. Plans are
+    stored as JSON lines."""
+
+    VERSION = 1
+
+    def __init__(self, node, records=None):
+        self.node = node
+        self.records = records or []
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            header = json.loads(f.readline() or "{}")
+            if header.get("version") != cls.VERSION or "node" not in header:
+                raise ValueError("{} is not a plan.".format(path))
+
+            return cls(header["node"], [json.loads(line) for line in f])
+
+    @staticmethod
+    def get_record(entry):
+        st = entry.stat
+        return {
+            "node": entry.source.node,
+            "path": entry.path,
+            "stat": [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns],
+        }
+
+    def get_entry(self, record):
+        """Return a FileEntry for the file recorded, or None if it has changed or
+        gone since it was scanned."""
+        try:
+            st = os.stat(record["path"])
+        except OSError:
+            return None
+
+        if [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns] != record["stat"]:
+            return None
+
+        return FileEntry(record["path"], None, st)
+
+    def apply(self, sink, batch_size=1000):
+        """Pass the duplicates in this plan to sink, in batches of batch_size (or
+        all at once, if batch_size is 0). Return the numbers of duplicates sunk
+        and skipped."""
+        logger = logging.getLogger(__name__)
+        batch = []
+        sunk = 0
+        skipped = 0
+
+        for record in self.records:
+            skip = None
+            entry = self.get_entry(record)
+            original = record["original"]
+            if entry is None:
+                skip = "it has changed since it was scanned"
+            elif original["node"] == self.node:
+                entry.original = self.get_entry(original)
+                if entry.original is None:
+                    skip = "its original {} has changed since it was scanned".format(
+                        original["path"]
+                    )
+            elif isinstance(sink, LinkDuplicateFileSink):
+                skip = "its original is on node {}".format(original["node"])
+
+            if skip is not None:
+                logger.warning("Skipping duplicate file %s: %s.", record["path"], skip)
+                skipped += 1
+                continue
+
+            batch.append(entry)
+            if batch_size and len(batch) >= batch_size:
+                sink.sink(batch)
+                sunk += len(batch)
+                batch = []
+
+        if batch:
+            sink.sink(batch)
+            sunk += len(batch)
+
+        return (sunk, skipped)
+
+
+class PlanDuplicateFileSink(DuplicateFileSink):
+    """Write the duplicates on each node to a DuplicatePlan for that node,
+    <node>.plan in directory, rather than acting on them. A plan is written for
+    each of nodes, even if it has no duplicates."""
+
+    def __init__(self, directory, nodes):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        for node in nodes:
+            with open(self.get_path(node), "w") as f:
+                f.write(json.dumps({"version": DuplicatePlan.VERSION, "node": node}))
+                f.write("\n")
+
+    def get_path(self, node):
+        return os.path.join(self.directory, "{}.plan".format(node))
+
+    def sink(self, files):
+        plans = collections.defaultdict(list)
+        for entry in files:
+            record = DuplicatePlan.get_record(entry)
+            record["original"] = DuplicatePlan.get_record(entry.original)
+            plans[record.pop("node")].append(record)
+
+        for (node, records) in plans.items():
+            with open(self.get_path(node), "a") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+
+
 class FileCatalog:
-    def __init__(self, idfunc):
+    """Group entries by the key returned by idfunc, ignoring entries whose key is
+    None. Entries whose identity (by default, their path) has already been seen
+    are also ignored, unless identityfunc is None."""
+
+    def __init__(self, idfunc, identityfunc=operator.attrgetter("path")):
         self.store = {}
         self.path_store = set()
         self.idfunc = idfunc
+        self.identityfunc = identityfunc
 
     def add_entry(self, entry):
-        if self.idfunc(entry) is not None and entry.path not in self.path_store:
-            self.store.setdefault(self.idfunc(entry), []).append(entry)
-            self.path_store.add(entry.path)
+        key = self.idfunc(entry)
+        if key is not None:
+            if self.identityfunc is None:
+                self.store.setdefault(key, []).append(entry)
+                return
+
+            identity = self.identityfunc(entry)
+            if identity not in self.path_store:
+                self.store.setdefault(key, []).append(entry)
+                self.path_store.add(identity)
 
     def get_groups(self):
         return [
@@ -254,6 +1606,358 @@ class FileCatalog:
         ]
 
 
+class SpillingFileCatalog(FileCatalog):
+    """A FileCatalog holding at most max_entries entries in memory. Beyond that,
+    entries are sorted by key and written out to temporary files (runs) in
+    directory, and get_groups() merges the runs.
+
+    get_groups() produces the same groups, in the same order, as FileCatalog,
+    but reads them back from disk one at a time rather than returning a list.
+    Keys must be orderable. Since entries with the same identity always share a
+    key, repeated entries are removed within each group, rather than by holding
+    every identity in memory."""
+
+    def __init__(
+        self,
+        idfunc,
+        identityfunc=operator.attrgetter("path"),
+        max_entries=1 << 20,
+        directory=None,
+    ):
+        super(SpillingFileCatalog, self).__init__(idfunc, identityfunc)
+        self.max_entries = max_entries
+        self.directory = directory
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+        # Sources are shared by many entries, and are not written out.
+        self.sources = {}
+
+    def add_entry(self, entry):
+        key = self.idfunc(entry)
+        if key is not None:
+            # The sequence number orders entries with equal keys, and keeps
+            # entries themselves from being compared.
+            self.buffer.append((key, self.count, entry))
+            self.count += 1
+            if len(self.buffer) >= self.max_entries:
+                self.spill()
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Source):
+            self.sources[id(obj)] = obj
+            return id(obj)
+
+        return None
+
+    def persistent_load(self, pid):
+        return self.sources[pid]
+
+    def dump(self, f, item):
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self.persistent_id
+        pickler.dump(item)
+
+    def load(self, f):
+        unpickler = pickle.Unpickler(f)
+        unpickler.persistent_load = self.persistent_load
+        return unpickler.load()
+
+    def spill(self):
+        logging.getLogger(__name__).debug(
+            "Spilling %d catalog entries to disk.", len(self.buffer)
+        )
+        self.buffer.sort(key=operator.itemgetter(0, 1))
+        run = tempfile.TemporaryFile(dir=self.directory)
+        for record in self.buffer:
+            self.dump(run, record)
+
+        self.runs.append(run)
+        self.buffer = []
+
+    def read_run(self, run):
+        run.seek(0)
+        while True:
+            try:
+                yield self.load(run)
+            except EOFError:
+                break
+
+    def unique(self, group):
+        if self.identityfunc is None:
+            return group
+
+        seen = set()
+        entries = []
+        for entry in group:
+            identity = self.identityfunc(entry)
+            if identity not in seen:
+                seen.add(identity)
+                entries.append(entry)
+
+        return entries
+
+    def get_groups(self):
+        if not self.runs:
+            store = {}
+            for (key, count, entry) in self.buffer:
+                store.setdefault(key, []).append(entry)
+
+            groups = [self.unique(group) for group in store.values()]
+            return [group for group in groups if len(group) > 1]
+
+        if self.buffer:
+            self.spill()
+
+        return self.merge_runs()
+
+    def merge_runs(self):
+        # Merge the runs into groups, in key order. FileCatalog orders groups by
+        # their first entry, so write the groups out again, keeping only an
+        # index of their first entries and offsets in memory.
+        index = []
+        with tempfile.TemporaryFile(dir=self.directory) as groups:
+            records = heapq.merge(
+                *map(self.read_run, self.runs), key=operator.itemgetter(0, 1)
+            )
+            for (key, group) in itertools.groupby(records, operator.itemgetter(0)):
+                group = list(group)
+                entries = self.unique([entry for (key, count, entry) in group])
+                if len(entries) > 1:
+                    index.append((group[0][1], groups.tell()))
+                    self.dump(groups, entries)
+
+            for run in self.runs:
+                run.close()
+            self.runs = []
+
+            index.sort()
+            for (count, offset) in index:
+                groups.seek(offset)
+                yield self.load(groups)
+
+
+class ColumnarFileCatalog(FileCatalog):
+    """Group entries by size, as DeduplicateOperation's size catalog does, keeping
+    each entry's size, device, inode, modification time, source order and path
+    depth (relative to its source) in columns. Grouping sorts the size column
+    with NumPy, rather than building a list for every distinct size.
+
+    Groups, and the entries within them, are returned in the same order as by
+    FileCatalog. Requires NumPy."""
+
+    columns = {
+        "size": "q",
+        "dev": "Q",
+        "ino": "Q",
+        "mtime": "q",
+        "order": "q",
+        "depth": "q",
+    }
+
+    def __init__(self, identityfunc=operator.attrgetter("path")):
+        if numpy is None:
+            raise ValueError("The columnar catalog requires NumPy.")
+
+        super(ColumnarFileCatalog, self).__init__(
+            lambda entry: entry.get_size() if entry.get_size() != 0 else None,
+            identityfunc,
+        )
+        self.entries = []
+        self.data = {name: array.array(code) for (name, code) in self.columns.items()}
+        self.rows = {}
+
+    def add_entry(self, entry):
+        if self.idfunc(entry) is None:
+            return
+
+        if self.identityfunc is not None:
+            identity = self.identityfunc(entry)
+            if identity in self.path_store:
+                return
+            self.path_store.add(identity)
+
+        st = entry.stat
+        self.entries.append(entry)
+        self.data["size"].append(st.st_size)
+        self.data["dev"].append(st.st_dev)
+        self.data["ino"].append(st.st_ino)
+        self.data["mtime"].append(st.st_mtime_ns)
+        self.data["order"].append(entry.source.order)
+        self.data["depth"].append(
+            entry.path.count(os.path.sep) - entry.source.path.count(os.path.sep)
+        )
+
+    def get_column(self, name):
+        return numpy.frombuffer(self.data[name], dtype=self.data[name].typecode)
+
+    def get_groups(self):
+        order = numpy.argsort(self.get_column("size"), kind="stable")
+        (values, starts, counts) = numpy.unique(
+            self.get_column("size")[order], return_index=True, return_counts=True
+        )
+        starts = starts[counts > 1]
+        counts = counts[counts > 1]
+
+        # Present groups in order of their first entry, as FileCatalog does.
+        first = numpy.argsort(order[starts], kind="stable")
+        order = order.tolist()
+
+        groups = []
+        self.rows = {}
+        for (start, count) in zip(starts[first].tolist(), counts[first].tolist()):
+            group = []
+            for row in order[start : start + count]:
+                entry = self.entries[row]
+                self.rows[id(entry)] = row
+                group.append(entry)
+            groups.append(group)
+
+        return groups
+
+
+def translate_glob(pattern):
+    """Translate a gitignore-style glob into a regular expression matching the
+    whole of a name or /-separated path. * and ? do not match /, and a ** path
+    component matches any number of directories."""
+    components = pattern.split("/")
+    parts = []
+    for (i, component) in enumerate(components):
+        last = i == len(components) - 1
+        if component == "**":
+            parts.append(".*" if last else "(?:.*/)?")
+            continue
+
+        j = 0
+        while j < len(component):
+            c = component[j]
+            j += 1
+            if c == "*":
+                parts.append("[^/]*")
+            elif c == "?":
+                parts.append("[^/]")
+            elif c == "[" and component.find("]", j + 1) != -1:
+                end = component.find("]", j + 1)
+                body = component[j:end].replace("\\", "\\\\")
+                j = end + 1
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append("[" + body + "]")
+            elif c == "\\" and j < len(component):
+                parts.append(re.escape(component[j]))
+                j += 1
+            else:
+                parts.append(re.escape(c))
+
+        if not last:
+            parts.append("/")
+
+    return "".join(parts) + "\\Z"
+
+
+class CompiledMatcher:
+    """Matches names against many rules at once. Literal names are kept in a
+    set, while regular expressions (applied with re.match()) and globs are merged
+    into a single alternation. Results are cached for the last cache_size names
+    matched."""
+
+    def __init__(self, names=None, patterns=None, globs=None, cache_size=65536):
+        self.names = frozenset(names or [])
+        self.regexes = []
+
+        merged = collections.OrderedDict()
+        for pattern in itertools.chain(
+            (re.compile(p) for p in patterns or []),
+            (re.compile(translate_glob(g)) for g in globs or []),
+        ):
+            if pattern.groups:
+                # Merging would renumber the groups of any backreferences.
+                self.regexes.append(pattern)
+            else:
+                merged.setdefault(pattern.flags, []).append(pattern)
+
+        for (flags, group) in merged.items():
+            try:
+                self.regexes.append(
+                    re.compile(
+                        "|".join("(?:{})".format(p.pattern) for p in group), flags
+                    )
+                )
+            except re.error:
+                # For example, patterns setting their own flags.
+                self.regexes.extend(group)
+
+        if self.regexes and cache_size:
+            self.match = functools.lru_cache(cache_size)(self.match)
+
+    def __bool__(self):
+        return bool(self.names or self.regexes)
+
+    def match(self, name):
+        return name in self.names or any(
+            regex.match(name) is not None for regex in self.regexes
+        )
+
+
+class IgnoreRules:
+    """Rules in the style of .gitignore files, each excluding the files and
+    directories whose names match a glob. Rules ending in / match only
+    directories, and rules containing any other / match the path relative to the
+    rules' own directory. Negated (!) rules are not supported, and are skipped."""
+
+    def __init__(self, lines):
+        rules = collections.defaultdict(lambda: ([], []))
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line.endswith("\\ "):
+                line = line.rstrip(" ")
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("!"):
+                logging.getLogger(__name__).warning(
+                    "Negated ignore rules are not supported: %s", line
+                )
+                continue
+
+            directories_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            (names, globs) = rules[(directories_only, anchored)]
+            if re.search("[*?[\\\\]", line) is None:
+                names.append(line.lstrip("/"))
+            else:
+                globs.append(line.lstrip("/"))
+
+        def matcher(directories_only, anchored):
+            (names, globs) = rules[(directories_only, anchored)]
+            # Paths are rarely matched more than once; only names are cached.
+            return CompiledMatcher(
+                names, globs=globs, cache_size=0 if anchored else 65536
+            )
+
+        self.names = matcher(False, False)
+        self.paths = matcher(False, True)
+        self.directory_names = matcher(True, False)
+        self.directory_paths = matcher(True, True)
+
+    @classmethod
+    def load(cls, path, opener=None):
+        with open(path, "r", opener=opener) as f:
+            return cls(f)
+
+    def ignores(self, name, prefix, is_dir):
+        """Return True if the file or directory name, whose directory lies at
+        prefix (ending in /) relative to the rules' directory, is excluded."""
+        if self.names.match(name) or (self.paths and self.paths.match(prefix + name)):
+            return True
+        if is_dir:
+            return self.directory_names.match(name) or bool(
+                self.directory_paths and self.directory_paths.match(prefix + name)
+            )
+
+        return False
+
+
 class SourceFilter(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def include_file(self, fn, path):
@@ -265,112 +1969,1880 @@ class SourceFilter(metaclass=abc.ABCMeta):
 
 
 class ConfiguredSourceFilter(SourceFilter):
-    def __init__(self, patterns=None, names=None):
+    def __init__(self, patterns=None, names=None, globs=None):
         self.patterns = patterns
         self.names = names
+        self.globs = globs
+        self.matcher = CompiledMatcher(names, patterns, globs)
 
     def include_file(self, fn, enclosing_dir):
-        if self.names is None or fn not in self.names:
-            if self.patterns is None or True not in [
-                re.match(pattern, fn) is not None for pattern in self.patterns
-            ]:
-                return True
-
-        return False
+        return not self.matcher.match(fn)
 
     def descend_into_directory(self, dirname, enclosing_dir):
         return self.include_file(dirname, enclosing_dir)
 
 
 class Source:
-    def __init__(self, dpath, order, source_filter=None):
+    """A tree of files to be deduplicated. With fwalk, the tree is walked with
+    os.fwalk(), and files are stat()ed relative to a descriptor for their
+    directory, rather than by full path.
+
+    If ignore_file is given, files so named hold IgnoreRules excluding files and
+    directories within their own directory's subtree. The ignore files are
+    themselves excluded."""
+
+    def __init__(
+        self,
+        dpath,
+        order,
+        source_filter=None,
+        compact=False,
+        fwalk=False,
+        ignore_file=None,
+    ):
+        if fwalk and not SUPPORTS_DIR_FD:
+            raise ValueError("Walking with os.fwalk() is not supported here.")
+
         self.path = os.path.abspath(dpath)
         self.order = order
         self.source_filter = source_filter
+        self.compact = compact
+        self.fwalk = fwalk
+        self.ignore_file = ignore_file
+        self.directories = DirectoryTable()
+        # The (directory, IgnoreRules) pairs applying within each directory.
+        self.ignore_chains = {}
+
+    def contains(self, other):
+        """Return True if other's tree lies within this source's tree."""
+        return other.path == self.path or other.path.startswith(
+            os.path.join(self.path, "")
+        )
+
+    def get_ignore_rules(self, directory, names=None, dir_fd=None):
+        """Return the IgnoreRules applying within directory, each paired with
+        directory's path relative to the rules' own directory, as expected by
+        includes(). names, if given, lists the contents of directory, and dir_fd
+        is a descriptor for it."""
+        if self.ignore_file is None:
+            return []
+
+        results = []
+        for (base, rules) in self.get_ignore_chain(directory, names, dir_fd):
+            prefix = directory[len(base) + 1 :]
+            if os.path.sep != "/":
+                prefix = prefix.replace(os.path.sep, "/")
+            results.append((rules, prefix + "/" if prefix else ""))
+
+        return results
+
+    def get_ignore_chain(self, directory, names=None, dir_fd=None):
+        chain = self.ignore_chains.get(directory)
+        if chain is None:
+            if directory.startswith(os.path.join(self.path, "")):
+                chain = self.get_ignore_chain(os.path.dirname(directory))
+            else:
+                chain = ()
+
+            if names is None or self.ignore_file in names:
+                rules = self.load_ignore_rules(directory, dir_fd)
+                if rules is not None:
+                    chain += ((directory, rules),)
+            self.ignore_chains[directory] = chain
+
+        return chain
+
+    def load_ignore_rules(self, directory, dir_fd=None):
+        try:
+            if dir_fd is not None:
+                return IgnoreRules.load(
+                    self.ignore_file, functools.partial(os.open, dir_fd=dir_fd)
+                )
+            return IgnoreRules.load(os.path.join(directory, self.ignore_file))
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+        except (OSError, UnicodeDecodeError) as e:
+            logging.getLogger(__name__).warning(
+                "Unable to read ignore file %s: %s",
+                os.path.join(directory, self.ignore_file),
+                e,
+            )
+            return None
+
+    def includes(self, name, directory, is_dir, rules=()):
+        """Return True if the file or directory name within directory passes our
+        source filter and is not excluded by rules, as returned by
+        get_ignore_rules(directory)."""
+        if self.source_filter is not None:
+            if is_dir:
+                if not self.source_filter.descend_into_directory(name, directory):
+                    return False
+            elif not self.source_filter.include_file(name, directory):
+                return False
+
+        if not is_dir and name == self.ignore_file:
+            return False
+
+        return not any(r.ignores(name, prefix, is_dir) for (r, prefix) in rules)
+
+    def make_entry(self, path, name, st, directory):
+        if self.compact:
+            return CompactFileEntry(path, self, st, directory, name)
+
+        return FileEntry(path, self, st)
+
+    def walk(self, ctx, path=None, stats=None):
+        """Add an entry to ctx for each file in this source, or in its subtree at
+        path. The work done is counted in stats, if given."""
+        if path is None:
+            # Pick up any changes to ignore files since we were last walked.
+            self.ignore_chains = {}
+
+        if self.fwalk:
+            counts = self.walk_fds(ctx, path or self.path)
+        else:
+            counts = self.walk_paths(ctx, path or self.path)
+
+        if stats is not None:
+            for (name, count) in counts.items():
+                stats.increment(name, count)
+
+    def walk_paths(self, ctx, path):
+        # Equivalent to a top-down os.walk() that does not follow links, but
+        # uses the type information returned by scandir() and only stats
+        # files that pass the source filter.
+        stack = [path]
+        counts = collections.Counter()
+        while stack:
+            cwd = stack.pop()
+            subdirs = []
+            directory = self.directories.intern(cwd) if self.compact else None
+
+            try:
+                it = os.scandir(cwd)
+            except OSError:
+                counts["walk_errors"] += 1
+                continue
+
+            counts["directories_walked"] += 1
+            with it:
+                dir_entries = list(it)
+
+            rules = self.get_ignore_rules(cwd, [e.name for e in dir_entries])
+            for dir_entry in dir_entries:
+                try:
+                    is_dir = dir_entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    if not dir_entry.is_symlink() and self.includes(
+                        dir_entry.name, cwd, True, rules
+                    ):
+                        subdirs.append(dir_entry.path)
+                    else:
+                        counts["directories_filtered"] += 1
+                elif self.includes(dir_entry.name, cwd, False, rules):
+                    # scandir() supplies file types without a stat() call;
+                    # only the files we keep are stat()ed.
+                    counts["files_walked"] += 1
+                    counts["stat_calls"] += 1
+                    ctx.add_entry(
+                        self.make_entry(
+                            dir_entry.path, dir_entry.name, dir_entry.stat(), directory
+                        )
+                    )
+                else:
+                    counts["files_filtered"] += 1
+
+            stack.extend(reversed(subdirs))
+
+        return counts
+
+    def walk_fds(self, ctx, path):
+        # os.fwalk() holds a descriptor for each directory on the way down, and
+        # opens each subdirectory relative to its parent, refusing to follow a
+        # directory that has been replaced by a link since it was listed. Files
+        # are stat()ed relative to the same descriptor.
+        counts = collections.Counter()
+
+        def onerror(error):
+            counts["walk_errors"] += 1
+
+        for (cwd, subdirs, files, dir_fd) in os.fwalk(path, onerror=onerror):
+            counts["directories_walked"] += 1
+            directory = self.directories.intern(cwd) if self.compact else None
+            rules = self.get_ignore_rules(cwd, files, dir_fd)
+
+            kept = [d for d in subdirs if self.includes(d, cwd, True, rules)]
+            counts["directories_filtered"] += len(subdirs) - len(kept)
+            subdirs[:] = kept
+
+            for name in files:
+                if self.includes(name, cwd, False, rules):
+                    counts["files_walked"] += 1
+                    counts["stat_calls"] += 1
+                    st = os.stat(name, dir_fd=dir_fd)
+                    ctx.add_entry(
+                        self.make_entry(os.path.join(cwd, name), name, st, directory)
+                    )
+                else:
+                    counts["files_filtered"] += 1
+
+        return counts
+
+
+class OperationStats:
+    """Counters and per-phase timings describing the work done by an operation.
+
+    Phases are timed exclusively: time spent in a phase entered while another
+    is in progress on the same thread is counted only against the inner phase.
+    CPU time is that of the whole process, including worker threads. Phases
+    that run concurrently on different threads, as in
+    DeduplicateOperation.groups(), have overlapping times."""
+
+    PHASES = ["walk", "group", "hash", "resolve", "sink"]
+    COUNTERS = [
+        "directories_walked",
+        "directories_filtered",
+        "files_walked",
+        "files_filtered",
+        "stat_calls",
+        "walk_errors",
+        "size_groups",
+        "candidate_files",
+        "files_sampled",
+        "bytes_sampled",
+        "bytes_avoided",
+        "files_hashed",
+        "bytes_hashed",
+        "bytes_compared",
+        "duplicate_groups",
+        "unresolved_groups",
+        "sink_batches",
+        "files_sunk",
+        "sink_failures",
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The stack of phases in progress on each thread.
+        self.stacks = {}
+        self.profiler = None
+        self.phases = collections.OrderedDict(
+            (name, [0.0, 0.0]) for name in self.PHASES
+        )
+        self.counters = collections.Counter()
+        self.resolvers = collections.OrderedDict()
+        self.started = None
+        self.elapsed = [0.0, 0.0]
+
+    def now(self):
+        return (time.perf_counter(), time.process_time())
+
+    def start(self):
+        self.started = self.now()
+
+    def stop(self):
+        if self.started is not None:
+            now = self.now()
+            self.elapsed[0] += now[0] - self.started[0]
+            self.elapsed[1] += now[1] - self.started[1]
+            self.started = None
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def accrue(self, frame, now):
+        with self.lock:
+            times = self.phases.setdefault(frame[0], [0.0, 0.0])
+            times[0] += now[0] - frame[1][0]
+            times[1] += now[1] - frame[1][1]
+
+    def get_phase(self, thread_id):
+        """Return the name of the phase in progress on a thread, or None."""
+        try:
+            return self.stacks[thread_id][-1][0]
+        except (KeyError, IndexError):
+            return None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self.stacks.setdefault(threading.get_ident(), [])
+        profiler = self.profiler
+        now = self.now()
+        if stack:
+            # Pause the enclosing phase.
+            self.accrue(stack[-1], now)
+            if profiler is not None:
+                profiler.leave(stack[-1][0])
+        stack.append([name, now])
+        if profiler is not None:
+            profiler.enter(name)
+
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.leave(name)
+            now = self.now()
+            self.accrue(stack.pop(), now)
+            if stack:
+                stack[-1][1] = now
+                if profiler is not None:
+                    profiler.enter(stack[-1][0])
+
+    def call(self, name, function, *args):
+        with self.phase(name):
+            return function(*args)
+
+    def timed(self, name, iterable):
+        """Yield the items of iterable, counting the time taken to produce each
+        against the named phase."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+
+            yield item
+
+    def record_resolution(self, resolver, originals, duplicates):
+        """Count the outcome of applying resolver to a group."""
+        if not originals:
+            outcome = "deferred"
+        elif len(originals) == 1:
+            outcome = "resolved"
+        elif duplicates:
+            outcome = "narrowed"
+        else:
+            outcome = "undecided"
+
+        name = type(resolver).__name__
+        if getattr(resolver, "reverse", False):
+            name += " (reverse)"
+
+        with self.lock:
+            self.resolvers.setdefault(name, collections.Counter())[outcome] += 1
+
+    def get_rates(self):
+        def rate(amount, total):
+            return amount / total if total else None
+
+        counters = self.counters
+        read = counters["bytes_hashed"] + counters["bytes_sampled"]
+        lookups = counters["digest_cache_hits"] + counters["digest_cache_misses"]
+        return {
+            "walk_files_per_second": rate(
+                counters["files_walked"], self.phases["walk"][0]
+            ),
+            "hash_megabytes_per_second": rate(
+                (read + counters["bytes_compared"]) / (1 << 20), self.phases["hash"][0]
+            ),
+            "digest_cache_hit_rate": rate(counters["digest_cache_hits"], lookups),
+            "prefilter_bytes_avoided_ratio": rate(
+                counters["bytes_avoided"], counters["bytes_avoided"] + read
+            ),
+        }
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "wall_time": self.elapsed[0],
+                "cpu_time": self.elapsed[1],
+                "phases": collections.OrderedDict(
+                    (name, {"wall_time": wall, "cpu_time": cpu})
+                    for (name, (wall, cpu)) in self.phases.items()
+                ),
+                "counters": collections.OrderedDict(
+                    [(name, self.counters[name]) for name in self.COUNTERS]
+                    + sorted(
+                        (name, count)
+                        for (name, count) in self.counters.items()
+                        if name not in self.COUNTERS
+                    )
+                ),
+                "rates": self.get_rates(),
+                "resolvers": collections.OrderedDict(
+                    (name, dict(outcomes))
+                    for (name, outcomes) in self.resolvers.items()
+                ),
+            }
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2)
+            f.write("\n")
+
+    def summary(self):
+        return ", ".join(
+            "{} {:.2f}s".format(name, wall)
+            for (name, (wall, cpu)) in self.phases.items()
+        )
+
+
+class PhaseProfiler:
+    """Profile each phase of an operation separately, writing to directory a
+    cProfile dump (<phase>.prof), a tracemalloc snapshot (<phase>.snapshot), and
+    a report of the top allocations (<phase>-memory.txt) for each phase.
+
+    Only the thread that starts the profiler is profiled with cProfile; work
+    done on worker threads is not seen. Snapshots are taken as phases are left,
+    whenever memory use has grown by more than a tenth since the phase's last
+    snapshot, so that each phase's snapshot shows its highest memory use."""
+
+    def __init__(self, directory, top=25, frames=8):
+        self.directory = directory
+        self.top = top
+        self.frames = frames
+        self.profiles = {}
+        self.snapshots = {}
+        self.thread_id = None
+
+    def start(self, stats):
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread_id = threading.get_ident()
+        self.started_tracing = not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start(self.frames)
+        stats.profiler = self
+
+    def enter(self, name):
+        if threading.get_ident() == self.thread_id:
+            self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+    def leave(self, name):
+        if threading.get_ident() != self.thread_id:
+            return
+
+        self.profiles[name].disable()
+        (current, peak) = tracemalloc.get_traced_memory()
+        previous = self.snapshots.get(name)
+        if previous is None or current > previous[0] * 1.1:
+            self.snapshots[name] = (current, tracemalloc.take_snapshot())
+
+    def stop(self, stats):
+        stats.profiler = None
+        if self.started_tracing:
+            tracemalloc.stop()
+
+        for (name, profile) in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory, name + ".prof"))
+
+        for (name, (current, snapshot)) in self.snapshots.items():
+            snapshot = snapshot.filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__)]
+            )
+            snapshot.dump(os.path.join(self.directory, name + ".snapshot"))
+            path = os.path.join(self.directory, name + "-memory.txt")
+            with open(path, "w") as f:
+                f.write(
+                    "Top allocations during {} ({} bytes traced):\n".format(
+                        name, current
+                    )
+                )
+                for statistic in snapshot.statistics("lineno")[: self.top]:
+                    f.write("{}\n".format(statistic))
+
+
+class SamplingProfiler:
+    """Sample the stacks of all threads every interval seconds, counting the
+    samples in each phase (that of the sampled thread, or else that of the
+    thread that started the profiler). Cheap enough to leave running.
+
+    Samples are written to directory as <phase>.folded, with one line for each
+    distinct stack and its count, in the format used by flame graph tools."""
+
+    def __init__(self, directory, interval=0.01):
+        self.directory = directory
+        self.interval = interval
+        self.samples = collections.defaultdict(collections.Counter)
+        self.stopped = threading.Event()
+        self.thread = None
 
-    def walk(self, ctx):
-        for cwd, subdirs, files in os.walk(self.path, topdown=True):
-            subdirs[:] = [
-                d
-                for d in subdirs
-                if self.source_filter is None
-                or self.source_filter.descend_into_directory(d, cwd)
+    def start(self, stats):
+        os.makedirs(self.directory, exist_ok=True)
+        self.stats = stats
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for (thread_id, frame) in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+
+            phase = (
+                self.stats.get_phase(thread_id)
+                or self.stats.get_phase(self.thread_id)
+                or "other"
+            )
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "{} ({}:{})".format(
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno,
+                    )
+                )
+                frame = frame.f_back
+
+            self.samples[phase][";".join(reversed(stack))] += 1
+
+    def stop(self, stats):
+        self.stopped.set()
+        self.thread.join()
+        for (phase, samples) in self.samples.items():
+            with open(os.path.join(self.directory, phase + ".folded"), "w") as f:
+                for (stack, count) in samples.most_common():
+                    f.write("{} {}\n".format(stack, count))
+
+
+class ProgressReporter:
+    """Report the progress of confirming duplicates every interval seconds: the
+    proportion of candidate bytes processed, the current throughput, an estimate
+    of the time remaining, and the file being read.
+
+    Reports are written as lines to output (a text stream, such as sys.stderr),
+    and as JSON to the status file at path, which is replaced on each report.
+    They are written by a background thread, so that the work being reported
+    on need only count the bytes it processes."""
+
+    # Weight given to the latest interval's throughput.
+    SMOOTHING = 0.3
+
+    def __init__(self, output=None, path=None, interval=1.0):
+        self.output = output
+        self.path = path
+        self.interval = interval
+        self.clock = time.monotonic
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.total_bytes = None
+        self.total_files = None
+        self.bytes_done = 0
+        self.files_done = 0
+        self.current = None
+        self.rate = None
+
+    def start(self, total_bytes=None, total_files=None):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.started = self.last = self.clock()
+        self.last_bytes = 0
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+            self.current = None
+            self.report(final=True)
+
+    def advance(self, nbytes, nfiles=1):
+        with self.lock:
+            self.bytes_done += nbytes
+            self.files_done += nfiles
+
+    def get_status(self):
+        now = self.clock()
+        with self.lock:
+            (bytes_done, files_done) = (self.bytes_done, self.files_done)
+
+        if now > self.last:
+            rate = (bytes_done - self.last_bytes) / (now - self.last)
+            if self.rate is not None:
+                rate = self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.rate
+            self.rate = rate
+            (self.last, self.last_bytes) = (now, bytes_done)
+
+        status = collections.OrderedDict(
+            [
+                ("bytes_done", bytes_done),
+                ("bytes_total", self.total_bytes),
+                ("files_done", files_done),
+                ("files_total", self.total_files),
+                ("percent", None),
+                ("bytes_per_second", self.rate),
+                ("elapsed", now - self.started),
+                ("eta", None),
+                ("current", self.current),
             ]
+        )
+        if self.total_bytes:
+            remaining = max(self.total_bytes - bytes_done, 0)
+            status["percent"] = min(100.0 * bytes_done / self.total_bytes, 100.0)
+            if remaining == 0:
+                status["eta"] = 0.0
+            elif self.rate:
+                status["eta"] = remaining / self.rate
+
+        return status
+
+    @staticmethod
+    def format_size(size):
+        for unit in ["B", "KB", "MB", "GB", "TB"]:
+            if size < 1024 or unit == "TB":
+                break
+            size /= 1024
+
+        if unit == "B":
+            return "{:.0f} B".format(size)
+
+        return "{:.1f} {}".format(size, unit)
+
+    @staticmethod
+    def format_duration(seconds):
+        seconds = int(seconds)
+        return "{}:{:02d}:{:02d}".format(
+            seconds // 3600, (seconds // 60) % 60, seconds % 60
+        )
 
-            for f in files:
-                # os.walk returns filenames, not paths
-                if self.source_filter is None or self.source_filter.include_file(
-                    f, cwd
-                ):
-                    ctx.add_entry(FileEntry(os.path.join(cwd, f), self))
+    def format_status(self, status):
+        if status["percent"] is not None:
+            parts = [
+                "{:.1f}% ({} of {})".format(
+                    status["percent"],
+                    self.format_size(status["bytes_done"]),
+                    self.format_size(status["bytes_total"]),
+                )
+            ]
+        else:
+            parts = [self.format_size(status["bytes_done"])]
+
+        if status["bytes_per_second"] is not None:
+            parts.append("{}/s".format(self.format_size(status["bytes_per_second"])))
+        if status["eta"] is not None:
+            parts.append("ETA {}".format(self.format_duration(status["eta"])))
+        if status["current"] is not None:
+            parts.append(status["current"])
+
+        return "Confirming duplicates: " + ", ".join(parts)
+
+    def report(self, final=False):
+        status = self.get_status()
+
+        if self.output is not None:
+            line = self.format_status(status)
+            if self.output.isatty():
+                # Redraw a single line in place.
+                self.output.write("\r\033[K" + line + ("\n" if final else ""))
+            else:
+                self.output.write(line + "\n")
+            self.output.flush()
+
+        if self.path is not None:
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(status, f, indent=2)
+                f.write("\n")
+            os.replace(temporary_path, self.path)
+
+
+class CountingBlockReader:
+    """Wrap a block reader, counting the files and bytes read through it, and
+    advancing progress, if given, as each block is read."""
+
+    def __init__(self, reader, stats, progress=None):
+        self.reader = reader
+        self.stats = stats
+        self.progress = progress
+        self.bytes_read = 0
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+    def read_blocks(self, entry):
+        self.stats.increment("files_hashed")
+        for block in self.reader.read_blocks(entry):
+            self.stats.increment("bytes_hashed", len(block))
+            self.bytes_read += len(block)
+            if self.progress is not None:
+                self.progress.advance(len(block), 0)
+            yield block
+
+
+class CountingContentSampler:
+    """Wrap a ContentSampler, counting the files and bytes it samples."""
+
+    def __init__(self, sampler, stats):
+        self.sampler = sampler
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.sampler, name)
+
+    def run_digest(self, path, size):
+        self.stats.increment("files_sampled")
+        self.stats.increment(
+            "bytes_sampled",
+            sum(length for (offset, length) in self.sampler.get_regions(size)),
+        )
+        return self.sampler.run_digest(path, size)
+
+
+class CountingProgress:
+    """Wrap a ProgressReporter, totalling the bytes advanced through it."""
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.bytes_done = 0
+
+    def advance(self, nbytes, nfiles=1):
+        self.bytes_done += nbytes
+        self.progress.advance(nbytes, nfiles)
+
+
+class StoppingContext:
+    """Wrap a walk context, raising OperationStopped instead of adding any further
+    entries once stop (a threading.Event) is set."""
+
+    def __init__(self, ctx, stop):
+        self.ctx = ctx
+        self.stop = stop
+
+    def __getattr__(self, name):
+        return getattr(self.ctx, name)
+
+    def add_entry(self, entry):
+        if self.stop.is_set():
+            raise OperationStopped()
+
+        self.ctx.add_entry(entry)
+
+
+RESOLVE_BATCH_SIZE = 1024
+# A generous estimate of the memory, in bytes, used by each catalogued entry.
+SPILL_ENTRY_SIZE = 1024
 
 
 class DeduplicateOperation:
-    def __init__(self, sources, resolvers, sink):
+    def __init__(
+        self,
+        sources,
+        resolvers,
+        sink,
+        sampler=None,
+        digest_cache=None,
+        jobs=1,
+        comparator=None,
+        algorithm=None,
+        reader=None,
+        collapse_links=False,
+        sink_batch_size=1000,
+        columnar=False,
+        memory_limit=None,
+        manifest=None,
+        progress=None,
+        profiler=None,
+    ):
         self.sources = sources
         self.resolvers = resolvers
         self.sink = sink
+        self.sampler = sampler
+        self.digest_cache = digest_cache
+        self.jobs = jobs
+        self.comparator = comparator
+        self.algorithm = algorithm or DEFAULT_HASH_ALGORITHM
+        self.reader = reader or DEFAULT_BLOCK_READER
+        self.collapse_links = collapse_links
+        self.sink_batch_size = sink_batch_size
+        self.columnar = columnar
+        self.memory_limit = memory_limit
+        self.manifest = manifest
+        self.progress = progress
+        self.profiler = profiler
+        self.stats = OperationStats()
+        # Bytes read in full from each path whose group is yet to be settled.
+        self.bytes_read = {}
+        # Set to a threading.Event to stop walking and hashing between files.
+        self.stop_event = None
+
+        if columnar and numpy is None:
+            raise ValueError("The columnar catalog requires NumPy.")
+        if columnar and memory_limit is not None:
+            raise ValueError("The columnar catalog cannot be limited in memory.")
+
+    def map_ordered(self, function, items):
+        """Yield function(item) for each item, in order. Up to self.jobs calls run
+        concurrently on a thread pool; hashlib releases the GIL while hashing."""
+        if self.jobs <= 1:
+            for item in items:
+                yield function(item)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            # Bound the number of outstanding items so that results are
+            # consumed as they complete, rather than all being queued at once.
+            pending = collections.deque()
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= self.jobs * 4:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+    def prepare_entries(self, function, entries, first_links=None):
+        """Call function on each entry (typically to compute and cache its digest)
+        and yield the entries in their original order.
+
+        function is only called on the first link to each inode, as recorded in
+        first_links. Later links share its digests, which are always complete by
+        the time they are yielded."""
+        if first_links is None:
+            first_links = {}
+
+        def select(entries):
+            for entry in entries:
+                inode = entry.get_inode()
+                first_link = None
+                if inode is not None:
+                    first_link = first_links.setdefault(inode, entry)
+                    if first_link is entry:
+                        first_link = None
+
+                yield (entry, first_link)
+
+        def prepare(item):
+            self.check_stopped()
+            if item[1] is None:
+                function(item[0])
+
+            return item
+
+        for (entry, first_link) in self.map_ordered(prepare, select(entries)):
+            if first_link is not None:
+                entry.digest = first_link.digest
+                entry.partial_digests = first_link.partial_digests
+
+            yield entry
+
+    def check_stopped(self):
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise OperationStopped()
+
+    def get_digest(self, entry):
+        if self.progress is not None:
+            self.progress.current = entry.path
+
+        reader = CountingBlockReader(self.reader, self.stats, self.progress)
+        if self.digest_cache is not None:
+            digest = self.digest_cache.get_digest(entry, self.algorithm, reader)
+        else:
+            digest = entry.get_digest(self.algorithm, reader)
+        if self.progress is not None and reader.bytes_read:
+            self.bytes_read[entry.path] = (
+                self.bytes_read.get(entry.path, 0) + reader.bytes_read
+            )
 
-    def run(self):
-        size_catalog = FileCatalog(
-            lambda entry: entry.get_size() if entry.get_size() != 0 else None
+        if self.manifest is not None:
+            self.manifest.record_digests(entry)
+
+        return digest
+
+    def get_partial_digest(self, entry):
+        if self.sampler.covers(entry.get_size()):
+            # The sample would read the entire file; take its full digest.
+            return self.get_digest(entry)
+
+        if self.progress is not None:
+            self.progress.current = entry.path
+
+        sampler = CountingContentSampler(self.sampler, self.stats)
+        if self.digest_cache is not None:
+            digest = self.digest_cache.get_partial_digest(entry, sampler)
+        else:
+            digest = entry.get_partial_digest(sampler)
+
+        if self.manifest is not None:
+            self.manifest.record_digests(entry)
+
+        return digest
+
+    def prepare_groups(self, function, groups):
+        """Call function on each entry of each group, as prepare_entries does,
+        and yield each group once all of its entries have been prepared."""
+        pending = collections.deque()
+        # Links to an inode all have the same size, and so fall in the same
+        # group: forget a group's first links once it is yielded, rather than
+        # holding every entry until the last group is prepared.
+        first_links = {}
+
+        def entries():
+            for group in groups:
+                pending.append([group, len(group)])
+                yield from group
+
+        for entry in self.prepare_entries(function, entries(), first_links):
+            pending[0][1] -= 1
+            if pending[0][1] == 0:
+                group = pending.popleft()[0]
+                for member in group:
+                    inode = member.get_inode()
+                    if inode is not None and first_links.get(inode) is member:
+                        del first_links[inode]
+
+                yield group
+
+    def split_groups(self, idfunc, groups):
+        """Yield the groups of entries within each group that share a key."""
+        for group in groups:
+            catalog = FileCatalog(idfunc)
+            for entry in group:
+                catalog.add_entry(entry)
+
+            yield from catalog.get_groups()
+
+    def prefilter_groups(self, groups):
+        """Split groups by the sample digests of their entries, counting the bytes
+        that need not be read in full."""
+
+        def idfunc(entry):
+            return (entry.get_size(), self.get_partial_digest(entry))
+
+        for group in self.prepare_groups(self.get_partial_digest, groups):
+            survivors = list(self.split_groups(idfunc, [group]))
+            size = group[0].get_size()
+            remaining = {id(entry) for g in survivors for entry in g}
+            eliminated = [entry for entry in group if id(entry) not in remaining]
+            if not self.sampler.covers(size):
+                # The samples of the eliminated files were read all the same.
+                regions = self.sampler.get_regions(size)
+                unread = size - sum(length for (offset, length) in regions)
+                self.stats.increment("bytes_avoided", len(eliminated) * unread)
+            self.settle_progress(eliminated)
+
+            yield from survivors
+
+    def settle_progress(self, entries, bytes_read=0):
+        """Count entries, all of the same size, as processed, crediting progress
+        with those of their bytes not already counted as read (bytes_read, plus
+        any read for their digests)."""
+        if self.progress is None or not entries:
+            return
+
+        bytes_read += sum(self.bytes_read.pop(entry.path, 0) for entry in entries)
+        unread = len(entries) * entries[0].get_size() - bytes_read
+        self.progress.advance(max(unread, 0), len(entries))
+
+    def track_progress(self, groups):
+        """Yield groups, counting them as processed."""
+        for group in groups:
+            self.settle_progress(group)
+            yield group
+
+    def compare(self, comparator, group):
+        """Split group by content with comparator, counting it as processed."""
+        self.check_stopped()
+        if self.progress is None:
+            return comparator.get_groups(group, self.stats)
+
+        self.progress.current = group[0].path
+        progress = CountingProgress(self.progress)
+        groups = comparator.get_groups(group, self.stats, progress)
+        self.settle_progress(group, progress.bytes_done)
+
+        return groups
+
+    def candidate_groups(self, groups):
+        """Yield the groups of files with the same size from a catalog's groups."""
+        for group in self.stats.timed("group", groups):
+            self.stats.increment("size_groups")
+            self.stats.increment("candidate_files", len(group))
+            yield group
+
+    def find_duplicates(self, candidates):
+        """Yield confirmed groups of duplicate files from candidate groups of
+        files with the same size, one group at a time."""
+        logger = logging.getLogger(__name__)
+        groups = iter(candidates)
+
+        # Optional intermediate pass: split candidate groups by a digest of
+        # a small sample of each file, so that only the survivors are read
+        # in full.
+        if self.sampler is not None:
+            groups = self.prefilter_groups(groups)
+
+        # Second pass: use SHA digest (or a direct comparison of contents)
+        # to confirm duplicate entries.
+        if self.comparator is not None:
+            groups = itertools.chain.from_iterable(
+                self.map_ordered(
+                    lambda group: self.compare(self.comparator, group), groups
+                )
+            )
+        else:
+            groups = self.split_groups(
+                lambda entry: (entry.get_size(), self.get_digest(entry)),
+                self.track_progress(self.prepare_groups(self.get_digest, groups)),
+            )
+
+            if not self.algorithm.cryptographic:
+                # Checksums collide too easily to be trusted on their own.
+                logger.info("Confirming %s matches by content.", self.algorithm.name)
+                comparator = BlockComparator()
+                groups = itertools.chain.from_iterable(
+                    self.map_ordered(
+                        lambda group: comparator.get_groups(group, self.stats), groups
+                    )
+                )
+
+        return groups
+
+    def resolve_group(self, g):
+        """Run a confirmed duplicate group through our chain of resolvers,
+        returning the lists of original and duplicate files."""
+        logger = logging.getLogger(__name__)
+        logger.debug(
+            "Attempting to resolve group of %d duplicate files:\n%s",
+            len(g),
+            "\n".join(map(operator.attrgetter("path"), g)),
         )
+        originals = g
+        group_duplicates = []
+
+        for r in self.resolvers:
+            logger.debug("Applying resolver %s.", r)
+            (originals, duplicates) = r.resolve(originals)
+            self.stats.record_resolution(r, originals, duplicates)
+            logger.debug(
+                "Resolver found duplicates:\n%s\n and originals:\n%s",
+                "\n".join(map(operator.attrgetter("path"), duplicates)),
+                "\n".join(map(operator.attrgetter("path"), originals)),
+            )
+
+            if len(originals) > 0:
+                group_duplicates.extend(duplicates)
+                if len(originals) == 1:
+                    # Narrowed to a single original file. Stop running resolvers
+                    # on this group.
+                    break
+            else:
+                # If the resolver identified all of the files as duplicates,
+                # reset and punt to the next resolver.
+                originals = duplicates
+
+        self.stats.increment("duplicate_groups")
+        if len(originals) > 1:
+            self.stats.increment("unresolved_groups")
+            logger.info(
+                "Marking files as originals (unable to resolve duplicates):\n%s",
+                "\n".join(map(operator.attrgetter("path"), originals)),
+            )
+        else:
+            logger.debug("Marking file as original:\n%s", originals[0].path)
+
+        # Record an original for each duplicate, for sinks that need one.
+        for d in group_duplicates:
+            d.original = originals[0]
+
+        return (originals, group_duplicates)
+
+    def resolve_groups(self, groups, catalog):
+        """Resolve each of groups as resolve_group() does, applying each resolver
+        to all of the groups still unresolved at once. Sort-based resolvers with a
+        column in a columnar catalog compare ranks from the catalog."""
+        logger = logging.getLogger(__name__)
+        originals = list(groups)
+        group_duplicates = [[] for g in groups]
+        pending = list(range(len(groups)))
+
+        for r in self.resolvers:
+            if not pending:
+                break
+
+            logger.debug("Applying resolver %s to %d groups.", r, len(pending))
+            if self.columnar and getattr(r, "column", None) is not None:
+                results = r.resolve_columnar([originals[i] for i in pending], catalog)
+            else:
+                results = r.resolve_many([originals[i] for i in pending])
+
+            unresolved = []
+            for (i, (group_originals, duplicates)) in zip(pending, results):
+                self.stats.record_resolution(r, group_originals, duplicates)
+                if len(group_originals) > 0:
+                    group_duplicates[i].extend(duplicates)
+                    originals[i] = group_originals
+                    if len(group_originals) > 1:
+                        unresolved.append(i)
+                else:
+                    # All of the files were identified as duplicates. Reset and
+                    # punt to the next resolver.
+                    originals[i] = duplicates
+                    unresolved.append(i)
+
+            pending = unresolved
+
+        for (group_originals, duplicates) in zip(originals, group_duplicates):
+            self.stats.increment("duplicate_groups")
+            if len(group_originals) > 1:
+                self.stats.increment("unresolved_groups")
+                logger.info(
+                    "Marking files as originals (unable to resolve duplicates):\n%s",
+                    "\n".join(map(operator.attrgetter("path"), group_originals)),
+                )
+            for d in duplicates:
+                d.original = group_originals[0]
+
+        return list(zip(originals, group_duplicates))
+
+    def resolve_all(self, groups, catalog):
+        """Yield (originals, duplicates) for each group. If all of our resolvers
+        allow it, groups are resolved in batches of RESOLVE_BATCH_SIZE."""
+        if not all(r.batched for r in self.resolvers):
+            for g in groups:
+                yield self.resolve_group(g)
+            return
+
+        groups = iter(groups)
+        while True:
+            batch = list(itertools.islice(groups, RESOLVE_BATCH_SIZE))
+            if not batch:
+                break
+
+            for result in self.resolve_groups(batch, catalog):
+                yield result
+
+    def build_catalog(self):
+        with self.stats.phase("walk"):
+            return self.walk_sources()
+
+    def walk_sources(self):
+        if self.columnar:
+            size_catalog = ColumnarFileCatalog()
+        elif self.memory_limit is not None:
+            size_catalog = SpillingFileCatalog(
+                lambda entry: entry.get_size() if entry.get_size() != 0 else None,
+                max_entries=max(self.memory_limit // SPILL_ENTRY_SIZE, 1),
+            )
+        else:
+            size_catalog = FileCatalog(
+                lambda entry: entry.get_size() if entry.get_size() != 0 else None
+            )
+        if self.collapse_links:
+            # Treat all links to an inode as a single file: only the first link
+            # found is considered.
+            size_catalog.identityfunc = lambda entry: entry.get_inode() or entry.path
+        elif not any(
+            a is not b and a.contains(b) for a in self.sources for b in self.sources
+        ):
+            # No file can be reached through more than one source, so there is
+            # no need to hold every path in memory to detect repeats.
+            size_catalog.identityfunc = None
         logger = logging.getLogger(__name__)
 
         # Initial pass through the file tree. Identify candidate duplicate
         # groups by equality of file size in bytes.
         logger.info("Building file catalog...")
+        ctx = size_catalog
+        if self.manifest is not None:
+            # Record every file, seeding the digests of unchanged files.
+            self.manifest.catalog = size_catalog
+            ctx = self.manifest
+        if self.stop_event is not None:
+            ctx = StoppingContext(ctx, self.stop_event)
+
         for s in self.sources:
             logger.info("Walking source %d at %s", s.order, s.path)
-            s.walk(size_catalog)
+            s.walk(ctx, stats=self.stats)
+
+        if self.manifest is not None:
+            self.stats.increment("manifest_new", self.manifest.new)
+            self.stats.increment("manifest_changed", self.manifest.changed)
+            self.stats.increment("manifest_unchanged", self.manifest.unchanged)
+            logger.info(
+                "Manifest: %d new, %d changed, %d unchanged and %d deleted files.",
+                self.manifest.new,
+                self.manifest.changed,
+                self.manifest.unchanged,
+                len(self.manifest.get_deleted()),
+            )
 
-        # Second pass: use SHA digest to confirm duplicate entries.
-        logger.info("Identifying duplicate file groups...")
+        return size_catalog
+
+    def sink_files(self, files):
+        """Pass files to the sink, counting the operations that fail."""
+        failures = getattr(self.sink, "failures", 0)
+        with self.stats.phase("sink"):
+            self.sink.sink(files)
+
+        self.stats.increment("sink_batches")
+        self.stats.increment("files_sunk", len(files))
+        self.stats.increment(
+            "sink_failures", getattr(self.sink, "failures", 0) - failures
+        )
+
+    def record_cache_stats(self, hits, misses):
+        """Count the digest cache lookups made since it had hits and misses."""
+        self.stats.increment("digest_cache_hits", self.digest_cache.hits - hits)
+        self.stats.increment("digest_cache_misses", self.digest_cache.misses - misses)
 
-        f = FileCatalog(lambda entry: entry.get_digest())
+    def report_changes(self):
+        logger = logging.getLogger(__name__)
+        (added, dissolved) = self.manifest.get_changes()
+        logger.info(
+            "%d duplicate groups added and %d dissolved since the last scan.",
+            len(added),
+            len(dissolved),
+        )
+        for group in added:
+            logger.info("Added duplicate group:\n%s", "\n".join(group))
+        for group in dissolved:
+            logger.info("Dissolved duplicate group:\n%s", "\n".join(group))
 
-        for entry in itertools.chain(*size_catalog.get_groups()):
-            f.add_entry(entry)
+    def run(self):
+        if self.profiler is None:
+            self.deduplicate()
+            return
+
+        self.profiler.start(self.stats)
+        try:
+            self.deduplicate()
+        finally:
+            self.profiler.stop(self.stats)
+
+    def deduplicate(self):
+        self.stats.start()
+        if self.digest_cache is not None:
+            cache_counts = (self.digest_cache.hits, self.digest_cache.misses)
+
+        size_catalog = self.build_catalog()
+        logger = logging.getLogger(__name__)
+        with self.stats.phase("group"):
+            candidates = size_catalog.get_groups()
 
-        # Run confirmed duplicate groups through our chain of resolvers.
+        # Confirm, resolve, and sink duplicate groups as they are found.
+        # Duplicates are passed to the sink in batches of sink_batch_size, so
+        # that they need not all be held in memory and so that the work done
+        # is applied as we go.
+        logger.info("Identifying duplicate file groups...")
         to_sink = []
+        total = 0
 
-        for g in f.get_groups():
-            logger.debug(
-                "Attempting to resolve group of %d duplicate files:\n%s",
-                len(g),
-                "\n".join(map(operator.attrgetter("path"), g)),
+        if self.progress is not None:
+            if isinstance(candidates, list):
+                self.progress.start(
+                    sum(len(g) * g[0].get_size() for g in candidates),
+                    sum(len(g) for g in candidates),
+                )
+            else:
+                # Groups are merged from disk as they are read; their total
+                # size is not known in advance.
+                self.progress.start()
+
+        groups = self.stats.timed(
+            "hash", self.find_duplicates(self.candidate_groups(candidates))
+        )
+        try:
+            for (originals, duplicates) in self.stats.timed(
+                "resolve", self.resolve_all(groups, size_catalog)
+            ):
+                if self.manifest is not None:
+                    self.manifest.add_group(originals + duplicates)
+                to_sink.extend(duplicates)
+
+                if self.sink_batch_size and len(to_sink) >= self.sink_batch_size:
+                    self.sink_files(to_sink)
+                    total += len(to_sink)
+                    to_sink = []
+        finally:
+            if self.progress is not None:
+                self.progress.stop()
+
+        # Appropriately discard all of the remaining identified duplicate files.
+        if to_sink:
+            self.sink_files(to_sink)
+            total += len(to_sink)
+
+        if self.digest_cache is not None:
+            self.digest_cache.flush()
+            self.record_cache_stats(*cache_counts)
+            logger.info(
+                "Digest cache: %d hits, %d misses.",
+                self.digest_cache.hits,
+                self.digest_cache.misses,
+            )
+
+        if self.manifest is not None:
+            self.report_changes()
+
+        self.stats.stop()
+        logger.info("Time by phase: %s.", self.stats.summary())
+        logger.info("Finished. %d duplicate files located.", total)
+
+    def scan(self):
+        """Walk the sources and compute the full digest of every file, recording
+        them in self.manifest, without resolving or sinking anything. Each node
+        of a multi-node run scans its own sources; their manifests are then
+        combined by a MergedDeduplicateOperation."""
+        if self.manifest is None:
+            raise ValueError("Scanning requires a manifest.")
+
+        logger = logging.getLogger(__name__)
+        self.stats.start()
+        if self.digest_cache is not None:
+            cache_counts = (self.digest_cache.hits, self.digest_cache.misses)
+
+        # Any non-empty file may have a duplicate on another node.
+        catalog = FileCatalog(lambda entry: entry.get_size() or None)
+        self.manifest.catalog = catalog
+        with self.stats.phase("walk"):
+            for s in self.sources:
+                logger.info("Walking source %d at %s", s.order, s.path)
+                s.walk(self.manifest, stats=self.stats)
+
+        entries = list(itertools.chain.from_iterable(catalog.store.values()))
+
+        def digest(entry):
+            try:
+                self.get_digest(entry)
+            except OSError as e:
+                logger.warning("Unable to hash file %s: %s", entry.path, e)
+
+        logger.info("Hashing %d files...", len(entries))
+        if self.progress is not None:
+            self.progress.start(sum(e.get_size() for e in entries), len(entries))
+        try:
+            for entry in self.stats.timed(
+                "hash", self.prepare_entries(digest, entries)
+            ):
+                # Later links to an inode take the digest of the first.
+                self.manifest.record_digests(entry)
+                self.settle_progress([entry])
+        finally:
+            if self.progress is not None:
+                self.progress.stop()
+
+        if self.digest_cache is not None:
+            self.digest_cache.flush()
+            self.record_cache_stats(*cache_counts)
+
+        self.stats.stop()
+        logger.info("Time by phase: %s.", self.stats.summary())
+        logger.info("Finished. %d files scanned.", len(entries))
+
+    async def groups(self, hash_concurrency=None, queue_size=16, executor=None):
+        """Find, resolve and sink duplicate groups without blocking the event loop,
+        yielding an (originals, duplicates) pair for each group once its
+        duplicates have been sunk.
+
+        Walking, hashing, resolving and sinking run as concurrent stages connected
+        by queues of at most queue_size items, so that slow consumers hold up the
+        stages before them. Blocking work runs on executor (by default, a private
+        thread pool). Up to hash_concurrency size groups (by default, self.jobs)
+        are confirmed at once, so groups are not necessarily produced in the order
+        run() would process them. Closing or cancelling the consumer cancels all
+        of the stages: work not yet started is abandoned, and walking and hashing
+        already under way stop before the next file."""
+        # Python 3.6 has no get_running_loop().
+        loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)()
+        hash_concurrency = hash_concurrency or self.jobs
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ThreadPoolExecutor(hash_concurrency + 2)
+
+        # Each size group is confirmed serially; concurrency comes from running
+        # several confirmation stages at once.
+        serial = copy.copy(self)
+        serial.jobs = 1
+        stop = serial.stop_event = threading.Event()
+
+        candidates = asyncio.Queue(queue_size)
+        confirmed = asyncio.Queue(queue_size)
+        resolved = asyncio.Queue(queue_size)
+        output = asyncio.Queue(queue_size)
+
+        self.stats.start()
+        if self.digest_cache is not None:
+            cache_counts = (self.digest_cache.hits, self.digest_cache.misses)
+
+        def blocking(function, *args):
+            return loop.run_in_executor(executor, function, *args)
+
+        async def walk():
+            size_catalog = await blocking(serial.build_catalog)
+            # Groups may be read back from disk as they are iterated.
+            groups = self.candidate_groups(
+                await blocking(self.stats.call, "group", size_catalog.get_groups)
             )
-            originals = g
-
-            for r in self.resolvers:
-                logger.debug("Applying resolver %s.", r)
-                (originals, duplicates) = r.resolve(originals)
-                logger.debug(
-                    "Resolver found duplicates:\n%s\n and originals:\n%s",
-                    "\n".join(map(operator.attrgetter("path"), duplicates)),
-                    "\n".join(map(operator.attrgetter("path"), originals)),
+            while True:
+                group = await blocking(next, groups, None)
+                if group is None:
+                    break
+                await candidates.put(group)
+            for i in range(hash_concurrency):
+                await candidates.put(None)
+
+        async def confirm():
+            while True:
+                group = await candidates.get()
+                if group is None:
+                    break
+
+                groups = await blocking(
+                    lambda: list(
+                        serial.stats.timed("hash", serial.find_duplicates([group]))
+                    )
                 )
+                for g in groups:
+                    await confirmed.put(g)
 
-                if len(originals) > 0:
-                    to_sink.extend(duplicates)
-                    if len(originals) == 1:
-                        # Narrowed to a single original file. Stop running resolvers
-                        # on this group.
-                        break
+            await confirmed.put(None)
+
+        async def resolve():
+            remaining = hash_concurrency
+            while remaining:
+                g = await confirmed.get()
+                if g is None:
+                    remaining -= 1
                 else:
-                    # If the resolver identified all of the files as duplicates,
-                    # reset and punt to the next resolver.
-                    originals = duplicates
+                    result = await blocking(
+                        self.stats.call, "resolve", self.resolve_group, g
+                    )
+                    if self.manifest is not None:
+                        self.manifest.add_group(result[0] + result[1])
+                    await resolved.put(result)
+
+            if self.manifest is not None:
+                self.report_changes()
+            await resolved.put(None)
+
+        async def sink():
+            batch = []
+            to_sink = []
+            while True:
+                item = await resolved.get()
+                if item is not None:
+                    batch.append(item)
+                    to_sink.extend(item[1])
 
-            if len(originals) > 1:
-                logger.info(
-                    "Marking files as originals (unable to resolve duplicates):\n%s",
-                    "\n".join(map(operator.attrgetter("path"), originals)),
+                if item is None or (
+                    self.sink_batch_size and len(to_sink) >= self.sink_batch_size
+                ):
+                    if to_sink:
+                        await blocking(self.sink_files, to_sink)
+                    for result in batch:
+                        await output.put(result)
+                    batch = []
+                    to_sink = []
+
+                if item is None:
+                    break
+
+            await output.put(None)
+
+        async def supervise(stage):
+            try:
+                await stage()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await output.put(e)
+
+        stages = [walk, resolve, sink] + [confirm] * hash_concurrency
+        tasks = [asyncio.ensure_future(supervise(stage)) for stage in stages]
+
+        try:
+            while True:
+                item = await output.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                yield item
+        finally:
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if self.digest_cache is not None:
+                await blocking(self.digest_cache.flush)
+                self.record_cache_stats(*cache_counts)
+            if own_executor and sys.version_info >= (3, 9):
+                executor.shutdown(wait=False, cancel_futures=True)
+            elif own_executor:
+                executor.shutdown(wait=False)
+            self.stats.stop()
+
+
+class MergedDeduplicateOperation(DeduplicateOperation):
+    """Find and resolve duplicates across several nodes, from the manifests that
+    each node's scan() recorded, without reading any files. sources are the
+    ManifestSources returned by ManifestSource.load_all(). With a
+    PlanDuplicateFileSink, each node is then given a plan for its own
+    duplicates, so that no file's contents ever leave its node."""
+
+    def __init__(self, sources, resolvers, sink, **kwargs):
+        if sources:
+            kwargs.setdefault("algorithm", sources[0].algorithm)
+        super(MergedDeduplicateOperation, self).__init__(
+            sources, resolvers, sink, **kwargs
+        )
+
+        if any(s.algorithm.name != self.algorithm.name for s in sources):
+            raise ValueError(
+                "The manifests do not use the {} digest algorithm.".format(
+                    self.algorithm.name
                 )
+            )
+        if (
+            self.sampler is not None
+            or self.comparator is not None
+            or self.digest_cache is not None
+            or self.manifest is not None
+        ):
+            raise ValueError("Manifests are merged without reading any files.")
+
+
+class InotifyWatcher:
+    """Report changes to files in watched directories, through Linux's inotify
+    API. Directories are not watched recursively: each must be added."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    MASK = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_ONLYDIR
+        | IN_DONT_FOLLOW
+    )
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise ValueError("Watching for changes is only supported on Linux.")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self.raise_error()
+
+        self.watches = {}
+        self.paths = {}
+
+    def raise_error(self, path=None):
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            self.raise_error(path)
+
+        self.watches[wd] = path
+        self.paths[path] = wd
+
+    def remove_tree(self, path):
+        """Stop watching path and the directories beneath it."""
+        prefix = os.path.join(path, "")
+        for (watched, wd) in list(self.paths.items()):
+            if watched == path or watched.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.paths[watched]
+                self.watches.pop(wd, None)
+
+    def read_events(self, timeout=None):
+        """Wait up to timeout seconds for events, returning a list of (path, mask)
+        pairs. If the kernel's queue overflowed, the path is None."""
+        (readable, writable, errors) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & self.IN_IGNORED:
+                # The watch was removed, or its directory deleted.
+                path = self.watches.pop(wd, None)
+                if path is not None and self.paths.get(path) == wd:
+                    del self.paths[path]
+            elif wd in self.watches:
+                directory = self.watches[wd]
+                events.append(
+                    (os.path.join(directory, name) if name else directory, mask)
+                )
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchedDeduplicateOperation(DeduplicateOperation):
+    """A DeduplicateOperation that, after an initial scan, follows changes to
+    its sources as they happen, resolving and sinking duplicate groups as they
+    appear.
+
+    Changes are applied once no further events have arrived for settle seconds,
+    or once the first of them has waited max_latency seconds, so that a tree
+    that never stops changing is still processed. Only the size groups of new
+    and changed files are confirmed, and only the files not already hashed are
+    read."""
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(
+        self,
+        *args,
+        settle=1.0,
+        max_latency=10.0,
+        watcher_class=InotifyWatcher,
+        **kwargs
+    ):
+        super(WatchedDeduplicateOperation, self).__init__(*args, **kwargs)
+        if self.columnar or self.memory_limit is not None:
+            raise ValueError("Watching requires the default in-memory catalog.")
+        if self.manifest is not None:
+            raise ValueError("Watching cannot be combined with a manifest.")
+
+        self.settle = settle
+        self.max_latency = max_latency
+        self.watcher_class = watcher_class
+        self.watcher = None
+        # Files by path and by size, the source of each watched directory, and
+        # the identity of each duplicate sunk that remains in place.
+        self.files = {}
+        self.store = {}
+        self.directories = {}
+        self.sunk = {}
+        self.added = []
+
+    def get_identity(self, st):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def add_entry(self, entry):
+        if entry.get_size() == 0 or entry.path in self.files:
+            return
+
+        self.files[entry.path] = entry
+        self.store.setdefault(entry.get_size(), []).append(entry)
+        # Changes made by our own sink need not be considered again.
+        if self.sunk.get(entry.path) != self.get_identity(entry.stat):
+            self.added.append(entry)
+
+    def remove_path(self, path):
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            group = self.store[entry.get_size()]
+            group.remove(entry)
+            if not group:
+                del self.store[entry.get_size()]
+
+    def watch_tree(self, source, path):
+        """Watch each directory in the tree at path that source descends into."""
+        for (cwd, subdirs, files) in os.walk(path):
+            self.directories.setdefault(cwd, source)
+            try:
+                self.watcher.add_watch(cwd)
+            except OSError as e:
+                logging.getLogger(__name__).warning(
+                    "Unable to watch directory %s: %s", cwd, e
+                )
+
+            rules = source.get_ignore_rules(cwd, files)
+            subdirs[:] = [d for d in subdirs if source.includes(d, cwd, True, rules)]
+
+    def add_tree(self, path):
+        (directory, name) = os.path.split(path)
+        source = self.directories.get(directory)
+        if source is not None and source.includes(
+            name, directory, True, source.get_ignore_rules(directory)
+        ):
+            self.watch_tree(source, path)
+            source.walk(self, path, self.stats)
+
+    def remove_tree(self, path):
+        prefix = os.path.join(path, "")
+        for p in [p for p in self.files if p.startswith(prefix)]:
+            self.remove_path(p)
+        for p in [p for p in self.directories if p == path or p.startswith(prefix)]:
+            del self.directories[p]
+        self.watcher.remove_tree(path)
+
+    def refresh(self, path):
+        """Replace the entry for the file at path with one for its current state."""
+        self.remove_path(path)
+
+        (directory, name) = os.path.split(path)
+        source = self.directories.get(directory)
+        if source is None or not source.includes(
+            name, directory, False, source.get_ignore_rules(directory)
+        ):
+            return
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        if stat.S_ISREG(st.st_mode):
+            if source.compact:
+                self.add_entry(CompactFileEntry(path, source, st))
+            else:
+                self.add_entry(FileEntry(path, source, st))
+
+    def rescan(self):
+        """Rebuild the catalog from scratch, keeping the digests of files that are
+        unchanged. Used when the kernel has dropped events."""
+        previous = self.files
+        # Files added but not yet processed have no digests to keep; the walk
+        # adds them again.
+        for entry in self.added:
+            previous.pop(entry.path, None)
+        self.added = []
+        self.files = {}
+        self.store = {}
+        for s in self.sources:
+            self.watch_tree(s, s.path)
+            s.walk(self, stats=self.stats)
+
+        changed = []
+        for entry in self.added:
+            old = previous.get(entry.path)
+            if (
+                old is not None
+                and old.digest is not None
+                and self.get_identity(old.stat) == self.get_identity(entry.stat)
+            ):
+                entry.digest = old.digest
+                entry.partial_digests = old.partial_digests
             else:
-                logger.debug("Marking file as original:\n%s", originals[0].path)
+                changed.append(entry)
 
-        # Appropriately discard all of the identified duplicate files.
-        logger.info("Finished. %d duplicate files located.", len(to_sink))
-        self.sink.sink(to_sink)
+        self.added = changed
+
+    def process(self):
+        """Confirm, resolve and sink the duplicate groups that include any file
+        added since the last call."""
+        logger = logging.getLogger(__name__)
+        added = set(map(id, self.added))
+        groups = [
+            list(self.store[size])
+            for size in {entry.get_size() for entry in self.added}
+            if len(self.store.get(size, [])) > 1
+        ]
+        self.added = []
+
+        to_sink = []
+        for g in self.find_duplicates(groups):
+            if any(id(entry) in added for entry in g):
+                (originals, duplicates) = self.resolve_group(g)
+                to_sink.extend(
+                    d
+                    for d in duplicates
+                    if self.sunk.get(d.path) != self.get_identity(d.stat)
+                )
+
+        if to_sink:
+            logger.info("Found %d new duplicate files.", len(to_sink))
+            self.sink_files(to_sink)
+            for d in to_sink:
+                try:
+                    self.sunk[d.path] = self.get_identity(os.stat(d.path))
+                except OSError:
+                    self.sunk.pop(d.path, None)
+
+        if self.digest_cache is not None:
+            self.digest_cache.flush()
+
+    def apply(self, events):
+        for (path, mask) in events:
+            if path is None:
+                self.rescan()
+            elif mask & InotifyWatcher.IN_ISDIR:
+                if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+                    self.add_tree(path)
+                else:
+                    self.remove_tree(path)
+            elif mask & InotifyWatcher.IN_DELETE_SELF:
+                self.remove_tree(path)
+            elif mask & (InotifyWatcher.IN_MOVED_FROM | InotifyWatcher.IN_DELETE):
+                self.remove_path(path)
+                self.sunk.pop(path, None)
+            else:
+                self.refresh(path)
+
+    def watch(self, stop=None):
+        """Scan the sources, then follow changes to them until stop (a
+        threading.Event) is set."""
+        logger = logging.getLogger(__name__)
+        self.watcher = self.watcher_class()
+        self.stats.start()
+
+        try:
+            # Watch before scanning, so that no change is missed.
+            for s in self.sources:
+                logger.info("Walking and watching source %d at %s", s.order, s.path)
+                self.watch_tree(s, s.path)
+                s.walk(self, stats=self.stats)
+            self.process()
+
+            logger.info("Watching for changes...")
+            events = []
+            first = last = time.monotonic()
+            while stop is None or not stop.is_set():
+                received = self.watcher.read_events(self.POLL_INTERVAL)
+                now = time.monotonic()
+                if received:
+                    if not events:
+                        first = now
+                    events.extend(received)
+                    last = now
+
+                if events and (
+                    now - last >= self.settle or now - first >= self.max_latency
+                ):
+                    self.apply(events)
+                    events = []
+                    self.process()
+        finally:
+            self.watcher.close()
+            self.stats.stop()
+            if self.digest_cache is not None:
+                self.digest_cache.flush()
@@ -1,34 +1,80 @@
+import asyncio
+import errno
+import gc
 import hashlib
 import io
+import json
 import os
+import pstats
 import re
+import shutil
+import sys
 import tempfile
+import threading
+import time
 import unittest
 import unittest.mock
+import zlib
 
 from dedupe_trees import (
     AttrBasedDuplicateResolver,
+    AutoTuningBlockReader,
+    BlockComparator,
+    BlockReader,
+    ColumnarFileCatalog,
+    CompactFileEntry,
+    CompiledMatcher,
     ConfiguredSourceFilter,
+    ContentSampler,
     CopyPatternDuplicateResolver,
     DeduplicateOperation,
     DeleteDuplicateFileSink,
+    DuplicatePlan,
+    DigestCache,
     DuplicateFileSink,
     DuplicateResolver,
     FileCatalog,
     FileEntry,
     FilenameSortDuplicateResolver,
+    HashAlgorithm,
+    IgnoreRules,
+    InotifyWatcher,
     InteractiveDuplicateResolver,
+    LinkDuplicateFileSink,
+    ManifestEntry,
+    ManifestSource,
+    ManifestStat,
+    MergedDeduplicateOperation,
     ModificationDateDuplicateResolver,
+    OperationStats,
+    OperationStopped,
     OutputOnlyDuplicateFileSink,
     PathLengthDuplicateResolver,
+    PhaseProfiler,
+    PlanDuplicateFileSink,
+    ProgressReporter,
+    SamplingProfiler,
+    ScanManifest,
     SequesterDuplicateFileSink,
     SortBasedDuplicateResolver,
     Source,
     SourceOrderDuplicateResolver,
+    SUPPORTS_DIR_FD,
+    SpillingFileCatalog,
     UserCanceledException,
+    WatchedDeduplicateOperation,
+    ZlibChecksum,
+    get_hash_algorithm,
+    hash_algorithms,
     join_paths_componentwise,
+    select_fastest_hash_algorithm,
 )
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
 # Dummy/stub objects for testing
 
 
@@ -41,12 +87,15 @@ class DummyEntry:
     def __repr__(self):
         return self.path
 
-    def get_digest(self):
+    def get_digest(self, algorithm=None, reader=None):
         return self.digest
 
     def get_size(self):
         return self.digest
 
+    def get_inode(self):
+        return None
+
     def __eq__(self, other):
         if type(other) is type(self):
             return self.path == other.path and self.source == other.source
@@ -60,7 +109,7 @@ class DummySource(Source):
         self.path = "TestSource"
         self.order = 1
 
-    def walk(self, ctx):
+    def walk(self, ctx, path=None, stats=None):
         for f in self.files:
             ctx.add_entry(f)
 
@@ -73,6 +122,25 @@ class DummySink(DuplicateFileSink):
         self.sunk.extend(files)
 
 
+class DummyWatcher:
+    def __init__(self):
+        self.watched = set()
+
+    def add_watch(self, path):
+        self.watched.add(path)
+
+    def remove_tree(self, path):
+        self.watched = {
+            p for p in self.watched if p != path and not p.startswith(path + os.sep)
+        }
+
+    def read_events(self, timeout=None):
+        return []
+
+    def close(self):
+        pass
+
+
 class DummyResolver(DuplicateResolver):
     def __init__(self, key):
         self.key = key
@@ -171,6 +239,26 @@ class test_SortBasedDuplicateResolver(unittest.TestCase):
 
         self.assertEqual(r, (["test", "test", "test"], []))
 
+    def test_ResolveMany(self):
+        groups = [
+            ["test", "here", "strings", "here"],
+            ["b", "c", "a", "d"],
+            ["test"],
+            ["same", "same"],
+            [],
+        ]
+        rank = unittest.mock.Mock(side_effect=lambda x: x)
+        self.s.rank_function = rank
+
+        for reverse in [False, True]:
+            self.s.reverse = reverse
+            expected = [self.s.resolve(g) for g in groups]
+            rank.reset_mock()
+
+            self.assertEqual(expected, self.s.resolve_many(groups))
+            # Each entry is ranked exactly once.
+            self.assertEqual(11, rank.call_count)
+
 
 class test_AttrBasedDuplicateResolver(unittest.TestCase):
     def setUp(self):
@@ -284,11 +372,11 @@ class test_ModificationDateDuplicateResolver(unittest.TestCase):
         file_three = DummyEntry("test3")
 
         file_one.stat = DummyEntry("foo")
-        setattr(file_one.stat, "st_mtime", 3)
+        setattr(file_one.stat, "st_mtime_ns", 3)
         file_two.stat = DummyEntry("foo")
-        setattr(file_two.stat, "st_mtime", 2)
+        setattr(file_two.stat, "st_mtime_ns", 2)
         file_three.stat = DummyEntry("foo")
-        setattr(file_three.stat, "st_mtime", 1)
+        setattr(file_three.stat, "st_mtime_ns", 1)
 
         (originals, duplicates) = ModificationDateDuplicateResolver().resolve(
             [file_one, file_two, file_three]
@@ -421,6 +509,44 @@ class test_FileEntry(unittest.TestCase):
         self.assertEqual(h.hexdigest(), entry.get_digest())
 
 
+class test_ContentSampler(unittest.TestCase):
+    def test_ContentSampler_Regions(self):
+        self.assertEqual([(0, 10)], ContentSampler(10).get_regions(100))
+        self.assertEqual([(0, 10), (90, 10)], ContentSampler(10, True).get_regions(100))
+        self.assertEqual(
+            [(0, 10), (45, 10), (90, 10)], ContentSampler(10, True, 1).get_regions(100)
+        )
+        # Overlapping regions are merged
+        self.assertEqual([(0, 15)], ContentSampler(10, True).get_regions(15))
+        self.assertEqual([(0, 8)], ContentSampler(10, True, 3).get_regions(8))
+
+    def test_ContentSampler_Key(self):
+        self.assertEqual(ContentSampler(10).key, ContentSampler(10).key)
+        self.assertNotEqual(ContentSampler(10).key, ContentSampler(10, True).key)
+        self.assertNotEqual(ContentSampler(10).key, ContentSampler(20).key)
+
+
+class test_HashAlgorithms(unittest.TestCase):
+    def test_ZlibChecksum(self):
+        c = ZlibChecksum(zlib.crc32, 0)
+        c.update(b"Test")
+        c.update(b"Data")
+        self.assertEqual("{:08x}".format(zlib.crc32(b"TestData")), c.hexdigest())
+
+        c = ZlibChecksum(zlib.adler32, 1)
+        c.update(b"TestData")
+        self.assertEqual("{:08x}".format(zlib.adler32(b"TestData")), c.hexdigest())
+
+    def test_get_hash_algorithm(self):
+        self.assertEqual("blake2b", get_hash_algorithm("blake2b").name)
+        self.assertFalse(get_hash_algorithm("crc32").cryptographic)
+        self.assertTrue(get_hash_algorithm("auto").cryptographic)
+
+    def test_select_fastest_hash_algorithm(self):
+        candidates = [hash_algorithms["md5"], hash_algorithms["sha512"]]
+        self.assertIn(select_fastest_hash_algorithm(candidates, 1 << 16), candidates)
+
+
 class test_FileCatalog(unittest.TestCase):
     def test_FileCatalog(self):
         c = FileCatalog(lambda x: x.get_digest())
@@ -447,6 +573,16 @@ class test_FileCatalog(unittest.TestCase):
             [[file_three, file_four], [file_one, file_two]],
         )
 
+    def test_FileCatalog_NoIdentity(self):
+        c = FileCatalog(lambda x: x.get_digest(), None)
+
+        file_one = DummyEntry("test", "Hash1")
+        c.add_entry(file_one)
+        c.add_entry(file_one)
+
+        self.assertEqual(0, len(c.path_store))
+        self.assertEqual(c.get_groups(), [[file_one, file_one]])
+
     def test_FileCatalog_Exclusions(self):
         c = FileCatalog(lambda entry: None)
 
@@ -457,6 +593,57 @@ class test_FileCatalog(unittest.TestCase):
         self.assertEqual(c.get_groups(), [])
 
 
+class test_SpillingFileCatalog(unittest.TestCase):
+    def get_entries(self):
+        digests = ["Hash3", "Hash1", "Hash2", "Hash1", None, "Hash3", "Hash4"]
+        digests += ["Hash2", "Hash1", "Hash5", "Hash4"]
+
+        return [DummyEntry("file{}".format(i), d) for (i, d) in enumerate(digests)]
+
+    def get_groups(self, catalog, entries):
+        for entry in entries:
+            catalog.add_entry(entry)
+
+        return list(catalog.get_groups())
+
+    def test_SpillingFileCatalog(self):
+        entries = self.get_entries()
+        expected = self.get_groups(FileCatalog(lambda x: x.get_digest()), entries)
+
+        for max_entries in [1, 2, 3, 100]:
+            c = SpillingFileCatalog(lambda x: x.get_digest(), max_entries=max_entries)
+            self.assertEqual(expected, self.get_groups(c, entries))
+
+    def test_SpillingFileCatalog_Spills(self):
+        c = SpillingFileCatalog(lambda x: x.get_digest(), max_entries=4)
+        for entry in self.get_entries():
+            c.add_entry(entry)
+
+        self.assertEqual(2, len(c.runs))
+        self.assertEqual(2, len(c.buffer))
+        self.assertEqual(4, len(list(c.get_groups())))
+        self.assertEqual([], c.runs)
+
+    def test_SpillingFileCatalog_Repeats(self):
+        entries = self.get_entries()
+        entries = entries + entries[:4]
+        expected = self.get_groups(FileCatalog(lambda x: x.get_digest()), entries)
+
+        c = SpillingFileCatalog(lambda x: x.get_digest(), max_entries=3)
+        self.assertEqual(expected, self.get_groups(c, entries))
+
+    def test_SpillingFileCatalog_Sources(self):
+        # Sources are shared, not copied, by entries read back from disk.
+        source = DummySource([])
+        c = SpillingFileCatalog(lambda x: x.get_digest(), max_entries=1)
+        c.add_entry(DummyEntry("file1", "Hash1", source))
+        c.add_entry(DummyEntry("file2", "Hash1", source))
+
+        (group,) = list(c.get_groups())
+        self.assertIs(source, group[0].source)
+        self.assertIs(source, group[1].source)
+
+
 class test_SourceFilter(unittest.TestCase):
     def test_SourceFilter(self):
         names = ["test1"]
@@ -471,6 +658,105 @@ class test_SourceFilter(unittest.TestCase):
         self.assertEqual(False, sf.include_file("test2", "testdir"))
         self.assertEqual(False, sf.include_file("test1", "testdir"))
 
+    def test_SourceFilter_Globs(self):
+        sf = ConfiguredSourceFilter(names=["test1"], globs=["*.tmp", "[0-9]?"])
+
+        self.assertEqual(True, sf.include_file("test", "testdir"))
+        self.assertEqual(True, sf.include_file("tmp", "testdir"))
+        self.assertEqual(True, sf.include_file("1ab", "testdir"))
+        self.assertEqual(False, sf.include_file("test1", "testdir"))
+        self.assertEqual(False, sf.include_file("a.tmp", "testdir"))
+        self.assertEqual(False, sf.include_file("1a", "testdir"))
+
+
+class test_CompiledMatcher(unittest.TestCase):
+    def test_CompiledMatcher(self):
+        m = CompiledMatcher(
+            names=["test1"],
+            patterns=[re.compile("^[0-9]"), ".*[0-9]$"],
+            globs=["*.tmp"],
+        )
+
+        # The patterns and globs are merged into one expression.
+        self.assertEqual(1, len(m.regexes))
+        self.assertEqual(
+            [True, True, True, True, False, False],
+            [
+                m.match(n)
+                for n in ["test1", "1test", "test2", "a.tmp", "test", "a.tmpx"]
+            ],
+        )
+
+    def test_CompiledMatcher_Unmerged(self):
+        # Patterns with groups or their own flags are matched separately.
+        m = CompiledMatcher(patterns=["(a)\\1", "b", "c", "(?i)d"])
+
+        self.assertEqual(3, len(m.regexes))
+        self.assertEqual(
+            [True, False, True, True, True],
+            [m.match(n) for n in ["aa", "ab", "b", "c", "D"]],
+        )
+
+    def test_CompiledMatcher_Cache(self):
+        m = CompiledMatcher(globs=["*.tmp"])
+        for n in ["a.tmp", "b", "a.tmp", "a.tmp"]:
+            m.match(n)
+
+        self.assertEqual(2, m.match.cache_info().hits)
+        self.assertEqual(2, m.match.cache_info().misses)
+
+    def test_CompiledMatcher_Empty(self):
+        self.assertFalse(CompiledMatcher())
+        self.assertFalse(CompiledMatcher().match("test"))
+        self.assertTrue(CompiledMatcher(names=["test"]))
+
+
+class test_IgnoreRules(unittest.TestCase):
+    def test_IgnoreRules(self):
+        r = IgnoreRules(
+            [
+                "# A comment\n",
+                "\n",
+                "*.log\n",
+                "/top\n",
+                "build/\n",
+                "docs/*.md\n",
+                "**/thumbs/*.jpg\n",
+                "cache/**\n",
+                "[!a]z\n",
+                "\\#hash\n",
+            ]
+        )
+
+        for (name, prefix, is_dir, ignored) in [
+            ("a.log", "", False, True),
+            ("a.log", "x/y/", True, True),
+            ("a.logx", "", False, False),
+            ("top", "", False, True),
+            ("top", "x/", False, False),
+            ("build", "x/", True, True),
+            ("build", "x/", False, False),
+            ("a.md", "docs/", False, True),
+            ("a.md", "x/docs/", False, False),
+            ("a.md", "docs/x/", False, False),
+            ("a.jpg", "thumbs/", False, True),
+            ("a.jpg", "x/y/thumbs/", False, True),
+            ("a.jpg", "x/thumbs/y/", False, False),
+            ("a", "cache/x/", False, True),
+            ("bz", "", False, True),
+            ("az", "", False, False),
+            ("#hash", "", False, True),
+            ("A comment", "", False, False),
+        ]:
+            with self.subTest(name=name, prefix=prefix, is_dir=is_dir):
+                self.assertEqual(ignored, r.ignores(name, prefix, is_dir))
+
+    def test_IgnoreRules_Negated(self):
+        with self.assertLogs("dedupe_trees.dedupe_trees", level="WARNING"):
+            r = IgnoreRules(["*.log", "!keep.log"])
+
+        self.assertTrue(r.ignores("keep.log", "", False))
+
 
 class test_DeduplicateOperation(unittest.TestCase):
     def setUp(self):
@@ -498,6 +784,88 @@ class test_DeduplicateOperation(unittest.TestCase):
         )
         self.assertEqual([], self.perform([]))
 
+    def test_DDO_Batches(self):
+        batches = []
+
+        class BatchSink(DuplicateFileSink):
+            def sink(self, files):
+                batches.append(list(files))
+
+        self.so.files.extend(
+            [DummyEntry("test6", digest="test6"), DummyEntry("test7", digest="test6")]
+        )
+        DeduplicateOperation(
+            [self.so], [FilenameSortDuplicateResolver()], BatchSink(), sink_batch_size=2
+        ).run()
+
+        # Groups are never split between batches.
+        self.assertEqual(
+            [["test2", "test3", "test4"], ["test7"]],
+            [[e.path for e in batch] for batch in batches],
+        )
+
+    def test_DDO_Resolve_Many(self):
+        class BatchedResolver(DuplicateResolver):
+            batched = True
+
+            def resolve(self, flist):
+                return (flist[:1], flist[1:])
+
+        r = BatchedResolver()
+        self.so.files.extend(
+            [DummyEntry("test6", digest="test6"), DummyEntry("test7", digest="test6")]
+        )
+        s = DummySink()
+
+        with unittest.mock.patch.object(
+            r, "resolve_many", wraps=r.resolve_many
+        ) as resolve_many:
+            DeduplicateOperation([self.so], [r], s).run()
+
+        # All of the groups are resolved together.
+        resolve_many.assert_called_once()
+        self.assertEqual(2, len(resolve_many.call_args[0][0]))
+        self.assertEqual([self.f2, self.f3, self.f4, self.so.files[-1]], s.sunk)
+
+    def test_DDO_Resolve_Override(self):
+        # A sort-based resolver that only overrides resolve() is still consulted,
+        # though it inherits resolve_many().
+        groups = []
+
+        class LastResolver(AttrBasedDuplicateResolver):
+            def resolve(self, flist):
+                groups.append(list(flist))
+                return (flist[-1:], flist[:-1])
+
+        self.so.files.extend(
+            [DummyEntry("test6", digest="test6"), DummyEntry("test7", digest="test6")]
+        )
+        s = DummySink()
+        DeduplicateOperation([self.so], [LastResolver("path")], s).run()
+
+        self.assertEqual(2, len(groups))
+        self.assertEqual([f for g in groups for f in g[:-1]], s.sunk)
+
+    def test_DDO_Batches_Failure(self):
+        # Batches sunk before a failure stay sunk.
+        class FailingResolver(DuplicateResolver):
+            def resolve(self, flist):
+                if flist[0].path == "test6":
+                    raise Exception("Resolver failure")
+
+                return (flist[:1], flist[1:])
+
+        self.so.files.extend(
+            [DummyEntry("test6", digest="test6"), DummyEntry("test7", digest="test6")]
+        )
+        s = DummySink()
+        o = DeduplicateOperation([self.so], [FailingResolver()], s, sink_batch_size=1)
+
+        with self.assertRaises(Exception):
+            o.run()
+
+        self.assertEqual([self.f2, self.f3, self.f4], s.sunk)
+
     def test_DDO_Devils(self):
         # Run exactly the same tests, but inserting "devil" resolvers, which always
         # return either all originals or all duplicates.
@@ -522,6 +890,154 @@ class test_DeduplicateOperation(unittest.TestCase):
                 self.assertEqual(fl, self.perform(rl[:i] + [devil_duplicates] + rl[i:]))
                 self.assertEqual(fl, self.perform(rl[:i] + [devil_originals] + rl[i:]))
 
+    def test_DDO_Stats(self):
+        o = DeduplicateOperation(
+            [self.so], [self.r2, self.r1], DeleteDuplicateFileSink()
+        )
+        with self.assertLogs(level="ERROR"):
+            o.run()
+        counters = o.stats.as_dict()["counters"]
+
+        self.assertEqual(1, counters["size_groups"])
+        self.assertEqual(4, counters["candidate_files"])
+        self.assertEqual(1, counters["duplicate_groups"])
+        self.assertEqual(1, counters["unresolved_groups"])
+        self.assertEqual(2, counters["files_sunk"])
+        # The duplicates do not exist, so could not be deleted.
+        self.assertEqual(2, counters["sink_failures"])
+        self.assertEqual(
+            {"DummyResolver": {"narrowed": 2}},
+            o.stats.as_dict()["resolvers"],
+        )
+
+
+class test_OperationStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = OperationStats()
+        self.clock = iter(range(0, 100, 1))
+        self.stats.now = lambda: (next(self.clock),) * 2
+
+    def test_OperationStats_Phases(self):
+        self.stats.start()
+        with self.stats.phase("resolve"):
+            with self.stats.phase("hash"):
+                with self.stats.phase("group"):
+                    pass
+            with self.stats.phase("hash"):
+                pass
+        self.stats.stop()
+
+        phases = self.stats.as_dict()["phases"]
+        self.assertEqual(OperationStats.PHASES, list(phases.keys()))
+        # Time spent in inner phases is not counted against outer ones.
+        self.assertEqual({"wall_time": 3, "cpu_time": 3}, phases["resolve"])
+        self.assertEqual({"wall_time": 3, "cpu_time": 3}, phases["hash"])
+        self.assertEqual({"wall_time": 1, "cpu_time": 1}, phases["group"])
+        self.assertEqual({"wall_time": 0, "cpu_time": 0}, phases["walk"])
+        self.assertEqual(9, self.stats.as_dict()["wall_time"])
+
+    def test_OperationStats_Timed(self):
+        self.assertEqual([1, 2], list(self.stats.timed("sink", [1, 2])))
+        self.assertEqual(3, self.stats.as_dict()["phases"]["sink"]["wall_time"])
+
+    def test_OperationStats_Resolutions(self):
+        r = PathLengthDuplicateResolver(reverse=True)
+        self.stats.record_resolution(r, [], [1, 2])
+        self.stats.record_resolution(r, [1], [2])
+        self.stats.record_resolution(r, [1, 2], [3])
+        self.stats.record_resolution(r, [1, 2], [])
+
+        self.assertEqual(
+            {
+                "PathLengthDuplicateResolver (reverse)": {
+                    "deferred": 1,
+                    "resolved": 1,
+                    "narrowed": 1,
+                    "undecided": 1,
+                }
+            },
+            self.stats.as_dict()["resolvers"],
+        )
+
+    def test_OperationStats_Rates(self):
+        self.stats.increment("digest_cache_hits", 3)
+        self.stats.increment("digest_cache_misses")
+        self.stats.increment("bytes_hashed", 1 << 20)
+        self.stats.phases["hash"][0] = 0.5
+        rates = self.stats.as_dict()["rates"]
+
+        self.assertEqual(0.75, rates["digest_cache_hit_rate"])
+        self.assertEqual(2, rates["hash_megabytes_per_second"])
+        self.assertIsNone(rates["walk_files_per_second"])
+        self.assertEqual(0, rates["prefilter_bytes_avoided_ratio"])
+
+
+class test_ProgressReporter(unittest.TestCase):
+    def setUp(self):
+        self.output = io.StringIO()
+        self.progress = ProgressReporter(self.output, interval=3600)
+        self.time = 0
+        self.progress.clock = lambda: self.time
+
+    def test_ProgressReporter(self):
+        self.progress.start(4 << 20, 4)
+        self.time = 2
+        self.progress.current = "/test/one"
+        self.progress.advance(1 << 20)
+        status = self.progress.get_status()
+
+        self.assertEqual(25.0, status["percent"])
+        self.assertEqual(1, status["files_done"])
+        self.assertEqual(1 << 19, status["bytes_per_second"])
+        self.assertEqual(6, status["eta"])
+        self.assertEqual(
+            "Confirming duplicates: 25.0% (1.0 MB of 4.0 MB), 512.0 KB/s, "
+            "ETA 0:00:06, /test/one",
+            self.progress.format_status(status),
+        )
+
+        # Throughput is smoothed between reports.
+        self.time = 3
+        self.progress.advance(3 << 20, 3)
+        status = self.progress.get_status()
+        self.assertEqual(0.3 * (3 << 20) + 0.7 * (1 << 19), status["bytes_per_second"])
+        self.assertEqual(0, status["eta"])
+
+        self.progress.stop()
+        self.assertEqual(
+            "Confirming duplicates: 100.0% (4.0 MB of 4.0 MB), 1.2 MB/s, "
+            "ETA 0:00:00\n",
+            self.output.getvalue(),
+        )
+
+    def test_ProgressReporter_NoTotal(self):
+        self.progress.start()
+        self.time = 1
+        self.progress.advance(100)
+
+        self.assertEqual(
+            "Confirming duplicates: 100 B, 100 B/s",
+            self.progress.format_status(self.progress.get_status()),
+        )
+        self.progress.stop()
+
+    def test_ProgressReporter_StatusFile(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.progress.output = None
+        self.progress.path = os.path.join(temp_dir, "status.json")
+
+        self.progress.start(10, 1)
+        self.progress.current = "/test/one"
+        self.progress.report()
+        with open(self.progress.path) as f:
+            status = json.load(f)
+
+        self.assertEqual(0, status["percent"])
+        self.assertEqual("/test/one", status["current"])
+        self.assertEqual(["status.json"], os.listdir(temp_dir))
+        self.progress.stop()
+
 
 # Below are tests that directly touch the filesystem, all of which inherit
 # from test_FileSystemTestBase.
@@ -608,63 +1124,1438 @@ class test_FileSystemTestBase(object):
 # Tests for core classes, with filesystem access
 
 
-class test_FS_FileEntry(test_FileSystemTestBase, unittest.TestCase):
-    def setUp(self):
-        self.entry_state = [(os.path.join("source1", "file1"), "Contents1")]
-        super(test_FS_FileEntry, self).setUp()
+class test_FS_FileEntry(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [(os.path.join("source1", "file1"), "Contents1")]
+        super(test_FS_FileEntry, self).setUp()
+
+    def test_FS_FileEntry(self):
+        path = self.get_absolute_path(self.entry_state[0][0])
+        fe = FileEntry(path, None)
+
+        self.assertEqual(fe.path, path)
+        self.assertEqual(os.stat(path).st_size, fe.get_size())
+        self.assertEqual(None, fe.digest)
+        # The double-assert exercises the caching function
+        self.assertEqual(
+            hashlib.sha512("Contents1".encode("utf-8")).hexdigest(), fe.get_digest()
+        )
+        self.assertEqual(
+            hashlib.sha512("Contents1".encode("utf-8")).hexdigest(), fe.get_digest()
+        )
+
+
+class test_FS_CompactFileEntry(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("source1", "file1"), "Contents1"),
+            (os.path.join("source1", "file2"), "Contents1"),
+        ]
+        super(test_FS_CompactFileEntry, self).setUp()
+
+    def test_FS_CompactFileEntry(self):
+        path = self.get_absolute_path(self.entry_state[0][0])
+        s = Source(self.get_absolute_path("source1"), 1, compact=True)
+        fe = FileEntry(path, s)
+        ce = CompactFileEntry(path, s)
+
+        self.assertFalse(hasattr(ce, "__dict__"))
+        self.assertEqual(path, ce.path)
+        self.assertEqual("file1", ce.name)
+        self.assertEqual(fe.get_size(), ce.get_size())
+        self.assertEqual(fe.get_inode(), ce.get_inode())
+        self.assertEqual(fe.stat.st_mtime_ns, ce.stat.st_mtime_ns)
+        self.assertAlmostEqual(fe.stat.st_mtime, ce.stat.st_mtime, places=5)
+        self.assertEqual(fe.get_digest(), ce.get_digest())
+        self.assertEqual(
+            fe.get_partial_digest(ContentSampler(4)),
+            ce.get_partial_digest(ContentSampler(4)),
+        )
+
+    def test_FS_CompactFileEntry_Interned(self):
+        s = Source(self.get_absolute_path("source1"), 1, compact=True)
+        one = CompactFileEntry(self.get_absolute_path(self.entry_state[0][0]), s)
+        two = CompactFileEntry(self.get_absolute_path(self.entry_state[1][0]), s)
+
+        self.assertEqual(one.directory, two.directory)
+        self.assertEqual(1, len(s.directories))
+        self.assertEqual(self.get_absolute_path("source1"), s.directories[0])
+
+    def test_FS_CompactFileEntry_PartialDigestsLazy(self):
+        s = Source(self.get_absolute_path("source1"), 1, compact=True)
+        ce = CompactFileEntry(self.get_absolute_path(self.entry_state[0][0]), s)
+
+        self.assertIsNone(ce._partial_digests)
+        ce.get_partial_digest(ContentSampler(4))
+        self.assertEqual(1, len(ce.partial_digests))
+
+
+class test_FS_FileEntry_PartialDigest(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            ("file1", "HeadA" + "X" * 100 + "TailA"),
+            ("file2", "HeadA" + "Y" * 100 + "TailB"),
+            ("file3", "HeadB" + "X" * 100 + "TailA"),
+            ("file4", "Tiny"),
+        ]
+        super(test_FS_FileEntry_PartialDigest, self).setUp()
+
+    def get_entries(self):
+        return [
+            FileEntry(self.get_absolute_path(f), None) for (f, c) in self.entry_state
+        ]
+
+    def test_FS_FileEntry_PartialDigest_Head(self):
+        sampler = ContentSampler(5)
+        (one, two, three, four) = self.get_entries()
+
+        self.assertEqual(
+            one.get_partial_digest(sampler), two.get_partial_digest(sampler)
+        )
+        self.assertNotEqual(
+            one.get_partial_digest(sampler), three.get_partial_digest(sampler)
+        )
+        self.assertIsNone(one.digest)
+
+    def test_FS_FileEntry_PartialDigest_Tail(self):
+        sampler = ContentSampler(5, tail=True)
+        (one, two, three, four) = self.get_entries()
+
+        self.assertNotEqual(
+            one.get_partial_digest(sampler), two.get_partial_digest(sampler)
+        )
+
+    def test_FS_FileEntry_PartialDigest_Covers(self):
+        # Files no larger than the sample get their full digest.
+        four = self.get_entries()[3]
+
+        self.assertEqual(
+            hashlib.sha512("Tiny".encode("utf-8")).hexdigest(),
+            four.get_partial_digest(ContentSampler(5)),
+        )
+        self.assertIsNotNone(four.digest)
+
+
+class test_FS_DigestCache(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            ("file1", "Contents1" * 10),
+            ("file2", "Contents2" * 10),
+        ]
+        super(test_FS_DigestCache, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.cache_dir, "cache.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super(test_FS_DigestCache, self).tearDown()
+
+    def get_entry(self, index):
+        return FileEntry(self.get_absolute_path(self.entry_state[index][0]), None)
+
+    def test_FS_DigestCache_Hit(self):
+        cache = DigestCache(self.cache_path)
+        digest = cache.get_digest(self.get_entry(0))
+        cache.close()
+
+        cache = DigestCache(self.cache_path)
+        with unittest.mock.patch.object(FileEntry, "run_digest") as run_digest:
+            self.assertEqual(digest, cache.get_digest(self.get_entry(0)))
+            run_digest.assert_not_called()
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+        cache.close()
+
+    def test_FS_DigestCache_Invalidation(self):
+        cache = DigestCache(self.cache_path)
+        cache.get_digest(self.get_entry(0))
+
+        path = self.get_absolute_path(self.entry_state[0][0])
+        with open(path, mode="w") as f:
+            f.write("Changed")
+        os.utime(path, (10000, 10000))
+
+        self.assertEqual(
+            hashlib.sha512("Changed".encode("utf-8")).hexdigest(),
+            cache.get_digest(self.get_entry(0)),
+        )
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        cache.close()
+
+    def test_FS_DigestCache_NoInode(self):
+        # Files on filesystems without inodes all report inode 0, and so must not
+        # share cached digests.
+        cache = DigestCache(self.cache_path)
+        with unittest.mock.patch.object(FileEntry, "get_inode", return_value=None):
+            digests = [cache.get_digest(self.get_entry(i)) for i in range(2)]
+            self.assertIsNone(cache.lookup(self.get_entry(0), "sha512"))
+        cache.flush()
+
+        self.assertEqual([self.get_entry(i).get_digest() for i in range(2)], digests)
+        self.assertEqual((0, 0), (cache.hits, cache.misses))
+        self.assertEqual(
+            [(0,)], cache.connection.execute("SELECT COUNT(*) FROM digests").fetchall()
+        )
+        cache.close()
+
+    def test_FS_DigestCache_PartialDigest(self):
+        sampler = ContentSampler(4)
+        cache = DigestCache(self.cache_path)
+        digest = cache.get_partial_digest(self.get_entry(1), sampler)
+        cache.flush()
+
+        other = DigestCache(self.cache_path)
+        entry = self.get_entry(1)
+        self.assertEqual(digest, other.get_partial_digest(entry, sampler))
+        self.assertEqual(1, other.hits)
+        self.assertIsNone(other.lookup(entry, ContentSampler(8).key))
+        self.assertIsNone(other.lookup(entry, "sha512"))
+
+        other.close()
+        cache.close()
+
+    def test_FS_DigestCache_Prune(self):
+        cache = DigestCache(self.cache_path)
+        cache.get_digest(self.get_entry(0))
+        cache.get_digest(self.get_entry(1))
+
+        os.unlink(self.get_absolute_path(self.entry_state[0][0]))
+        self.assertEqual(1, cache.prune())
+        self.assertEqual(0, cache.prune())
+        cache.close()
+
+        self.entry_state = self.entry_state[1:]
+
+    def test_FS_DigestCache_Operation(self):
+        cache = DigestCache(self.cache_path)
+        DeduplicateOperation(
+            [Source(self.temp_dir, 1)], [], DummySink(), ContentSampler(4), cache
+        ).run()
+        cache.close()
+
+        # Both sizes are equal, so both files were sampled and hashed.
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(4, cache.misses)
+
+
+class test_FS_ScanManifest(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            ("file1", "Contents1"),
+            ("file2", "Contents1"),
+            ("file3", "Contents2"),
+            ("file4", "Contents2"),
+            ("file5", "Contents3"),
+        ]
+        super(test_FS_ScanManifest, self).setUp()
+        self.manifest_dir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.manifest_dir, "manifest")
+
+    def tearDown(self):
+        shutil.rmtree(self.manifest_dir)
+        super(test_FS_ScanManifest, self).tearDown()
+
+    def scan(self, sampler=None):
+        manifest = ScanManifest.load(self.manifest_path)
+        with unittest.mock.patch.object(
+            FileEntry, "run_digest", autospec=True, side_effect=FileEntry.run_digest
+        ) as run_digest:
+            DeduplicateOperation(
+                [Source(self.temp_dir, 1)], [], DummySink(), sampler, manifest=manifest
+            ).run()
+        manifest.save(self.manifest_path)
+
+        return (
+            manifest,
+            sorted(os.path.basename(c[0][0].path) for c in run_digest.call_args_list),
+        )
+
+    def test_FS_ScanManifest(self):
+        (manifest, read) = self.scan()
+        self.assertEqual(["file1", "file2", "file3", "file4", "file5"], read)
+        self.assertEqual(
+            (5, 0, 0), (manifest.new, manifest.changed, manifest.unchanged)
+        )
+        self.assertEqual(2, len(manifest.get_changes()[0]))
+
+        (manifest, read) = self.scan()
+        self.assertEqual([], read)
+        self.assertEqual(
+            (0, 0, 5), (manifest.new, manifest.changed, manifest.unchanged)
+        )
+        self.assertEqual(([], []), manifest.get_changes())
+
+    def test_FS_ScanManifest_Changes(self):
+        self.scan()
+
+        # Dissolve one group and form another. Only the changed file is read.
+        with open(self.get_absolute_path("file4"), "w") as f:
+            f.write("Contents3")
+        os.utime(self.get_absolute_path("file4"), (10000, 10000))
+        self.entry_state[3] = ("file4", "Contents3")
+
+        (manifest, read) = self.scan()
+        self.assertEqual(["file4"], read)
+        self.assertEqual(
+            (0, 1, 4), (manifest.new, manifest.changed, manifest.unchanged)
+        )
+
+        (added, dissolved) = manifest.get_changes()
+        paths = [self.get_absolute_path(f) for f in ["file3", "file4", "file5"]]
+        self.assertEqual([[paths[1], paths[2]]], added)
+        self.assertEqual([[paths[0], paths[1]]], dissolved)
+
+    def test_FS_ScanManifest_Deleted(self):
+        self.scan()
+        os.unlink(self.get_absolute_path("file1"))
+        self.entry_state = self.entry_state[1:]
+
+        (manifest, read) = self.scan()
+        self.assertEqual([self.get_absolute_path("file1")], manifest.get_deleted())
+        self.assertEqual(1, len(manifest.get_changes()[1]))
+
+    def test_FS_ScanManifest_Samples(self):
+        sampler = ContentSampler(4)
+        self.scan(sampler)
+
+        manifest = ScanManifest.load(self.manifest_path)
+        record = manifest.previous[self.get_absolute_path("file1")]
+        self.assertIn(sampler.key, record["samples"])
+        self.assertIsNotNone(record["digest"])
+
+    def test_FS_ScanManifest_Algorithm(self):
+        self.scan()
+
+        manifest = ScanManifest.load(self.manifest_path, hash_algorithms["md5"])
+        self.assertIsNone(manifest.previous[self.get_absolute_path("file1")]["digest"])
+
+    def test_FS_ScanManifest_CommandLine(self):
+        import dedupe_trees.__main__ as ddt
+
+        argv = [
+            "dedupe_trees",
+            "--resolve-arbitrary",
+            "--sink-output-only",
+            "--sink-output-only-path",
+            os.path.join(self.manifest_dir, "output"),
+            "--manifest",
+            self.manifest_path,
+            self.temp_dir,
+        ]
+        for i in range(2):
+            with unittest.mock.patch("sys.argv", argv):
+                self.assertEqual(0, ddt.main())
+
+            manifest = ScanManifest.load(self.manifest_path)
+            self.assertEqual(5, len(manifest.previous))
+            self.assertEqual(2, len(manifest.previous_groups))
+
+    def test_FS_ScanManifest_Missing(self):
+        manifest = ScanManifest.load(self.manifest_path)
+
+        self.assertEqual({}, manifest.previous)
+        self.assertEqual(set(), manifest.previous_groups)
+
+
+class test_ManifestEntry(unittest.TestCase):
+    def test_ManifestEntry(self):
+        source = ManifestSource("node1", "/source", 1, "manifest", 1, None)
+        entry = ManifestEntry(
+            "/source/file", source, ManifestStat(1, 2, 3, 4 * 10 ** 9)
+        )
+
+        self.assertEqual(3, entry.get_size())
+        self.assertEqual(4, entry.stat.st_mtime)
+        # Inodes are only shared by files on the same node.
+        self.assertEqual(("node1", 1, 2), entry.get_inode())
+        with self.assertRaises(ValueError):
+            entry.get_digest()
+
+
+class test_FS_MultiNode(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("node1", "file1"), "Contents1"),
+            (os.path.join("node1", "sub", "file2"), "Contents2"),
+            (os.path.join("node1", "sub", "file3"), "Contents2"),
+            (os.path.join("node2", "file4"), "Contents1"),
+            (os.path.join("node2", "file5"), "Contents3"),
+        ]
+        super(test_FS_MultiNode, self).setUp()
+        self.manifest_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.manifest_dir)
+        super(test_FS_MultiNode, self).tearDown()
+
+    def get_manifest_path(self, node):
+        return os.path.join(self.manifest_dir, node + ".manifest")
+
+    def scan(self, node, **kwargs):
+        manifest = ScanManifest.load(self.get_manifest_path(node), node=node)
+        DeduplicateOperation(
+            [Source(self.get_absolute_path(node), 1)],
+            [],
+            DummySink(),
+            ContentSampler(4),
+            manifest=manifest,
+            **kwargs
+        ).scan()
+        manifest.save(self.get_manifest_path(node))
+
+        return manifest
+
+    def merge(self):
+        sources = ManifestSource.load_all(
+            [self.get_manifest_path("node1"), self.get_manifest_path("node2")]
+        )
+        plans = os.path.join(self.manifest_dir, "plans")
+        MergedDeduplicateOperation(
+            sources,
+            [SourceOrderDuplicateResolver(), FilenameSortDuplicateResolver()],
+            PlanDuplicateFileSink(plans, ["node1", "node2"]),
+        ).run()
+
+        return [
+            DuplicatePlan.load(os.path.join(plans, node + ".plan"))
+            for node in ["node1", "node2"]
+        ]
+
+    def test_FS_MultiNode_Scan(self):
+        manifest = self.scan("node2")
+
+        # Every file is hashed, even where its size is unique on its node.
+        self.assertEqual(2, len(manifest.files))
+        self.assertTrue(all(r["digest"] for r in manifest.files.values()))
+        self.assertEqual({1: self.get_absolute_path("node2")}, manifest.sources)
+
+    def test_FS_MultiNode_ScanProgress(self):
+        # Each file is counted once, whether it is read or its digest is reused.
+        for i in range(2):
+            progress = ProgressReporter(interval=3600)
+            self.scan("node1", progress=progress)
+
+            self.assertEqual((27, 27), (progress.bytes_done, progress.total_bytes))
+            self.assertEqual((3, 3), (progress.files_done, progress.total_files))
+
+    def test_FS_MultiNode(self):
+        self.scan("node1")
+        self.scan("node2")
+        plans = self.merge()
+
+        self.assertEqual(["node1", "node2"], [plan.node for plan in plans])
+        self.assertEqual(
+            [
+                (self.get_absolute_path(self.entry_state[2][0]), "node1"),
+                (self.get_absolute_path(self.entry_state[3][0]), "node1"),
+            ],
+            [(r["path"], r["original"]["node"]) for p in plans for r in p.records],
+        )
+
+        for plan in plans:
+            self.assertEqual((1, 0), plan.apply(DeleteDuplicateFileSink()))
+
+        self.check_exit_state([self.entry_state[i] for i in [0, 1, 4]])
+
+    def test_FS_MultiNode_Changed(self):
+        self.scan("node1")
+        self.scan("node2")
+        plans = self.merge()
+
+        # Files changed since they were scanned are left alone.
+        os.utime(self.get_absolute_path(self.entry_state[3][0]), (10000, 10000))
+        os.utime(self.get_absolute_path(self.entry_state[1][0]), (10000, 10000))
+        with self.assertLogs("dedupe_trees.dedupe_trees", level="WARNING"):
+            for plan in plans:
+                self.assertEqual((0, 1), plan.apply(DeleteDuplicateFileSink()))
+
+        self.check_exit_state(self.entry_state)
+
+    def test_FS_MultiNode_RemoteLink(self):
+        self.scan("node1")
+        self.scan("node2")
+        plan = self.merge()[1]
+
+        # Files can only be linked to originals on the same node.
+        with self.assertLogs("dedupe_trees.dedupe_trees", level="WARNING"):
+            self.assertEqual((0, 1), plan.apply(LinkDuplicateFileSink()))
+
+    def test_FS_MultiNode_Invalid(self):
+        self.scan("node1")
+
+        with self.assertRaises(ValueError):
+            ManifestSource.load_all([self.get_manifest_path("node1")] * 2)
+
+        # Manifests not written by a node scan can't be merged.
+        ScanManifest().save(self.get_manifest_path("node2"))
+        with self.assertRaises(ValueError):
+            ManifestSource.load_all([self.get_manifest_path("node2")])
+
+        with self.assertRaises(ValueError):
+            MergedDeduplicateOperation(
+                ManifestSource.load_all([self.get_manifest_path("node1")]),
+                [],
+                DummySink(),
+                sampler=ContentSampler(4),
+            )
+
+    def test_FS_MultiNode_CommandLine(self):
+        import dedupe_trees.__main__ as ddt
+
+        plans = os.path.join(self.manifest_dir, "plans")
+        commands = [
+            [
+                "--node-scan",
+                "--node",
+                "node1",
+                "--manifest",
+                self.get_manifest_path("node1"),
+                self.get_absolute_path("node1"),
+            ],
+            [
+                "--node-scan",
+                "--node",
+                "node2",
+                "--manifest",
+                self.get_manifest_path("node2"),
+                self.get_absolute_path("node2"),
+            ],
+            [
+                "--merge-plans",
+                plans,
+                "--resolve-source-order",
+                "--resolve-arbitrary",
+                self.get_manifest_path("node1"),
+                self.get_manifest_path("node2"),
+            ],
+            [
+                "--apply-plan",
+                os.path.join(plans, "node1.plan"),
+                "--node",
+                "node1",
+                "--sink-delete",
+            ],
+            [
+                "--apply-plan",
+                os.path.join(plans, "node2.plan"),
+                "--node",
+                "node2",
+                "--sink-delete",
+            ],
+        ]
+        for command in commands:
+            with unittest.mock.patch("sys.argv", ["dedupe_trees"] + command):
+                self.assertEqual(0, ddt.main())
+
+        self.check_exit_state([self.entry_state[i] for i in [0, 1, 4]])
+
+        # Plans are only applied on their own nodes.
+        with unittest.mock.patch(
+            "sys.argv",
+            ["dedupe_trees", "--apply-plan", commands[3][1], "--sink-delete"],
+        ):
+            self.assertEqual(1, ddt.main())
+
+
+class test_FS_OperationStats(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            ("a/1.txt", "Same contents"),
+            ("b/2.txt", "Same contents"),
+            ("c/3.txt", "Xame contents"),
+            ("d/4.txt", "Unique"),
+            ("e/ignored", "Same contents"),
+        ]
+        super(test_FS_OperationStats, self).setUp()
+
+    def test_FS_OperationStats(self):
+        o = DeduplicateOperation(
+            [Source(self.temp_dir, 1, ConfiguredSourceFilter(names=["ignored"]))],
+            [PathLengthDuplicateResolver(), FilenameSortDuplicateResolver()],
+            DummySink(),
+            sampler=ContentSampler(4),
+        )
+        o.run()
+        metrics = o.stats.as_dict()
+
+        self.assertEqual(
+            {
+                "directories_walked": 6,
+                "directories_filtered": 0,
+                "files_walked": 4,
+                "files_filtered": 1,
+                "stat_calls": 4,
+                "walk_errors": 0,
+                "size_groups": 1,
+                "candidate_files": 3,
+                "files_sampled": 3,
+                "bytes_sampled": 12,
+                "bytes_avoided": 9,
+                "files_hashed": 2,
+                "bytes_hashed": 26,
+                "bytes_compared": 0,
+                "duplicate_groups": 1,
+                "unresolved_groups": 0,
+                "sink_batches": 1,
+                "files_sunk": 1,
+                "sink_failures": 0,
+            },
+            metrics["counters"],
+        )
+        self.assertEqual(
+            {
+                "PathLengthDuplicateResolver": {"undecided": 1},
+                "FilenameSortDuplicateResolver": {"resolved": 1},
+            },
+            metrics["resolvers"],
+        )
+        self.assertGreater(metrics["wall_time"], 0)
+        self.assertTrue(
+            all(times["wall_time"] >= 0 for times in metrics["phases"].values())
+        )
+
+    def test_FS_OperationStats_Progress(self):
+        progress = ProgressReporter(interval=3600)
+        DeduplicateOperation(
+            [Source(self.temp_dir, 1, ConfiguredSourceFilter(names=["ignored"]))],
+            [FilenameSortDuplicateResolver()],
+            DummySink(),
+            sampler=ContentSampler(4),
+            progress=progress,
+        ).run()
+
+        self.assertEqual((39, 39), (progress.bytes_done, progress.total_bytes))
+        self.assertEqual((3, 3), (progress.files_done, progress.total_files))
+        self.assertIsNone(progress.thread)
+
+    def test_FS_OperationStats_ProgressBlocks(self):
+        # Progress advances with each block read, and each group is credited
+        # only with the bytes not read, such as those after a comparison ends.
+        for (reader, comparator, block) in [
+            (BlockReader(4), None, 4),
+            (None, BlockComparator(2, 4), 2),
+        ]:
+            source = Source(self.temp_dir, 1, ConfiguredSourceFilter(names=["ignored"]))
+            progress = ProgressReporter(interval=3600)
+            with unittest.mock.patch.object(
+                progress, "advance", wraps=progress.advance
+            ) as advance:
+                DeduplicateOperation(
+                    [source],
+                    [FilenameSortDuplicateResolver()],
+                    DummySink(),
+                    reader=reader,
+                    comparator=comparator,
+                    progress=progress,
+                ).run()
+
+            self.assertIn(unittest.mock.call(block, 0), advance.call_args_list)
+            self.assertEqual((39, 39), (progress.bytes_done, progress.total_bytes))
+            self.assertEqual((3, 3), (progress.files_done, progress.total_files))
+
+    def test_FS_OperationStats_PhaseProfiler(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        o = DeduplicateOperation(
+            [Source(self.temp_dir, 1)],
+            [FilenameSortDuplicateResolver()],
+            DummySink(),
+            profiler=PhaseProfiler(profile_dir),
+        )
+        o.run()
+
+        self.assertIsNone(o.stats.profiler)
+        for phase in OperationStats.PHASES:
+            stats = pstats.Stats(os.path.join(profile_dir, phase + ".prof"))
+            self.assertGreater(stats.total_calls, 0)
+            with open(os.path.join(profile_dir, phase + "-memory.txt")) as f:
+                self.assertTrue(f.readline().startswith("Top allocations during"))
+            self.assertTrue(
+                os.path.exists(os.path.join(profile_dir, phase + ".snapshot"))
+            )
+
+        # Each phase's profile excludes the phases it calls.
+        functions = {
+            function[2]
+            for function in pstats.Stats(
+                os.path.join(profile_dir, "walk.prof")
+            ).stats.keys()
+        }
+        self.assertIn("walk", functions)
+        self.assertNotIn("run_digest", functions)
+
+    def test_FS_OperationStats_SamplingProfiler(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        stats = OperationStats()
+        profiler = SamplingProfiler(profile_dir, interval=3600)
+        profiler.start(stats)
+
+        with stats.phase("hash"):
+            thread = threading.Thread(target=profiler.sample)
+            thread.start()
+            thread.join()
+        profiler.stop(stats)
+
+        with open(os.path.join(profile_dir, "hash.folded")) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(
+            any(
+                "test_FS_OperationStats_SamplingProfiler" in line
+                and line.endswith(" 1")
+                for line in lines
+            )
+        )
+
+    def test_FS_OperationStats_CommandLine(self):
+        import dedupe_trees.__main__ as ddt
+
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        metrics_path = os.path.join(metrics_dir, "metrics.json")
+        argv = [
+            "dedupe_trees",
+            "--resolve-arbitrary",
+            "--sink-output-only",
+            "--sink-output-only-path",
+            os.path.join(metrics_dir, "output"),
+            "--compare-bytes",
+            "--metrics-json",
+            metrics_path,
+            self.temp_dir,
+        ]
+        with unittest.mock.patch("sys.argv", argv):
+            self.assertEqual(0, ddt.main())
+
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+
+        self.assertEqual(OperationStats.PHASES, list(metrics["phases"].keys()))
+        self.assertEqual(5, metrics["counters"]["files_walked"])
+        self.assertEqual(2, metrics["counters"]["files_sunk"])
+        self.assertGreater(metrics["counters"]["bytes_compared"], 0)
+
+
+class test_FS_BlockComparator(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            ("file1", "A" * 50),
+            ("file2", "A" * 49 + "B"),
+            ("file3", "A" * 50),
+            ("file4", "B" * 50),
+            ("file5", "A" * 49 + "B"),
+            ("file6", "A" * 10 + "C" * 40),
+        ]
+        super(test_FS_BlockComparator, self).setUp()
+
+    def get_entries(self):
+        return [
+            FileEntry(self.get_absolute_path(f), None) for (f, c) in self.entry_state
+        ]
+
+    def test_FS_BlockComparator(self):
+        entries = self.get_entries()
+        groups = BlockComparator(4, 16).get_groups(entries)
+
+        self.assertEqual([[entries[0], entries[2]], [entries[1], entries[4]]], groups)
+
+    def test_FS_BlockComparator_OpenFiles(self):
+        entries = self.get_entries()
+        opened = []
+        real_open = open
+
+        def tracking_open(*args, **kwargs):
+            f = real_open(*args, **kwargs)
+            opened.append(f)
+            self.assertLessEqual(len([o for o in opened if not o.closed]), 2)
+            return f
+
+        with unittest.mock.patch("builtins.open", side_effect=tracking_open):
+            groups = BlockComparator(4, 16, max_open_files=2).get_groups(entries)
+
+        self.assertEqual([[entries[0], entries[2]], [entries[1], entries[4]]], groups)
+        self.assertTrue(all(f.closed for f in opened))
+
+    def test_FS_BlockComparator_Unique(self):
+        reads = []
+
+        class CountingComparator(BlockComparator):
+            def read_chunk(self, handles, entry, offset, length):
+                reads.append(entry)
+                return super().read_chunk(handles, entry, offset, length)
+
+        entries = self.get_entries()
+        groups = CountingComparator(4, 16).get_groups(
+            [entries[0], entries[3], entries[5]]
+        )
+
+        # Files are not read again once they are known to be unique.
+        self.assertEqual([], groups)
+        self.assertEqual(1, reads.count(entries[3]))
+        self.assertEqual(2, reads.count(entries[5]))
+
+
+class test_FS_FileEntry_Algorithms(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [("file1", "Contents1")]
+        super(test_FS_FileEntry_Algorithms, self).setUp()
+
+    def test_FS_FileEntry_Algorithms(self):
+        path = self.get_absolute_path("file1")
+        for name in ["sha256", "sha1", "md5", "blake2b"]:
+            self.assertEqual(
+                hashlib.new(name, b"Contents1").hexdigest(),
+                FileEntry(path, None).get_digest(hash_algorithms[name]),
+            )
+
+        self.assertEqual(
+            "{:08x}".format(zlib.crc32(b"Contents1")),
+            FileEntry(path, None).get_digest(hash_algorithms["crc32"]),
+        )
+
+
+class test_FS_BlockReader(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [("file1", "0123456789"), ("file2", "abcdefgh")]
+        super(test_FS_BlockReader, self).setUp()
+
+    def get_entry(self, index):
+        return FileEntry(self.get_absolute_path(self.entry_state[index][0]), None)
+
+    def test_FS_BlockReader(self):
+        r = BlockReader(4)
+
+        self.assertEqual(
+            [b"0123", b"4567", b"89"],
+            [bytes(b) for b in r.read_blocks(self.get_entry(0))],
+        )
+        self.assertEqual(
+            [b"abcd", b"efgh"], [bytes(b) for b in r.read_blocks(self.get_entry(1))]
+        )
+
+    def test_FS_BlockReader_Reuse(self):
+        r = BlockReader(4)
+        blocks = [b.obj for b in r.read_blocks(self.get_entry(0))]
+        blocks.extend(b.obj for b in r.read_blocks(self.get_entry(1)))
+
+        self.assertTrue(all(b is blocks[0] for b in blocks))
+
+    def test_FS_BlockReader_Digest(self):
+        entry = self.get_entry(0)
+        entry.run_digest(reader=BlockReader(3))
+
+        self.assertEqual(hashlib.sha512(b"0123456789").hexdigest(), entry.digest)
+
+    def test_FS_AutoTuningBlockReader(self):
+        r = AutoTuningBlockReader([2, 4], trials=2, min_trial_bytes=8)
+        entry = self.get_entry(0)
+
+        # Candidates are tried in turn, until each has been measured twice.
+        sizes = []
+        for i in range(4):
+            sizes.append(r.get_block_size(entry))
+            r.record(entry, sizes[-1], 8, 1.0 if sizes[-1] == 2 else 0.5)
+
+        self.assertEqual([2, 4, 2, 4], sizes)
+        self.assertEqual(4, r.get_block_size(entry))
+
+    def test_FS_AutoTuningBlockReader_Measures(self):
+        r = AutoTuningBlockReader([4], trials=1, min_trial_bytes=8)
+        entry = self.get_entry(0)
+
+        self.assertEqual(
+            b"0123456789", b"".join(bytes(b) for b in r.read_blocks(entry))
+        )
+        self.assertEqual(4, r.devices[entry.stat.st_dev]["chosen"])
+
+
+class test_FS_Source(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("source1", "file1"), "Contents1"),
+            (os.path.join("source1", "subdir1", "file2"), "Contents1"),
+            (os.path.join("source1", "file3"), "Contents2"),
+            (os.path.join("source1", "subdir2", "subdir", "file4"), "Contents2"),
+        ]
+        super(test_FS_Source, self).setUp()
+
+    def test_FS_Source(self):
+        s = Source(self.get_absolute_path("source1"), 2)
+        f = DummyCatalog()
+
+        self.assertEqual(2, s.order)
+        s.walk(f)
+
+        self.assertCountEqual(
+            [self.get_absolute_path(f) for (f, c) in self.entry_state],
+            [fe.path for fe in f.entries],
+        )
+
+    def test_FS_Source_NoRedundantStat(self):
+        # Stat information comes from the directory scan.
+        s = Source(self.get_absolute_path("source1"), 1)
+        f = DummyCatalog()
+
+        with unittest.mock.patch("os.stat", side_effect=Exception("os.stat called")):
+            s.walk(f)
+
+        self.assertEqual(4, len(f.entries))
+        for fe in f.entries:
+            self.assertEqual(os.stat(fe.path), fe.stat)
+
+    def test_FS_Source_Order(self):
+        s = Source(self.get_absolute_path("source1"), 1)
+        f = DummyCatalog()
+        s.walk(f)
+
+        expected = []
+        for cwd, subdirs, files in os.walk(s.path):
+            expected.extend(os.path.join(cwd, fn) for fn in files)
+
+        self.assertEqual(expected, [fe.path for fe in f.entries])
+
+    def test_FS_Source_Symlinks(self):
+        # Links to directories are not followed.
+        os.symlink(
+            self.get_absolute_path(os.path.join("source1", "subdir1")),
+            self.get_absolute_path(os.path.join("source1", "link")),
+        )
+        s = Source(self.get_absolute_path("source1"), 1)
+        f = DummyCatalog()
+        s.walk(f)
+        os.unlink(self.get_absolute_path(os.path.join("source1", "link")))
+
+        self.assertEqual(4, len(f.entries))
+
+    def test_FS_Source_Compact(self):
+        s = Source(self.get_absolute_path("source1"), 1, compact=True)
+        f = DummyCatalog()
+        s.walk(f)
+
+        self.assertCountEqual(
+            [self.get_absolute_path(f) for (f, c) in self.entry_state],
+            [fe.path for fe in f.entries],
+        )
+        self.assertTrue(all(isinstance(fe, CompactFileEntry) for fe in f.entries))
+        # One entry per directory visited
+        self.assertEqual(4, len(s.directories))
+
+    def test_FS_Source_Contains(self):
+        s = Source(self.get_absolute_path("source1"), 1)
+
+        self.assertTrue(s.contains(s))
+        self.assertTrue(
+            s.contains(Source(self.get_absolute_path(os.path.join("source1", "a")), 2))
+        )
+        self.assertFalse(s.contains(Source(self.get_absolute_path("source10"), 2)))
+        self.assertFalse(s.contains(Source(self.get_absolute_path(""), 2)))
+
+    def test_FS_Source_Overlapping(self):
+        # Files reached through more than one source are catalogued once.
+        o = DeduplicateOperation(
+            [
+                Source(self.get_absolute_path("source1"), 1),
+                Source(self.get_absolute_path(os.path.join("source1", "subdir1")), 2),
+            ],
+            [],
+            DummySink(),
+        )
+
+        catalog = o.build_catalog()
+
+        self.assertEqual(4, sum(len(entries) for entries in catalog.store.values()))
+
+    @unittest.skipUnless(SUPPORTS_DIR_FD, "os.fwalk() is not supported")
+    def test_FS_Source_Fwalk(self):
+        s = Source(self.get_absolute_path("source1"), 1, fwalk=True)
+        f = DummyCatalog()
+        expected = DummyCatalog()
+        Source(self.get_absolute_path("source1"), 1).walk(expected)
+
+        with unittest.mock.patch("os.stat", wraps=os.stat) as stat:
+            s.walk(f)
+
+        self.assertEqual(
+            [fe.path for fe in expected.entries], [fe.path for fe in f.entries]
+        )
+        for fe in f.entries:
+            self.assertEqual(os.stat(fe.path), fe.stat)
+        # Files are stat()ed relative to their directory.
+        self.assertTrue(
+            all(
+                "dir_fd" in call[1] and os.path.sep not in call[0][0]
+                for call in stat.call_args_list
+                if call[0][0] in ["file1", "file2", "file3", "file4"]
+            )
+        )
+
+    @unittest.skipUnless(SUPPORTS_DIR_FD, "os.fwalk() is not supported")
+    def test_FS_Source_Fwalk_Filtered(self):
+        os.symlink(
+            self.get_absolute_path(os.path.join("source1", "subdir1")),
+            self.get_absolute_path(os.path.join("source1", "link")),
+        )
+        sf = ConfiguredSourceFilter(names=["subdir2", "file1"])
+        s = Source(self.get_absolute_path("source1"), 1, sf, compact=True, fwalk=True)
+        f = DummyCatalog()
+        s.walk(f)
+        os.unlink(self.get_absolute_path(os.path.join("source1", "link")))
+
+        self.assertCountEqual(
+            [self.get_absolute_path(self.entry_state[i][0]) for i in [1, 2]],
+            [fe.path for fe in f.entries],
+        )
+        self.assertTrue(all(isinstance(fe, CompactFileEntry) for fe in f.entries))
+
+    def test_FS_Source_WithFilter(self):
+        names = ["subdir1", "file1"]
+        patterns = [re.compile("f.*[4-5]$")]
+
+        sf = ConfiguredSourceFilter(names=names, patterns=patterns)
+        s = Source(self.get_absolute_path("source1"), 1, sf)
+        f = DummyCatalog()
+
+        s.walk(f)
+        self.assertEqual(1, len(f.entries))
+        self.assertEqual(
+            self.get_absolute_path(self.entry_state[2][0]), f.entries[0].path
+        )
+
+
+class test_FS_Source_IgnoreFiles(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("source1", ".dedupeignore"), "*.log\n/top\nbuild/\n"),
+            (os.path.join("source1", "a.log"), None),
+            (os.path.join("source1", "top"), None),
+            (os.path.join("source1", "file1"), None),
+            (os.path.join("source1", "build", "file2"), None),
+            (os.path.join("source1", "sub", ".dedupeignore"), "keep*\n"),
+            (os.path.join("source1", "sub", "top"), None),
+            (os.path.join("source1", "sub", "build"), None),
+            (os.path.join("source1", "sub", "keep1"), None),
+            (os.path.join("source1", "sub", "deep", "b.log"), None),
+            (os.path.join("source1", "sub", "deep", "keep2"), None),
+            (os.path.join("source1", "sub", "deep", "file3"), None),
+        ]
+        super(test_FS_Source_IgnoreFiles, self).setUp()
+
+    def test_FS_Source_IgnoreFiles(self):
+        for fwalk in [False, True] if SUPPORTS_DIR_FD else [False]:
+            with self.subTest(fwalk=fwalk):
+                s = Source(
+                    self.get_absolute_path("source1"),
+                    1,
+                    fwalk=fwalk,
+                    ignore_file=".dedupeignore",
+                )
+                f = DummyCatalog()
+                stats = OperationStats()
+                s.walk(f, stats=stats)
+
+                self.assertCountEqual(
+                    [
+                        self.get_absolute_path(self.entry_state[i][0])
+                        for i in [3, 6, 7, 11]
+                    ],
+                    [fe.path for fe in f.entries],
+                )
+                self.assertEqual(1, stats.counters["directories_filtered"])
+                self.assertEqual(7, stats.counters["files_filtered"])
+
+    def test_FS_Source_IgnoreFiles_Disabled(self):
+        s = Source(self.get_absolute_path("source1"), 1)
+        f = DummyCatalog()
+        s.walk(f)
+
+        self.assertEqual(len(self.entry_state), len(f.entries))
+
+    def test_FS_Source_IgnoreFiles_Includes(self):
+        # Rules are found for directories that have not been walked.
+        s = Source(self.get_absolute_path("source1"), 1, ignore_file=".dedupeignore")
+        deep = self.get_absolute_path(os.path.join("source1", "sub", "deep"))
+        rules = s.get_ignore_rules(deep)
+
+        self.assertEqual(
+            ["deep/", "sub/deep/"], sorted(prefix for (r, prefix) in rules)
+        )
+        self.assertFalse(s.includes("c.log", deep, False, rules))
+        self.assertFalse(s.includes("keep3", deep, False, rules))
+        self.assertTrue(s.includes("file4", deep, False, rules))
+        self.assertFalse(s.includes(".dedupeignore", deep, False, rules))
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class test_FS_ColumnarFileCatalog(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("source1", "a", "file1"), "1"),
+            (os.path.join("source1", "file2"), "22"),
+            (os.path.join("source1", "file3"), "1"),
+            (os.path.join("source1", "empty"), ""),
+            (os.path.join("source2", "file4"), "22"),
+            (os.path.join("source2", "b", "c", "file5"), "1"),
+            (os.path.join("source2", "file6"), "333"),
+            (os.path.join("source2", "b", "file7"), "22"),
+        ]
+        super(test_FS_ColumnarFileCatalog, self).setUp()
+
+        for (i, (f, c)) in enumerate(self.entry_state):
+            os.utime(self.get_absolute_path(f), ns=(0, (i % 3) * 10 ** 9))
+
+    def get_catalogs(self):
+        sources = [
+            Source(self.get_absolute_path("source1"), 1),
+            Source(self.get_absolute_path("source2"), 2),
+        ]
+        c = ColumnarFileCatalog()
+        f = FileCatalog(lambda entry: entry.get_size() or None)
+        entries = DummyCatalog()
+        for s in sources:
+            s.walk(entries)
+        for entry in entries.entries:
+            c.add_entry(entry)
+            f.add_entry(entry)
+
+        return (c, f)
+
+    def test_FS_ColumnarFileCatalog_Groups(self):
+        (c, f) = self.get_catalogs()
+
+        self.assertEqual(f.get_groups(), c.get_groups())
+        self.assertEqual(7, len(c.entries))
+        self.assertEqual(
+            [e.get_size() for e in c.entries], c.get_column("size").tolist()
+        )
+
+    def test_FS_ColumnarFileCatalog_Resolvers(self):
+        (c, f) = self.get_catalogs()
+        groups = c.get_groups()
+
+        for resolver_class in [
+            PathLengthDuplicateResolver,
+            SourceOrderDuplicateResolver,
+            ModificationDateDuplicateResolver,
+        ]:
+            for reverse in [False, True]:
+                r = resolver_class(reverse)
+                self.assertEqual(
+                    [r.resolve(g) for g in groups], r.resolve_columnar(groups, c)
+                )
+
+    def test_FS_ColumnarFileCatalog_Mtime(self):
+        # Modification times a nanosecond apart must rank the same either way.
+        for (i, (f, c)) in enumerate(self.entry_state):
+            os.utime(self.get_absolute_path(f), ns=(0, 10 ** 18 + i % 2))
+        (c, f) = self.get_catalogs()
+        groups = c.get_groups()
+
+        for reverse in [False, True]:
+            r = ModificationDateDuplicateResolver(reverse)
+            self.assertEqual(
+                [r.resolve(g) for g in groups], r.resolve_columnar(groups, c)
+            )
+
+    def test_FS_ColumnarFileCatalog_ResolveGroups(self):
+        (c, f) = self.get_catalogs()
+        groups = c.get_groups()
+        o = DeduplicateOperation(
+            [],
+            [CopyPatternDuplicateResolver(), ModificationDateDuplicateResolver(True)],
+            DummySink(),
+            columnar=True,
+        )
+
+        self.assertEqual(
+            [o.resolve_group(list(g)) for g in groups], o.resolve_groups(groups, c)
+        )
+
+
+class test_FS_WatchedDeduplicateOperation(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("source1", "file1"), "Contents1"),
+            (os.path.join("source1", "file2"), "Contents1"),
+            (os.path.join("source1", "subdir", "file3"), "Contents2"),
+        ]
+        super(test_FS_WatchedDeduplicateOperation, self).setUp()
+
+    def get_operation(self, sink):
+        o = WatchedDeduplicateOperation(
+            [Source(self.get_absolute_path("source1"), 1)],
+            [FilenameSortDuplicateResolver()],
+            sink,
+            settle=0.05,
+            watcher_class=DummyWatcher,
+        )
+        o.watcher = DummyWatcher()
+        for s in o.sources:
+            o.watch_tree(s, s.path)
+            s.walk(o)
+        o.process()
+
+        return o
+
+    def create(self, path, contents):
+        path = self.get_absolute_path(path)
+        with open(path, "w") as f:
+            f.write(contents)
+
+        return path
+
+    def test_FS_WatchedDeduplicateOperation(self):
+        s = DummySink()
+        o = self.get_operation(s)
+
+        self.assertEqual(
+            [self.get_absolute_path(os.path.join("source1", "file2"))],
+            [d.path for d in s.sunk],
+        )
+        self.assertEqual(
+            {
+                self.get_absolute_path("source1"),
+                self.get_absolute_path(os.path.join("source1", "subdir")),
+            },
+            o.watcher.watched,
+        )
+
+        # A new duplicate is sunk; the duplicate already sunk is not sunk again.
+        path = self.create(os.path.join("source1", "file4"), "Contents1")
+        with unittest.mock.patch.object(
+            FileEntry, "run_digest", autospec=True, side_effect=FileEntry.run_digest
+        ) as run_digest:
+            o.apply([(path, InotifyWatcher.IN_CLOSE_WRITE)])
+            o.process()
+
+        self.assertEqual(1, run_digest.call_count)
+        self.assertEqual(path, s.sunk[-1].path)
+        self.assertEqual(2, len(s.sunk))
+        self.entry_state.append((os.path.join("source1", "file4"), "Contents1"))
+
+    def test_FS_WatchedDeduplicateOperation_Changes(self):
+        s = DummySink()
+        o = self.get_operation(s)
+        subdir = self.get_absolute_path(os.path.join("source1", "subdir"))
+
+        # Modified files are replaced in the catalog, and deleted files leave it.
+        old = o.files[self.get_absolute_path(os.path.join("source1", "file2"))]
+        path = self.create(os.path.join("source1", "file2"), "Contents3")
+        o.apply([(path, InotifyWatcher.IN_CLOSE_WRITE)])
+        o.process()
+        self.assertIsNot(old, o.files[path])
+        self.assertNotIn(old, o.store[old.get_size()])
+        self.assertEqual(1, len(s.sunk))
+
+        os.unlink(path)
+        del self.entry_state[1]
+        o.apply([(path, InotifyWatcher.IN_DELETE)])
+        o.apply([(subdir, InotifyWatcher.IN_MOVED_FROM | InotifyWatcher.IN_ISDIR)])
+        self.assertEqual(
+            [self.get_absolute_path(os.path.join("source1", "file1"))], list(o.files)
+        )
+        self.assertNotIn(subdir, o.watcher.watched)
+
+        # New directories are watched and scanned.
+        o.apply([(subdir, InotifyWatcher.IN_CREATE | InotifyWatcher.IN_ISDIR)])
+        o.process()
+        self.assertIn(subdir, o.watcher.watched)
+        self.assertEqual(2, len(o.files))
+
+    def test_FS_WatchedDeduplicateOperation_Rescan(self):
+        s = DummySink()
+        o = self.get_operation(s)
+        path = self.create(os.path.join("source1", "subdir", "file4"), "Contents2")
+        self.entry_state.append(
+            (os.path.join("source1", "subdir", "file4"), "Contents2")
+        )
+
+        o.apply([(None, InotifyWatcher.IN_Q_OVERFLOW)])
+        self.assertEqual([path], [entry.path for entry in o.added])
+        o.process()
 
-    def test_FS_FileEntry(self):
-        path = self.get_absolute_path(self.entry_state[0][0])
-        fe = FileEntry(path, None)
+        self.assertEqual(2, len(s.sunk))
+        self.assertEqual(4, len(o.files))
 
-        self.assertEqual(fe.path, path)
-        self.assertEqual(os.stat(path).st_size, fe.get_size())
-        self.assertEqual(None, fe.digest)
-        # The double-assert exercises the caching function
-        self.assertEqual(
-            hashlib.sha512("Contents1".encode("utf-8")).hexdigest(), fe.get_digest()
+    def test_FS_WatchedDeduplicateOperation_RefreshThenRescan(self):
+        # A file refreshed in the same batch as an overflow is still processed.
+        s = DummySink()
+        o = self.get_operation(s)
+        path = self.create(os.path.join("source1", "subdir", "file4"), "Contents2")
+        self.entry_state.append(
+            (os.path.join("source1", "subdir", "file4"), "Contents2")
         )
-        self.assertEqual(
-            hashlib.sha512("Contents1".encode("utf-8")).hexdigest(), fe.get_digest()
+
+        o.apply(
+            [
+                (path, InotifyWatcher.IN_CLOSE_WRITE),
+                (None, InotifyWatcher.IN_Q_OVERFLOW),
+            ]
         )
+        self.assertEqual([path], [entry.path for entry in o.added])
+        o.process()
+
+        self.assertEqual(2, len(s.sunk))
+        self.assertEqual(4, len(o.files))
+
+    def test_FS_WatchedDeduplicateOperation_MaxLatency(self):
+        # Changes are processed even if events never stop arriving.
+        path = self.get_absolute_path(os.path.join("source1", "file1"))
+
+        class BusyWatcher(DummyWatcher):
+            def read_events(self, timeout=None):
+                time.sleep(0.01)
+                return [(path, InotifyWatcher.IN_CLOSE_WRITE)]
+
+        o = WatchedDeduplicateOperation(
+            [Source(self.get_absolute_path("source1"), 1)],
+            [FilenameSortDuplicateResolver()],
+            DummySink(),
+            settle=60,
+            max_latency=0.05,
+            watcher_class=BusyWatcher,
+        )
+        stop = threading.Event()
+        process = o.process
+        calls = []
+
+        def record():
+            calls.append(time.monotonic())
+            process()
+            if len(calls) > 1:
+                stop.set()
+
+        with unittest.mock.patch.object(o, "process", side_effect=record):
+            thread = threading.Thread(target=o.watch, args=(stop,))
+            thread.start()
+            thread.join(10)
+            stop.set()
+            thread.join()
+
+        self.assertEqual(2, len(calls))
+        self.assertLess(calls[1] - calls[0], 5)
+
+    @unittest.skipIf(not sys.platform.startswith("linux"), "inotify requires Linux")
+    def test_FS_WatchedDeduplicateOperation_Inotify(self):
+        s = DummySink()
+        o = WatchedDeduplicateOperation(
+            [Source(self.get_absolute_path("source1"), 1)],
+            [FilenameSortDuplicateResolver()],
+            s,
+            settle=0.05,
+        )
+        stop = threading.Event()
+        thread = threading.Thread(target=o.watch, args=(stop,))
+        thread.start()
+
+        try:
+            deadline = time.monotonic() + 10
+            while len(s.sunk) < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            os.mkdir(self.get_absolute_path(os.path.join("source1", "new")))
+            time.sleep(0.2)
+            path = self.create(os.path.join("source1", "new", "file4"), "Contents2")
+            self.entry_state.append(
+                (os.path.join("source1", "new", "file4"), "Contents2")
+            )
 
+            while len(s.sunk) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            thread.join()
 
-class test_FS_Source(test_FileSystemTestBase, unittest.TestCase):
+        self.assertEqual(path, s.sunk[-1].path)
+
+
+class test_FS_HardLinks(test_FileSystemTestBase, unittest.TestCase):
     def setUp(self):
         self.entry_state = [
             (os.path.join("source1", "file1"), "Contents1"),
-            (os.path.join("source1", "subdir1", "file2"), "Contents1"),
+            (os.path.join("source1", "file2"), "Contents1"),
             (os.path.join("source1", "file3"), "Contents2"),
-            (os.path.join("source1", "subdir2", "subdir", "file4"), "Contents2"),
         ]
-        super(test_FS_Source, self).setUp()
-
-    def test_FS_Source(self):
-        s = Source(self.get_absolute_path("source1"), 2)
-        f = DummyCatalog()
-
-        self.assertEqual(2, s.order)
-        s.walk(f)
+        super(test_FS_HardLinks, self).setUp()
 
-        self.assertCountEqual(
-            [self.get_absolute_path(f) for (f, c) in self.entry_state],
-            [fe.path for fe in f.entries],
+        os.link(
+            self.get_absolute_path(os.path.join("source1", "file1")),
+            self.get_absolute_path(os.path.join("source1", "link1")),
         )
-
-    def test_FS_Source_WithFilter(self):
-        names = ["subdir1", "file1"]
-        patterns = [re.compile("f.*[4-5]$")]
-
-        sf = ConfiguredSourceFilter(names=names, patterns=patterns)
-        s = Source(self.get_absolute_path("source1"), 1, sf)
-        f = DummyCatalog()
-
-        s.walk(f)
-        self.assertEqual(1, len(f.entries))
-        self.assertEqual(
-            self.get_absolute_path(self.entry_state[2][0]), f.entries[0].path
+        os.link(
+            self.get_absolute_path(os.path.join("source1", "file3")),
+            self.get_absolute_path(os.path.join("source1", "link3")),
         )
 
+    def perform(self, **kwargs):
+        s = DummySink()
+        with unittest.mock.patch.object(
+            FileEntry, "run_digest", autospec=True, side_effect=FileEntry.run_digest
+        ) as run_digest:
+            DeduplicateOperation(
+                [Source(self.get_absolute_path("source1"), 1)],
+                [FilenameSortDuplicateResolver()],
+                s,
+                ContentSampler(4),
+                **kwargs
+            ).run()
+
+        return (sorted(os.path.basename(e.path) for e in s.sunk), run_digest)
+
+    def test_FS_HardLinks_GetInode(self):
+        one = FileEntry(self.get_absolute_path(os.path.join("source1", "file1")), None)
+        two = FileEntry(self.get_absolute_path(os.path.join("source1", "file2")), None)
+        link = FileEntry(self.get_absolute_path(os.path.join("source1", "link1")), None)
+
+        self.assertEqual(one.get_inode(), link.get_inode())
+        self.assertNotEqual(one.get_inode(), two.get_inode())
+
+    def test_FS_HardLinks_SharedDigests(self):
+        (sunk, run_digest) = self.perform(jobs=2)
+
+        # Each inode is only hashed once.
+        self.assertEqual(["file2", "link1", "link3"], sunk)
+        self.assertEqual(3, run_digest.call_count)
+
+    def test_FS_HardLinks_Collapse(self):
+        (sunk, run_digest) = self.perform(collapse_links=True)
+
+        # Only whichever link to file1 was found first is considered.
+        self.assertEqual(1, len(sunk))
+        self.assertIn(sunk[0], ["file2", "link1"])
+        self.assertEqual(3, run_digest.call_count)
+
+    def test_FS_HardLinks_MemoryLimit(self):
+        # Entries are not held alive by the record of first links once their
+        # size group has been hashed, so a spilled catalog stays bounded.
+        for size in range(1, 51):
+            for contents in ["a", "b"]:
+                path = os.path.join("source1", "sized", "{}{}".format(contents, size))
+                self.entry_state.append((path, contents * size))
+        os.mkdir(self.get_absolute_path(os.path.join("source1", "sized")))
+        for (path, contents) in self.entry_state[-100:]:
+            with open(self.get_absolute_path(path), "w") as f:
+                f.write(contents)
+
+        alive = []
+        original = FileEntry.run_digest
+
+        # Not a mock, which would keep every entry it is called with.
+        def run_digest(entry, *args, **kwargs):
+            gc.collect()
+            alive.append(sum(isinstance(o, FileEntry) for o in gc.get_objects()))
+            return original(entry, *args, **kwargs)
+
+        with unittest.mock.patch.object(FileEntry, "run_digest", run_digest):
+            DeduplicateOperation(
+                [Source(self.get_absolute_path("source1"), 1)],
+                [FilenameSortDuplicateResolver()],
+                DummySink(),
+                # Room for only a few entries, so that the catalog spills to disk.
+                memory_limit=20 * 1024,
+            ).run()
+
+        self.assertEqual(103, len(alive))
+        self.assertLess(max(alive), 20)
+
 
 # Tests for resolvers (individual, with real entry and source objects but no sink)
 
@@ -887,6 +2778,87 @@ class test_FS_DeleteDuplicateFileSink(test_FileSystemTestBase, unittest.TestCase
 
         self.check_exit_state([])
 
+    def test_Deletion_Parallel(self):
+        s = DeleteDuplicateFileSink(jobs=3)
+        s.chunk_size = 2
+        missing = self.get_absolute_path("missing")
+
+        with self.assertLogs(level="ERROR") as logs:
+            s.sink(
+                [DummyEntry(self.get_absolute_path(f)) for (f, c) in self.entry_state]
+                + [DummyEntry(missing)]
+            )
+
+        self.check_exit_state([])
+        self.assertEqual(1, s.failures)
+        self.assertEqual(1, len(logs.output))
+        self.assertIn(
+            "Unable to delete duplicate file {}".format(missing), logs.output[0]
+        )
+
+    @unittest.skipUnless(SUPPORTS_DIR_FD, "Directory descriptors are not supported")
+    def test_Deletion_DirectoryDescriptor(self):
+        s = DeleteDuplicateFileSink()
+        files = [DummyEntry(self.get_absolute_path(f)) for (f, c) in self.entry_state]
+
+        with unittest.mock.patch("os.unlink", wraps=os.unlink) as unlink:
+            s.sink(files)
+
+        self.check_exit_state([])
+        self.assertEqual(
+            [(os.path.basename(e.path),) for e in files],
+            [call[0] for call in unlink.call_args_list],
+        )
+        self.assertTrue(all("dir_fd" in call[1] for call in unlink.call_args_list))
+
+        # Errors are reported as they are without directory descriptors.
+        outputs = []
+        for supported in [True, False]:
+            with unittest.mock.patch(
+                "dedupe_trees.dedupe_trees.SUPPORTS_DIR_FD", supported
+            ):
+                with self.assertLogs(level="ERROR") as logs:
+                    s.sink(files[:1])
+            outputs.append(logs.output)
+
+        self.assertEqual(outputs[0], outputs[1])
+
+    @unittest.skipUnless(SUPPORTS_DIR_FD, "Directory descriptors are not supported")
+    def test_Deletion_DirectoryMoved(self):
+        # Files are found in their directory even if it moves while it is
+        # being worked on.
+        s = DeleteDuplicateFileSink()
+        open_directory = s.open_directory
+        moved_path = self.get_absolute_path("moved")
+        os.mkdir(self.get_absolute_path("directory"))
+        files = []
+        for i in range(3):
+            path = self.get_absolute_path(os.path.join("directory", str(i)))
+            with open(path, "w") as f:
+                f.write("Test")
+            files.append(DummyEntry(path))
+
+        def open_and_move(directory):
+            dir_fd = open_directory(directory)
+            os.rename(directory, moved_path)
+            return dir_fd
+
+        s.open_directory = open_and_move
+        s.sink(files)
+
+        self.assertEqual(0, s.failures)
+        self.assertEqual([], os.listdir(moved_path))
+
+    def test_Tasks(self):
+        s = DeleteDuplicateFileSink()
+        s.chunk_size = 2
+        files = [DummyEntry(p) for p in ["b/1", "a/1", "b/2", "a/2", "b/3", "c/1"]]
+
+        self.assertEqual(
+            [["a/1", "a/2"], ["b/1", "b/2"], ["b/3"], ["c/1"]],
+            [[e.path for e in task] for task in s.get_tasks(files)],
+        )
+
 
 class test_FS_SequesterDuplicateFileSink(test_FileSystemTestBase, unittest.TestCase):
     def setUp(self):
@@ -912,6 +2884,127 @@ class test_FS_SequesterDuplicateFileSink(test_FileSystemTestBase, unittest.TestC
             ]
         )
 
+    def test_Sequestration_Parallel(self):
+        s = SequesterDuplicateFileSink(self.get_absolute_path("sink"), jobs=4)
+        s.chunk_size = 1
+
+        files = [DummyEntry(self.get_absolute_path(f)) for (f, c) in self.entry_state]
+
+        s.sink(files[:5])
+        with unittest.mock.patch("os.makedirs") as makedirs:
+            s.sink(files[5:])
+
+        # Directories already created are remembered.
+        makedirs.assert_not_called()
+        self.check_exit_state(
+            [
+                (
+                    s.construct_sequestered_path(self.get_absolute_path(p))[
+                        len(self.temp_dir) :
+                    ],
+                    None,
+                )
+                for (p, c) in self.entry_state
+            ]
+        )
+
+    def test_Sequestration_DirectoryRemoved(self):
+        s = SequesterDuplicateFileSink(self.get_absolute_path("sink"))
+        files = [DummyEntry(self.get_absolute_path(f)) for (f, c) in self.entry_state]
+
+        s.sink(files[:1])
+        shutil.rmtree(self.get_absolute_path("sink"))
+        s.sink(files[1:])
+
+        self.assertEqual(0, s.failures)
+        self.check_exit_state(
+            [
+                (
+                    s.construct_sequestered_path(self.get_absolute_path(p))[
+                        len(self.temp_dir) :
+                    ],
+                    None,
+                )
+                for (p, c) in self.entry_state[1:]
+            ]
+        )
+
+
+class test_FS_LinkDuplicateFileSink(test_FileSystemTestBase, unittest.TestCase):
+    def setUp(self):
+        self.entry_state = [
+            (os.path.join("source", "original"), "Contents1"),
+            (os.path.join("source", "dup1"), "Contents1"),
+            (os.path.join("source", "subdir", "dup2"), "Contents1"),
+        ]
+        super(test_FS_LinkDuplicateFileSink, self).setUp()
+
+    def get_duplicates(self):
+        original = DummyEntry(self.get_absolute_path(self.entry_state[0][0]))
+        duplicates = [
+            DummyEntry(self.get_absolute_path(f)) for (f, c) in self.entry_state[1:]
+        ]
+        for d in duplicates:
+            d.original = original
+
+        return duplicates
+
+    def assertLinked(self, linked):
+        original = os.stat(self.get_absolute_path(self.entry_state[0][0]))
+        for (f, c) in self.entry_state[1:]:
+            self.assertEqual(
+                linked, os.path.samestat(original, os.stat(self.get_absolute_path(f)))
+            )
+
+        # No temporary files are left behind.
+        self.check_exit_state(self.entry_state)
+
+    def test_Hardlink(self):
+        LinkDuplicateFileSink("hardlink").sink(self.get_duplicates())
+
+        self.assertLinked(True)
+
+    def test_Auto(self):
+        # Reflinks are used if the temporary filesystem supports them.
+        LinkDuplicateFileSink().sink(self.get_duplicates())
+
+        original = os.stat(self.get_absolute_path(self.entry_state[0][0]))
+        for (f, c) in self.entry_state[1:]:
+            st = os.stat(self.get_absolute_path(f))
+            self.assertTrue(os.path.samestat(original, st) or st.st_nlink == 1)
+
+        self.check_exit_state(self.entry_state)
+
+    def test_Auto_Fallback(self):
+        with unittest.mock.patch(
+            "fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "Not supported")
+        ):
+            LinkDuplicateFileSink().sink(self.get_duplicates())
+
+        self.assertLinked(True)
+
+    def test_Reflink_Unsupported(self):
+        with unittest.mock.patch(
+            "fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "Not supported")
+        ):
+            with self.assertLogs("dedupe_trees.dedupe_trees", "ERROR"):
+                LinkDuplicateFileSink("reflink").sink(self.get_duplicates())
+
+        self.assertLinked(False)
+
+    def test_NoOriginal(self):
+        duplicates = self.get_duplicates()
+        duplicates[0].original = None
+
+        with self.assertLogs("dedupe_trees.dedupe_trees", "ERROR"):
+            LinkDuplicateFileSink("hardlink").sink(duplicates[:1])
+
+        self.assertLinked(False)
+
+    def test_InvalidMode(self):
+        with self.assertRaises(ValueError):
+            LinkDuplicateFileSink("copy")
+
 
 class test_FS_OutputOnlyDuplicateFileSink(test_FileSystemTestBase, unittest.TestCase):
     def setUp(self):
@@ -953,19 +3046,36 @@ class test_Integration(test_FileSystemTestBase, unittest.TestCase):
         ]
         super(test_Integration, self).setUp()
 
-    def perform(self, resolvers, sink, exit_states):
-        o = DeduplicateOperation(
+    # Subclasses vary the keyword arguments given to each Source and to the
+    # DeduplicateOperation under test.
+    def source_options(self):
+        return {}
+
+    def operation_options(self):
+        return {}
+
+    def make_operation(self, resolvers, sink, **kwargs):
+        paths = [
+            "source1",
+            os.path.join("sources", "source2"),
+            os.path.join("sources", "source3"),
+            os.path.join("sources", "source4"),
+        ]
+        options = self.operation_options()
+        options.update(kwargs)
+
+        return DeduplicateOperation(
             [
-                Source(self.get_absolute_path("source1"), 1),
-                Source(self.get_absolute_path(os.path.join("sources", "source2")), 2),
-                Source(self.get_absolute_path(os.path.join("sources", "source3")), 3),
-                Source(self.get_absolute_path(os.path.join("sources", "source4")), 4),
+                Source(self.get_absolute_path(path), i + 1, **self.source_options())
+                for (i, path) in enumerate(paths)
             ],
             resolvers,
             sink,
+            **options
         )
 
-        o.run()
+    def perform(self, resolvers, sink, exit_states, **kwargs):
+        self.make_operation(resolvers, sink, **kwargs).run()
 
         self.check_exit_state(exit_states)
 
@@ -1056,6 +3166,40 @@ class test_Integration(test_FileSystemTestBase, unittest.TestCase):
             ],
         )
 
+    def assertLinkedTo(self, originals, duplicates):
+        # Duplicates are linked to one of the unresolved originals.
+        for d in duplicates:
+            self.assertTrue(
+                any(
+                    os.path.samefile(
+                        self.get_absolute_path(o), self.get_absolute_path(d)
+                    )
+                    for o in originals
+                )
+            )
+
+    def test_Integration_DepthAndSourceOrder_LinkSink(self):
+        self.perform(
+            [PathLengthDuplicateResolver(), SourceOrderDuplicateResolver()],
+            LinkDuplicateFileSink("hardlink"),
+            self.entry_state,
+        )
+
+        self.assertLinkedTo(
+            [
+                os.path.join("source1", "file1"),
+                os.path.join("source1", "Copy of file1"),
+            ],
+            [
+                os.path.join("sources", "source2", "file4"),
+                os.path.join("sources", "source4", "file9"),
+            ],
+        )
+        self.assertLinkedTo(
+            [os.path.join("sources", "source3", "file8")],
+            [os.path.join("sources", "source4", "file10")],
+        )
+
     def test_Integration_CopyPattern_DeleteSink(self):
         self.perform(
             [CopyPatternDuplicateResolver()],
@@ -1074,6 +3218,186 @@ class test_Integration(test_FileSystemTestBase, unittest.TestCase):
         )
 
 
+class test_Integration_Sampled(test_Integration):
+    def operation_options(self):
+        return {"sampler": ContentSampler(4, tail=True)}
+
+
+class test_Integration_Compact(test_Integration):
+    def source_options(self):
+        return {"compact": True}
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class test_Integration_Columnar(test_Integration):
+    def operation_options(self):
+        return {"columnar": True}
+
+
+class test_Integration_MemoryLimit(test_Integration):
+    def operation_options(self):
+        # Room for only a few entries, so that the catalog spills to disk.
+        return {"memory_limit": 3000}
+
+
+class test_Integration_Concurrent(test_Integration):
+    def operation_options(self):
+        return {"sampler": ContentSampler(4), "jobs": 4}
+
+    def test_Integration_Concurrent_Order(self):
+        # The concurrent path must sink files in exactly the serial order.
+        outputs = []
+        for jobs in [1, 4]:
+            o = io.StringIO()
+            self.perform(
+                [PathLengthDuplicateResolver(), SourceOrderDuplicateResolver()],
+                OutputOnlyDuplicateFileSink(path=o),
+                self.entry_state,
+                jobs=jobs,
+            )
+            outputs.append(o.getvalue())
+
+        self.assertEqual(4, len(outputs[0].splitlines()))
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class test_Integration_Compared(test_Integration):
+    def operation_options(self):
+        return {"comparator": BlockComparator(2, 4)}
+
+
+class ConstantChecksum:
+    # A worst-case checksum: every file collides.
+    def update(self, data):
+        pass
+
+    def hexdigest(self):
+        return "0"
+
+
+class test_Integration_Checksum(test_Integration):
+    def operation_options(self):
+        return {"algorithm": HashAlgorithm("constant", ConstantChecksum, False)}
+
+
+class test_Integration_Async(test_Integration):
+    def operation_options(self):
+        return {"sampler": ContentSampler(4)}
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def perform(self, resolvers, sink, exit_states):
+        async def consume():
+            return [g async for g in self.make_operation(resolvers, sink).groups()]
+
+        self.run_async(consume())
+        self.check_exit_state(exit_states)
+
+    def test_Async_Groups(self):
+        s = DummySink()
+        o = self.make_operation([SourceOrderDuplicateResolver()], s, jobs=3)
+
+        async def consume():
+            return [g async for g in o.groups(queue_size=1)]
+
+        groups = self.run_async(consume())
+
+        self.assertEqual(3, len(groups))
+        self.assertCountEqual(
+            [d for (originals, duplicates) in groups for d in duplicates], s.sunk
+        )
+        self.assertCountEqual(
+            [
+                self.get_absolute_path(os.path.join("sources", "source2", "file4")),
+                self.get_absolute_path(os.path.join("sources", "source4", "file9")),
+                self.get_absolute_path(os.path.join("sources", "source2", "file5")),
+                self.get_absolute_path(os.path.join("sources", "source4", "file10")),
+            ],
+            [d.path for d in s.sunk],
+        )
+
+    def test_Async_Responsive(self):
+        # The event loop keeps running while the operation is blocked.
+        ticks = []
+        o = self.make_operation([InteractiveDuplicateResolver()], DummySink())
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        def slow_input(prompt):
+            time.sleep(0.1)
+            return "s"
+
+        async def consume():
+            ticker = asyncio.ensure_future(tick())
+            groups = [g async for g in o.groups()]
+            ticker.cancel()
+            return groups
+
+        with unittest.mock.patch("builtins.input", side_effect=slow_input):
+            with unittest.mock.patch("sys.stdout", io.StringIO()):
+                self.assertEqual(3, len(self.run_async(consume())))
+
+        self.assertGreater(len(ticks), 5)
+
+    def test_Async_Cancellation(self):
+        s = DummySink()
+        o = self.make_operation([SourceOrderDuplicateResolver()], s, sink_batch_size=1)
+
+        async def consume():
+            groups = o.groups(queue_size=1)
+            async for g in groups:
+                break
+            await groups.aclose()
+
+        self.run_async(consume())
+
+        self.assertLess(len(s.sunk), 4)
+
+    def test_Async_Stop(self):
+        # Walking and hashing stop before the next file once asked to.
+        o = self.make_operation([SourceOrderDuplicateResolver()], DummySink())
+        o.stop_event = threading.Event()
+        o.stop_event.set()
+        with self.assertRaises(OperationStopped):
+            o.run()
+        self.assertEqual(0, o.stats.counters["files_walked"])
+
+        o = self.make_operation([SourceOrderDuplicateResolver()], DummySink())
+        o.stop_event = threading.Event()
+        get_partial_digest = o.get_partial_digest
+
+        def stop(entry):
+            o.stop_event.set()
+            return get_partial_digest(entry)
+
+        with unittest.mock.patch.object(o, "get_partial_digest", side_effect=stop):
+            with self.assertRaises(OperationStopped):
+                o.run()
+        self.assertEqual(1, o.stats.counters["files_sampled"])
+
+    def test_Async_Failure(self):
+        o = self.make_operation([FailingResolver()], DummySink())
+
+        async def consume():
+            return [g async for g in o.groups()]
+
+        with self.assertRaises(UserCanceledException):
+            self.run_async(consume())
+
+
+class FailingResolver(DuplicateResolver):
+    def resolve(self, flist):
+        raise UserCanceledException()
+
+
 # Command-line integration tests (pass real parameter sets to main and execute against disk)
 
 
@@ -1205,6 +3529,34 @@ class test_CommandLine_Integration(test_Integration):
             ],
         )
 
+    def test_Integration_DepthAndSourceOrder_LinkSink(self):
+        self.perform(
+            [
+                "run_dedupe_trees.py",
+                "--resolve-path-length",
+                "--resolve-source-order",
+                "--sink-link",
+                "--sink-link-mode",
+                "hardlink",
+                self.get_absolute_path("source1"),
+                self.get_absolute_path(os.path.join("sources", "source2")),
+                self.get_absolute_path(os.path.join("sources", "source3")),
+                self.get_absolute_path(os.path.join("sources", "source4")),
+            ],
+            self.entry_state,
+        )
+
+        self.assertLinkedTo(
+            [
+                os.path.join("source1", "file1"),
+                os.path.join("source1", "Copy of file1"),
+            ],
+            [
+                os.path.join("sources", "source2", "file4"),
+                os.path.join("sources", "source4", "file9"),
+            ],
+        )
+
     def test_Integration_CopyPattern_DeleteSink(self):
         self.perform(
             [
@@ -1338,6 +3690,72 @@ class test_ResolverAction(unittest.TestCase):
         self.assertEqual(True, resolvers[1].reverse)
 
 
+class test_Benchmark(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_contents(self, root):
+        contents = {}
+        for (cwd, subdirs, files) in os.walk(root):
+            for f in files:
+                with open(os.path.join(cwd, f), "rb") as fh:
+                    contents[os.path.relpath(os.path.join(cwd, f), root)] = fh.read()
+
+        return contents
+
+    def test_Benchmark_GenerateTree(self):
+        from dedupe_trees.benchmark import generate_tree
+
+        roots = [os.path.join(self.temp_dir, name) for name in ["a", "b", "c"]]
+        summary = generate_tree(roots[0], 200, depth=2, fanout=3, min_size=64)
+        self.assertEqual(
+            summary, generate_tree(roots[1], 200, depth=2, fanout=3, min_size=64)
+        )
+        generate_tree(roots[2], 200, depth=2, fanout=3, min_size=64, seed=1)
+
+        self.assertEqual(self.get_contents(roots[0]), self.get_contents(roots[1]))
+        self.assertNotEqual(self.get_contents(roots[0]), self.get_contents(roots[2]))
+        self.assertEqual(200, summary["files"])
+        self.assertEqual(13, summary["directories"])
+        self.assertEqual(60, summary["duplicates"])
+        self.assertEqual(10, summary["decoys"])
+
+        contents = list(self.get_contents(roots[0]).values())
+        self.assertEqual(140, len(set(contents)))
+        self.assertTrue(all(64 <= len(c) <= 1 << 16 for c in contents))
+
+    def test_Benchmark_RunBenchmark(self):
+        from dedupe_trees.benchmark import PHASES, generate_tree, run_benchmark
+
+        summary = generate_tree(self.temp_dir, 100, min_size=64, decoy_ratio=0.1)
+        results = run_benchmark(self.temp_dir, repeat=2, jobs=2)
+
+        self.assertCountEqual(PHASES, results["phases"].keys())
+        self.assertEqual(100, results["counts"]["files"])
+        self.assertEqual(summary["duplicates"], results["counts"]["duplicates"])
+        self.assertEqual(
+            summary["duplicate_groups"], results["counts"]["duplicate_groups"]
+        )
+        self.assertEqual(100, len(self.get_contents(self.temp_dir)))
+
+
+class test_MemorySize(unittest.TestCase):
+    def test_MemorySize(self):
+        import argparse
+        import dedupe_trees.__main__ as ddt
+
+        self.assertEqual(1000, ddt.memory_size("1000"))
+        self.assertEqual(512 << 20, ddt.memory_size("512M"))
+        self.assertEqual(2 << 30, ddt.memory_size("2g"))
+
+        for value in ["", "0", "-1K", "lots", "1Q"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                ddt.memory_size(value)
+
+
 class test_ErrorHandling_Arguments(test_FileSystemTestBase, unittest.TestCase):
     def setUp(self):
         self.entry_state = []